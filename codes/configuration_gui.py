@@ -276,6 +276,8 @@ class App(ctk.CTk):
         #check if there's a tortoise-tts-fast folder in the current directory
         #playground variables
         self.playground_api = None
+        self.playground_conditioning_cache = None
+        self.playground_conditioning_cache_size = 1 << 30
         self.playground_model_path = self.find_latest_generated_model() if os.path.exists('tortoise-tts-fast') else ''
         self.playground_seed = ''
         self.playground_text = ''
@@ -864,6 +866,12 @@ class App(ctk.CTk):
         import torch
         from tortoise.inference import save_gen_with_voicefix
         from tortoise.utils.audio import load_required_audio, check_audio
+        if self.playground_conditioning_cache is None:
+            sys.path.append('./codes')
+            from scripts.audio.gen.conditioning_cache import ConditioningCache
+            self.playground_conditioning_cache = ConditioningCache(os.path.join('results', 'conditioning_cache'),
+                                                                   max_bytes=self.playground_conditioning_cache_size)
+        from scripts.audio.gen.conditioning_cache import compute_voice_key
         def get_voices(voice_dir):
             voices: Dict[str, List[str]] = {}
             subj = voice_dir
@@ -926,12 +934,22 @@ class App(ctk.CTk):
                     voice_samples = None
                     conditioning_latents = torch.load(paths[0])
                 else:
-                    conds = []
-                    for cond_path in paths:
-                        c = load_required_audio(cond_path)
-                        conds.append(c)
-                    voice_samples = conds
-                    conditioning_latents = None
+                    # Conditioning latents only depend on the voice and the model, so they are computed once and
+                    # reused from disk for every later generation with the same voice.
+                    def compute_latents():
+                        conds = []
+                        for cond_path in paths:
+                            c = load_required_audio(cond_path)
+                            conds.append(c)
+                        auto_latent, diffusion_latent = self.playground_api.get_conditioning_latents(conds)
+                        return {'autoregressive': auto_latent, 'diffusion': diffusion_latent}
+                    # In compare-to-original mode the stock model is loaded rather than the fine-tuned checkpoint,
+                    # and its latents must not be mixed up with the fine-tuned model's.
+                    checkpoint = model_path if model_path.endswith(".pth") and not original else None
+                    key = compute_voice_key(voice_dir, checkpoint, model='original' if original else 'finetuned')
+                    latents = self.playground_conditioning_cache.get_or_compute(key, compute_latents)
+                    voice_samples = None
+                    conditioning_latents = (latents['autoregressive'], latents['diffusion'])
             with timeit(
                 f"Generating candidates)"
             ):
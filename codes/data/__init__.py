@@ -6,9 +6,12 @@ from munch import munchify
 from utils.util import opt_get
 
 
-def create_dataloader(dataset, dataset_opt, opt=None, sampler=None, collate_fn=None, shuffle=True):
+def create_dataloader(dataset, dataset_opt, opt=None, sampler=None, collate_fn=None, shuffle=True, batch_sampler=None):
     phase = dataset_opt['phase']
     pin_memory = opt_get(dataset_opt, ['pin_memory'], True)
+    if batch_sampler is not None:
+        return torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler, num_workers=dataset_opt['n_workers'],
+                                           pin_memory=pin_memory, collate_fn=collate_fn)
     if phase == 'train':
         if opt_get(opt, ['dist'], False):
             world_size = torch.distributed.get_world_size()
@@ -105,6 +108,9 @@ def create_dataset(dataset_opt, return_collate=False):
     else:
         raise NotImplementedError('Dataset [{:s}] is not recognized.'.format(mode))
     dataset = D(dataset_opt)
+    if mode == 'paired_voice_audio' and 'length_bucketing' in dataset_opt.keys():
+        from data.zero_pad_dict_collate import ZeroPadDictCollate
+        collate = ZeroPadDictCollate(dataset.get_pad_fns())
 
     if return_collate:
         return dataset, collate
@@ -112,6 +118,35 @@ def create_dataset(dataset_opt, return_collate=False):
         return dataset
 
 
+def create_length_bucketed_sampler(dataset, dataset_opt, num_replicas=1, rank=0):
+    """
+    Builds a LengthBucketedBatchSampler from the `length_bucketing` section of a dataset config, e.g.:
+      length_bucketing:
+        max_samples_per_batch: 4000000  # Budget for padded audio samples in a (per-GPU) batch.
+        max_tokens_per_batch: 8000  # Budget for padded text tokens in a (per-GPU) batch.
+        max_batch_size: 256
+    The dataset must implement get_length_index().
+    """
+    from data.data_sampler import LengthBucketedBatchSampler
+    bucketing = dataset_opt['length_bucketing']
+    if num_replicas > 1:
+        # Computing the index can mean reading every clip, so only rank 0 does it and shares the result.
+        lengths = [dataset.get_length_index() if rank == 0 else None]
+        torch.distributed.broadcast_object_list(lengths, src=0)
+        lengths = lengths[0]
+    else:
+        lengths = dataset.get_length_index()
+    return LengthBucketedBatchSampler(lengths,
+                                      [opt_get(bucketing, ['max_samples_per_batch'], None),
+                                       opt_get(bucketing, ['max_tokens_per_batch'], None)],
+                                      max_batch_size=opt_get(bucketing, ['max_batch_size'], None),
+                                      max_lengths=[opt_get(dataset_opt, ['max_wav_length'], None),
+                                                   opt_get(dataset_opt, ['max_text_length'], None)],
+                                      sort_window=opt_get(bucketing, ['sort_window'], 4096),
+                                      num_replicas=num_replicas, rank=rank,
+                                      seed=opt_get(dataset_opt, ['seed'], 0))
+
+
 def get_dataset_debugger(dataset_opt):
     mode = dataset_opt['mode']
     if mode == 'paired_voice_audio':
@@ -0,0 +1,143 @@
+import os
+
+import numpy as np
+import torch
+import torchaudio
+
+
+INDEX_NAME = 'index.pth'
+
+
+def _key(path):
+    return os.path.normpath(os.path.abspath(path))
+
+
+class AudioShardWriter:
+    """
+    Packs audio clips into a small number of large shard files of raw int16 PCM, all resampled to a single sample rate.
+    An index maps the (normalized) source path of every clip to its shard, offset and length in samples, so that readers
+    can slice clips straight out of a memory map without touching the original files.
+    """
+    def __init__(self, output_dir, sample_rate, max_shard_bytes=2 << 30):
+        self.output_dir = output_dir
+        self.max_shard_bytes = max_shard_bytes
+        os.makedirs(output_dir, exist_ok=True)
+        index_path = os.path.join(output_dir, INDEX_NAME)
+        if os.path.exists(index_path):
+            self.index = torch.load(index_path)
+            assert self.index['sample_rate'] == sample_rate, f'{output_dir} was packed at a different sample rate.'
+        else:
+            self.index = {'sample_rate': sample_rate, 'shards': [], 'clips': {}}
+        self._shard_file = None
+        self._shard_offset = 0
+
+    def __contains__(self, path):
+        return _key(path) in self.index['clips'].keys()
+
+    def _open_new_shard(self):
+        if self._shard_file is not None:
+            self._shard_file.close()
+        name = f'shard_{len(self.index["shards"]):05}.pcm'
+        self.index['shards'].append(name)
+        self._shard_file = open(os.path.join(self.output_dir, name), 'wb')
+        self._shard_offset = 0
+
+    def add(self, path, audio):
+        """
+        Appends a clip to the current shard.
+        :param audio: Float tensor in [-1,1] at the sample rate of this writer. A leading channel dimension is squeezed out.
+        """
+        if len(audio.shape) > 1:
+            audio = audio.squeeze(0)
+        pcm = (audio.clamp(-1, 1) * 32767).round().short().numpy()
+        if self._shard_file is None or self._shard_offset * 2 + pcm.nbytes > self.max_shard_bytes:
+            self._open_new_shard()
+        self._shard_file.write(pcm.tobytes())
+        self.index['clips'][_key(path)] = (len(self.index['shards']) - 1, self._shard_offset, pcm.shape[0])
+        self._shard_offset += pcm.shape[0]
+
+    def close(self):
+        if self._shard_file is not None:
+            self._shard_file.close()
+            self._shard_file = None
+        index_path = os.path.join(self.output_dir, INDEX_NAME)
+        torch.save(self.index, index_path + '.tmp')
+        os.replace(index_path + '.tmp', index_path)
+
+
+class AudioShardReader:
+    """
+    Reads clips packed by AudioShardWriter. Shards are memory-mapped lazily so that every DataLoader worker opens its
+    own maps after it is forked.
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.index = torch.load(os.path.join(shard_dir, INDEX_NAME))
+        self.sample_rate = self.index['sample_rate']
+        self.clips = self.index['clips']
+        self._maps = {}
+
+    def __getstate__(self):
+        # Workers that are spawned rather than forked receive the reader pickled; they open their own maps.
+        state = dict(self.__dict__)
+        state['_maps'] = {}
+        return state
+
+    def __contains__(self, path):
+        return _key(path) in self.clips.keys()
+
+    def __len__(self):
+        return len(self.clips)
+
+    def paths(self):
+        return list(self.clips.keys())
+
+    def _get_map(self, shard):
+        if shard not in self._maps.keys():
+            self._maps[shard] = np.memmap(os.path.join(self.shard_dir, self.index['shards'][shard]), dtype=np.int16, mode='r')
+        return self._maps[shard]
+
+    def load(self, path, sampling_rate):
+        """
+        Returns the clip at <path> as a (1, samples) float tensor at <sampling_rate>, mirroring load_audio(). Range
+        checking and clipping are left to load_audio().
+        """
+        shard, offset, length = self.clips[_key(path)]
+        pcm = self._get_map(shard)[offset:offset+length]
+        audio = torch.from_numpy(pcm.astype(np.float32)) / 32767
+        if self.sample_rate != sampling_rate:
+            audio = torchaudio.functional.resample(audio, self.sample_rate, sampling_rate)
+        return audio.unsqueeze(0)
+
+
+# Readers are shared by every dataset that opens the same shard directory.
+_readers = {}
+
+
+def open_audio_shards(shard_dirs):
+    """
+    Returns the readers for the shard directories <shard_dirs>. Datasets keep these and pass them to load_audio() and
+    get_audio_length(), so that only the datasets configured with shards read from them.
+    """
+    if not isinstance(shard_dirs, list):
+        shard_dirs = [shard_dirs]
+    for d in shard_dirs:
+        if d not in _readers.keys():
+            _readers[d] = AudioShardReader(d)
+    return [_readers[d] for d in shard_dirs]
+
+
+def get_audio_length_from_shards(audiopath, sampling_rate, shards):
+    """ Returns the length in samples at <sampling_rate> of the clip at <audiopath>, or None if it is not in <shards>. """
+    for reader in shards:
+        if audiopath in reader:
+            return reader.clips[_key(audiopath)][2] * sampling_rate // reader.sample_rate
+    return None
+
+
+def load_audio_from_shards(audiopath, sampling_rate, shards):
+    """ Returns the clip at <audiopath> from any of <shards>, or None if none of them contains it. """
+    for reader in shards:
+        if audiopath in reader:
+            return reader.load(audiopath, sampling_rate)
+    return None
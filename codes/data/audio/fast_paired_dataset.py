@@ -5,6 +5,7 @@ import sys
 import time
 from itertools import groupby
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 import torch.utils.data
@@ -12,8 +13,10 @@ import torchaudio
 from tqdm import tqdm
 from transformers import Wav2Vec2CTCTokenizer
 
+from data.audio.audio_shards import open_audio_shards
+from data.audio.line_offset_index import IndexedTextFile
 from data.audio.paired_voice_audio_dataset import CharacterTokenizer
-from data.audio.unsupervised_audio_dataset import load_audio, load_similar_clips
+from data.audio.unsupervised_audio_dataset import load_audio, load_similar_clips, use_similarity_index
 from utils.util import opt_get
 
 
@@ -33,13 +36,9 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
     """
     This dataset is derived from paired_voice_audio, but it only supports loading from TSV files generated from the
     ocotillo transcription engine, which includes alignment codes. To support the vastly larger TSV files, this dataset
-    uses an indexing mechanism which randomly selects offsets within the translation file to seek to. The data returned
-    is relative to these offsets.
-
-    In practice, this means two things:
-    1) Index {i} of this dataset means nothing: fetching from the same index will almost always return different data.
-       As a result, this dataset should not be used for validation or test runs. Use PairedVoiceAudio dataset instead.
-    2) This dataset has a slight bias for items with longer text or longer filenames.
+    builds (once) and persists a uint64 index of the byte offset of every line next to each TSV file. Both the TSV and
+    the index are memory-mapped, so index {i} of this dataset always refers to the same line, every line is equally
+    likely to be sampled and the dataset length is exact.
 
     The upshot is that this dataset loads extremely quickly and consumes almost no system memory.
     """
@@ -47,8 +46,8 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
         self.paths = hparams['path']
         if not isinstance(self.paths, list):
             self.paths = [self.paths]
-        self.paths_size_bytes = [os.path.getsize(p) for p in self.paths]
-        self.total_size_bytes = sum(self.paths_size_bytes)
+        self.files = [IndexedTextFile(p) for p in self.paths]
+        self.files_start_index = np.cumsum([0] + [len(f) for f in self.files])
         self.types = opt_get(hparams, ['types'], [0 for _ in self.paths])
 
         self.load_conditioning = opt_get(hparams, ['load_conditioning'], False)
@@ -73,6 +72,13 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
             self.tokenizer = CharacterTokenizer()
         self.skipped_items = 0  # records how many items are skipped when accessing an index.
 
+        self.audio_shards = opt_get(hparams, ['audio_shards'], None)
+        if self.audio_shards is not None:
+            self.audio_shards = open_audio_shards(self.audio_shards)
+        similarity_index = opt_get(hparams, ['similarity_index'], None)
+        if similarity_index is not None:
+            use_similarity_index(similarity_index)
+
         self.load_times = torch.zeros((256,))
         self.load_ind = 0
 
@@ -80,7 +86,7 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
         # separate filename and text
         audiopath, text = audiopath_and_text[0], audiopath_and_text[1]
         text_seq = self.get_text(text)
-        wav = load_audio(audiopath, self.sample_rate)
+        wav = load_audio(audiopath, self.sample_rate, self.audio_shards)
         return (text_seq, wav, text, audiopath_and_text[0])
 
     def get_text(self, text):
@@ -93,33 +99,13 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
         assert not torch.any(tokens == 0)
         return tokens
 
-    def load_random_line(self, depth=0):
-        assert depth < 10
+    def load_line(self, index):
+        i = int(np.searchsorted(self.files_start_index, index, side='right')) - 1
+        line = self.files[i][int(index - self.files_start_index[i])]
+        return parse_tsv_aligned_codes(line, os.path.dirname(self.paths[i])), self.types[i]
 
-        rand_offset = random.randint(0, self.total_size_bytes)
-        for i in range(len(self.paths)):
-            if rand_offset < self.paths_size_bytes[i]:
-                break
-            else:
-                rand_offset -= self.paths_size_bytes[i]
-        path = self.paths[i]
-        type = self.types[i]
-        with open(path, 'r', encoding='utf-8') as f:
-            f.seek(rand_offset)
-            # Read the rest of the line we seeked to, then the line after that.
-            try:  # This can fail when seeking to a UTF-8 escape byte.
-                f.readline()
-            except:
-                return self.load_random_line(depth=depth + 1), type  # On failure, just recurse and try again.
-            l2 = f.readline()
-
-        if l2:
-            try:
-                base_path = os.path.dirname(path)
-                return parse_tsv_aligned_codes(l2, base_path), type
-            except:
-                print(f"error parsing random offset: {sys.exc_info()}")
-        return self.load_random_line(depth=depth+1), type  # On failure, just recurse and try again.
+    def load_random_line(self):
+        return self.load_line(random.randint(0, len(self)-1))
 
     def get_ctc_metadata(self, codes):
         grouped = groupby(codes.tolist())
@@ -159,18 +145,18 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
     def __getitem__(self, index):
         start = time.time()
         self.skipped_items += 1
-        apt, type = self.load_random_line()
         try:
+            apt, type = self.load_line(index)
             tseq, wav, text, path = self.get_wav_text_pair(apt)
             if text is None or len(text.strip()) == 0:
                 raise ValueError
             cond, cond_is_self = load_similar_clips(apt[0], self.conditioning_length, self.sample_rate,
-                                      n=self.conditioning_candidates) if self.load_conditioning else (None, False)
+                                      n=self.conditioning_candidates, shards=self.audio_shards) if self.load_conditioning else (None, False)
         except:
             if self.skipped_items > 100:
                 raise  # Rethrow if we have nested too far.
             if self.debug_failures:
-                print(f"error loading {apt[0]} {sys.exc_info()}")
+                print(f"error loading line {index} {sys.exc_info()}")
             return self[(index+1) % len(self)]
         raw_codes = apt[2]
         aligned_codes = raw_codes
@@ -223,7 +209,7 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
         return res
 
     def __len__(self):
-        return self.total_size_bytes // 1000  # 1000 cuts down a TSV file to the actual length pretty well.
+        return int(self.files_start_index[-1])
 
 
 class FastPairedVoiceDebugger:
@@ -0,0 +1,87 @@
+import mmap
+import os
+
+import numpy as np
+
+
+def _index_path(path):
+    return f'{path}.line_offsets.npy'
+
+
+def build_line_offsets(path, chunk_bytes=256 << 20):
+    """
+    Builds a uint64 index of the byte offset at which every line of the text file at <path> starts and persists it
+    next to the file. The scan runs over a memory map of the file in fixed-size chunks, so it needs bounded memory even
+    for files with billions of lines: a first pass counts newlines, a second fills a preallocated .npy memmap.
+    """
+    size = os.path.getsize(path)
+    out_path = _index_path(path)
+    # Every DDP rank may build the index at the same time; each writes its own file and atomically renames it into
+    # place, so readers only ever see a complete index.
+    tmp_path = f'{out_path}.{os.getpid()}.tmp.npy'
+    with open(path, 'rb') as f:
+        data = np.memmap(f, dtype=np.uint8, mode='r') if size > 0 else np.zeros((0,), dtype=np.uint8)
+        # A line starts at offset 0 and after every newline, except after a trailing newline at the end of the file.
+        count = 1 if size > 0 else 0
+        for start in range(0, size, chunk_bytes):
+            count += int(np.count_nonzero(data[start:start+chunk_bytes] == ord('\n')))
+        if size > 0 and data[size-1] == ord('\n'):
+            count -= 1
+
+        offsets = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint64, shape=(count,))
+        if count > 0:
+            offsets[0] = 0
+            written = 1
+            for start in range(0, size, chunk_bytes):
+                starts = np.flatnonzero(data[start:start+chunk_bytes] == ord('\n')).astype(np.uint64) + (start + 1)
+                starts = starts[starts < size]
+                offsets[written:written+starts.shape[0]] = starts
+                written += starts.shape[0]
+            assert written == count
+        offsets.flush()
+        del offsets, data
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def load_line_offsets(path):
+    """
+    Returns a read-only memory map of the line-offset index for <path>, (re)building it if it is missing or older
+    than the file it indexes.
+    """
+    index_path = _index_path(path)
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(path):
+        print(f'Building line offset index for {path}..')
+        build_line_offsets(path)
+    return np.load(index_path, mmap_mode='r')
+
+
+class IndexedTextFile:
+    """
+    Random access to the lines of a (potentially huge) text file through its line-offset index. Both the file and the
+    index are memory-mapped lazily, so instances can be created before DataLoader workers are spawned and each worker
+    will open its own maps on first access.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.num_lines = load_line_offsets(path).shape[0]
+        self._offsets = None
+        self._file = None
+        self._map = None
+
+    def __len__(self):
+        return self.num_lines
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_offsets'], state['_file'], state['_map'] = None, None, None
+        return state
+
+    def __getitem__(self, line):
+        if self._map is None:
+            self._offsets = load_line_offsets(self.path)
+            self._file = open(self.path, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        start = int(self._offsets[line])
+        end = int(self._offsets[line+1]) if line + 1 < self.num_lines else len(self._map)
+        return self._map[start:end].decode('utf-8')
@@ -8,7 +8,9 @@ import torch.utils.data
 import torchaudio
 from tqdm import tqdm
 
-from data.audio.unsupervised_audio_dataset import load_audio, load_similar_clips
+from data.audio.audio_shards import open_audio_shards
+from data.audio.unsupervised_audio_dataset import load_audio, load_similar_clips, get_similar_clip_candidates, \
+    get_audio_length, use_similarity_index
 from models.audio.tts.tacotron2 import load_filepaths_and_text, load_filepaths_and_text_type
 from models.audio.tts.tacotron2 import text_to_sequence, sequence_to_text
 from utils.util import opt_get
@@ -171,11 +173,79 @@ class TextWavLoader(torch.utils.data.Dataset):
             self.tokenizer = CharacterTokenizer()
         self.skipped_items = 0  # records how many items are skipped when accessing an index.
 
+        # When batches are bucketed by length, items are padded to the longest item in their batch by the collate
+        # function instead of to max_wav_length/max_text_length here.
+        self.pad_to_max_length = opt_get(hparams, ['pad_to_max_length'], 'length_bucketing' not in hparams.keys())
+        self.length_index_path = opt_get(hparams, ['length_index'], None)
+
+        self.audio_shards = opt_get(hparams, ['audio_shards'], None)
+        if self.audio_shards is not None:
+            self.audio_shards = open_audio_shards(self.audio_shards)
+        similarity_index = opt_get(hparams, ['similarity_index'], None)
+        if similarity_index is not None:
+            use_similarity_index(similarity_index)
+
+        # When a precomputed cache is specified (see scripts/audio/preparation/precompute_gpt_cache.py), MELs, conditioning
+        # MELs and DVAE codes are served directly from the cache instead of loading and decoding audio files.
+        self.precomputed_cache = opt_get(hparams, ['precomputed_cache'], None)
+        if self.precomputed_cache is not None:
+            from data.audio.precomputed_clip_cache import PrecomputedClipCache
+            assert not self.load_aligned_codes  # Aligned codes are not stored in the cache.
+            self.precomputed_cache = PrecomputedClipCache(self.precomputed_cache)
+            self.mel_hop_length = opt_get(hparams, ['mel_hop_length'], 256)
+            self.code_compression = opt_get(hparams, ['code_compression'], 4)
+            self.max_mel_frames = self.max_wav_len // self.mel_hop_length + 1
+            self.max_code_len = self.max_mel_frames // self.code_compression
+            self.conditioning_frames = self.conditioning_length // self.mel_hop_length + 1
+
+    def _length_index_key(self):
+        # Lengths are derived from the file lists, so the persisted index is discarded when any of them changes.
+        return [(p, os.stat(p).st_mtime_ns, os.stat(p).st_size) for p in self.path]
+
+    def get_length_index(self):
+        """
+        Returns a (N, 2) LongTensor holding the audio length in samples and the text length in tokens of every item of
+        this dataset. Lengths are computed once and persisted at `length_index` (keyed by audio path) when specified.
+        """
+        lengths = {}
+        key = self._length_index_key()
+        if self.length_index_path is not None and os.path.exists(self.length_index_path):
+            index = torch.load(self.length_index_path)
+            if isinstance(index, dict) and index.get('key') == key:
+                lengths = index['lengths']
+        missing = [apt for apt in self.audiopaths_and_text if apt[0] not in lengths.keys()]
+        if len(missing) > 0:
+            print(f'Computing lengths of {len(missing)} items..')
+            for apt in tqdm(missing):
+                try:
+                    if self.precomputed_cache is not None and apt[0] in self.precomputed_cache:
+                        wav_length = self.precomputed_cache.get_wav_length(apt[0])
+                    else:
+                        wav_length = get_audio_length(apt[0], self.sample_rate, self.audio_shards)
+                    lengths[apt[0]] = (wav_length, len(self.tokenizer.encode(apt[1])))
+                except:
+                    lengths[apt[0]] = (0, 0)  # Unloadable; __getitem__ will skip past it.
+            if self.length_index_path is not None:
+                # Every DDP rank computes the index; each writes its own file and atomically moves it into place.
+                tmp_path = f'{self.length_index_path}.{os.getpid()}.tmp'
+                torch.save({'key': key, 'lengths': lengths}, tmp_path)
+                os.replace(tmp_path, self.length_index_path)
+        return torch.tensor([lengths[apt[0]] for apt in self.audiopaths_and_text], dtype=torch.long)
+
+    def get_pad_fns(self):
+        """
+        Returns the functions ZeroPadDictCollate should pad items with where zeros differ from the padding this dataset
+        applies when it pads items itself.
+        """
+        if self.precomputed_cache is None:
+            return {}
+        return {'mel': self.precomputed_cache.pad_mel}
+
     def get_wav_text_pair(self, audiopath_and_text):
         # separate filename and text
         audiopath, text, type = audiopath_and_text[0], audiopath_and_text[1], audiopath_and_text[2]
         text_seq = self.get_text(text)
-        wav = load_audio(audiopath, self.sample_rate)
+        wav = load_audio(audiopath, self.sample_rate, self.audio_shards)
         return (text_seq, wav, text, audiopath_and_text[0], type)
 
     def get_text(self, text):
@@ -188,7 +258,73 @@ class TextWavLoader(torch.utils.data.Dataset):
         assert not torch.any(tokens == 0)
         return tokens
 
+    def load_similar_cached_mels(self, path):
+        candidates = [c for c in get_similar_clip_candidates(path) if c in self.precomputed_cache]
+        if len(candidates) == 0:
+            candidates = [path]
+        related_mels = []
+        contains_self = False
+        for k in range(self.conditioning_candidates):
+            rel_path = random.choice(candidates)
+            contains_self = contains_self or (rel_path == path)
+            gap = self.precomputed_cache.get_mel_length(rel_path) - self.conditioning_frames
+            start = random.randint(0, gap) if gap > 0 else 0
+            rel_mel = self.precomputed_cache.load_mel(rel_path, start, self.conditioning_frames)
+            related_mels.append(self.precomputed_cache.pad_mel(rel_mel, self.conditioning_frames))
+        return torch.stack(related_mels, dim=0), contains_self
+
+    def get_precomputed_item(self, index):
+        self.skipped_items += 1
+        path, text, type = self.audiopaths_and_text[index][:3]
+        try:
+            if text is None or len(text.strip()) == 0:
+                raise ValueError
+            tseq = self.get_text(text)
+            wav_length = self.precomputed_cache.get_wav_length(path)
+            if wav_length < (.6 * self.sample_rate):
+                raise ValueError
+            mel = self.precomputed_cache.load_mel(path)
+            codes = self.precomputed_cache.load_codes(path)
+            cond, cond_is_self = self.load_similar_cached_mels(path) if self.load_conditioning else (None, False)
+        except:
+            if self.skipped_items > 100:
+                raise  # Rethrow if we have nested too far.
+            if self.debug_failures:
+                print(f"error loading {path} from precomputed cache {sys.exc_info()}")
+            return self[(index+1) % len(self)]
+
+        actually_skipped_items = self.skipped_items
+        self.skipped_items = 0
+        if wav_length > self.max_wav_len or tseq.shape[0] > self.max_text_len:
+            if self.debug_failures:
+                print(f"error loading {path}: ranges are out of bounds; {wav_length}, {tseq.shape[0]}")
+            rv = random.randint(0,len(self)-1)
+            return self[rv]
+        orig_text_len = tseq.shape[0]
+        if self.pad_to_max_length:
+            if tseq.shape[0] != self.max_text_len:
+                tseq = F.pad(tseq, (0, self.max_text_len - tseq.shape[0]))
+            mel = self.precomputed_cache.pad_mel(mel, self.max_mel_frames)
+            codes = F.pad(codes, (0, self.max_code_len - codes.shape[0]))[:self.max_code_len]
+        res = {
+            'real_text': text,
+            'padded_text': tseq,
+            'text_lengths': torch.tensor(orig_text_len, dtype=torch.long),
+            'mel': mel,
+            'mel_codes': codes,
+            'wav_lengths': torch.tensor(wav_length, dtype=torch.long),
+            'filenames': path,
+            'skipped_items': torch.tensor(actually_skipped_items, dtype=torch.long),
+            'type': type,
+        }
+        if self.load_conditioning:
+            res['conditioning_mel'] = cond
+            res['conditioning_contains_self'] = torch.tensor(cond_is_self)
+        return res
+
     def __getitem__(self, index):
+        if self.precomputed_cache is not None:
+            return self.get_precomputed_item(index)
         self.skipped_items += 1
         try:
             tseq, wav, text, path, type = self.get_wav_text_pair(self.audiopaths_and_text[index])
@@ -198,7 +334,7 @@ class TextWavLoader(torch.utils.data.Dataset):
                 # Ultra short clips are also useless (and can cause problems within some models).
                 raise ValueError
             cond, cond_is_self = load_similar_clips(self.audiopaths_and_text[index][0], self.conditioning_length, self.sample_rate,
-                                      n=self.conditioning_candidates) if self.load_conditioning else (None, False)
+                                      n=self.conditioning_candidates, shards=self.audio_shards) if self.load_conditioning else (None, False)
         except:
             if self.skipped_items > 100:
                 raise  # Rethrow if we have nested too far.
@@ -222,12 +358,12 @@ class TextWavLoader(torch.utils.data.Dataset):
             return self[rv]
         orig_output = wav.shape[-1]
         orig_text_len = tseq.shape[0]
-        if wav.shape[-1] != self.max_wav_len:
+        if self.pad_to_max_length and wav.shape[-1] != self.max_wav_len:
             wav = F.pad(wav, (0, self.max_wav_len - wav.shape[-1]))
             if self.load_aligned_codes:
                 # These codes are aligned to audio inputs, so make sure to pad them as well.
                 aligned_codes = F.pad(aligned_codes, (0, self.max_aligned_codes-aligned_codes.shape[0]))
-        if tseq.shape[0] != self.max_text_len:
+        if self.pad_to_max_length and tseq.shape[0] != self.max_text_len:
             tseq = F.pad(tseq, (0, self.max_text_len - tseq.shape[0]))
         res = {
             'real_text': text,
@@ -236,12 +372,12 @@ class TextWavLoader(torch.utils.data.Dataset):
             'wav': wav,
             'wav_lengths': torch.tensor(orig_output, dtype=torch.long),
             'filenames': path,
-            'skipped_items': actually_skipped_items,
+            'skipped_items': torch.tensor(actually_skipped_items, dtype=torch.long),
             'type': type,
         }
         if self.load_conditioning:
             res['conditioning'] = cond
-            res['conditioning_contains_self'] = cond_is_self
+            res['conditioning_contains_self'] = torch.tensor(cond_is_self)
         if self.load_aligned_codes:
             res['aligned_codes'] = aligned_codes
         return res
@@ -268,9 +404,9 @@ class PairedVoiceDebugger:
             self.self_conditioning_items = opt_get(state, ['self_conditioning_items'], 0)
 
     def update(self, batch):
-        self.total_items += batch['wav'].shape[0]
+        self.total_items += batch['padded_text'].shape[0]
         self.loaded_items += batch['skipped_items'].sum().item()
-        if 'conditioning' in batch.keys():
+        if 'conditioning_contains_self' in batch.keys():
             self.self_conditioning_items += batch['conditioning_contains_self'].sum().item()
 
     def get_debugging_map(self):
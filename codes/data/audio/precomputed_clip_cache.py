@@ -0,0 +1,175 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+
+MANIFEST_NAME = 'manifest.pth'
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """ Returns the sha1 hex digest of the contents of the file at <path>. """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def compute_cache_signature(dvae_checkpoint, mel_norm_file=None, **mel_params):
+    """
+    Computes the key under which a set of precomputed clips is stored. Changing the DVAE checkpoint, the MEL norms or
+    any of the MEL parameters produces a different signature (and therefore a different cache directory).
+    """
+    h = hashlib.sha1()
+    h.update(hash_file(dvae_checkpoint).encode('utf-8'))
+    if mel_norm_file is not None:
+        h.update(hash_file(mel_norm_file).encode('utf-8'))
+    for k in sorted(mel_params.keys()):
+        h.update(f'{k}={mel_params[k]}'.encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def _shard_paths(cache_dir, shard):
+    return os.path.join(cache_dir, f'shard_{shard:05}_mel.npy'), os.path.join(cache_dir, f'shard_{shard:05}_codes.npy')
+
+
+class PrecomputedClipCacheWriter:
+    """
+    Writes MEL spectrograms and DVAE codes for a set of audio clips into a sharded on-disk cache. Each shard is a pair
+    of .npy files: one holding the float16 MELs of every clip in the shard concatenated along the time axis, and one
+    holding the int16 codes, concatenated likewise. A manifest maps audio paths to content hashes and content hashes to
+    their location within the shards.
+
+    Clips whose path, size and mtime are already recorded in an existing manifest with the same signature are skipped,
+    so the precompute stage can be resumed or re-run incrementally over a growing dataset.
+    """
+    def __init__(self, cache_dir, signature, silence_frame, clips_per_shard=4096):
+        self.cache_dir = cache_dir
+        self.clips_per_shard = clips_per_shard
+        os.makedirs(cache_dir, exist_ok=True)
+        manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            self.manifest = torch.load(manifest_path)
+            assert self.manifest['signature'] == signature, f'{cache_dir} holds a cache for a different signature.'
+        else:
+            self.manifest = {'signature': signature, 'silence_frame': silence_frame.cpu().half(), 'num_shards': 0,
+                             'paths': {}, 'clips': {}}
+        self._pending_mels = []
+        self._pending_codes = []
+        self._pending_hashes = []
+
+    def is_cached(self, path):
+        if path not in self.manifest['paths'].keys():
+            return False
+        _, size, mtime = self.manifest['paths'][path]
+        try:
+            return os.path.getsize(path) == size and os.path.getmtime(path) == mtime
+        except OSError:
+            return False  # Listed, but deleted since.
+
+    def contains_hash(self, clip_hash):
+        return clip_hash in self.manifest['clips'].keys() or any(h == clip_hash for h, _ in self._pending_hashes)
+
+    def add_path(self, path, clip_hash):
+        """ Records that <path> has the content <clip_hash>, which must already be (or be pending to be) cached. """
+        self.manifest['paths'][path] = (clip_hash, os.path.getsize(path), os.path.getmtime(path))
+
+    def add(self, path, clip_hash, mel, codes, wav_length):
+        """
+        Adds a clip to the cache.
+        :param mel: (n_mels, frames) MEL spectrogram of the clip.
+        :param codes: (frames//compression,) DVAE codes computed from <mel>.
+        :param wav_length: Length of the source audio in samples.
+        """
+        if not self.contains_hash(clip_hash):
+            self._pending_mels.append(mel.permute(1, 0).cpu().half().numpy())
+            self._pending_codes.append(codes.cpu().short().numpy())
+            self._pending_hashes.append((clip_hash, wav_length))
+            if len(self._pending_hashes) >= self.clips_per_shard:
+                self.flush()
+        self.add_path(path, clip_hash)
+
+    def flush(self):
+        if len(self._pending_hashes) == 0:
+            return
+        shard = self.manifest['num_shards']
+        mel_path, codes_path = _shard_paths(self.cache_dir, shard)
+        mel_offset, code_offset = 0, 0
+        for (clip_hash, wav_length), mel, codes in zip(self._pending_hashes, self._pending_mels, self._pending_codes):
+            self.manifest['clips'][clip_hash] = (shard, mel_offset, mel.shape[0], code_offset, codes.shape[0], wav_length)
+            mel_offset += mel.shape[0]
+            code_offset += codes.shape[0]
+        np.save(mel_path, np.concatenate(self._pending_mels, axis=0))
+        np.save(codes_path, np.concatenate(self._pending_codes, axis=0))
+        self.manifest['num_shards'] = shard + 1
+        self._pending_mels = []
+        self._pending_codes = []
+        self._pending_hashes = []
+        # Persist the manifest after every shard so that an interrupted precompute can be resumed.
+        self.save_manifest()
+
+    def save_manifest(self):
+        manifest_path = os.path.join(self.cache_dir, MANIFEST_NAME)
+        torch.save(self.manifest, manifest_path + '.tmp')
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def close(self):
+        self.flush()
+        self.save_manifest()
+
+
+class PrecomputedClipCache:
+    """
+    Read side of PrecomputedClipCacheWriter. Shards are memory-mapped lazily, so this object can be created before
+    DataLoader workers are forked and each worker will open its own maps on first use.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.manifest = torch.load(os.path.join(cache_dir, MANIFEST_NAME))
+        self.paths = self.manifest['paths']
+        self.clips = self.manifest['clips']
+        self.silence_frame = self.manifest['silence_frame'].float()
+        self._shards = {}
+
+    def __contains__(self, path):
+        return path in self.paths.keys()
+
+    def _get_shard(self, shard):
+        if shard not in self._shards.keys():
+            mel_path, codes_path = _shard_paths(self.cache_dir, shard)
+            self._shards[shard] = (np.load(mel_path, mmap_mode='r'), np.load(codes_path, mmap_mode='r'))
+        return self._shards[shard]
+
+    def _locate(self, path):
+        return self.clips[self.paths[path][0]]
+
+    def get_wav_length(self, path):
+        return self._locate(path)[5]
+
+    def load_mel(self, path, start=0, length=None):
+        """ Returns a (n_mels, frames) float tensor of the cached MEL for <path>, optionally cropped. """
+        shard, mel_offset, mel_len, _, _, _ = self._locate(path)
+        mels, _ = self._get_shard(shard)
+        length = mel_len - start if length is None else min(length, mel_len - start)
+        mel = np.array(mels[mel_offset+start:mel_offset+start+length], dtype=np.float32)
+        return torch.from_numpy(mel).permute(1, 0)
+
+    def load_codes(self, path):
+        shard, _, _, code_offset, code_len, _ = self._locate(path)
+        _, codes = self._get_shard(shard)
+        return torch.from_numpy(np.array(codes[code_offset:code_offset+code_len], dtype=np.int64))
+
+    def get_mel_length(self, path):
+        return self._locate(path)[2]
+
+    def pad_mel(self, mel, frames):
+        """ Pads <mel> on the right to <frames> frames with the MEL of digital silence. """
+        gap = frames - mel.shape[-1]
+        if gap <= 0:
+            return mel[:, :frames]
+        return torch.cat([mel, self.silence_frame.unsqueeze(-1).repeat(1, gap)], dim=-1)
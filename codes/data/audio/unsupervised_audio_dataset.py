@@ -1,3 +1,4 @@
+import functools
 import os
 import random
 import sys
@@ -9,12 +10,19 @@ import torchaudio
 from audio2numpy import open_audio
 from tqdm import tqdm
 
+from data.audio.audio_shards import load_audio_from_shards, open_audio_shards, get_audio_length_from_shards
 from data.util import find_files_of_type, is_audio_file, load_paths_from_cache
 from models.audio.tts.tacotron2.taco_utils import load_wav_to_torch
 from utils.util import opt_get
 
 
-def load_audio(audiopath, sampling_rate):
+def load_audio(audiopath, sampling_rate, shards=None):
+    # Clips packed by scripts/audio/preparation/pack_audio_shards.py are sliced out of memory-mapped <shards> instead.
+    if shards is not None:
+        audio = load_audio_from_shards(audiopath, sampling_rate, shards)
+        if audio is not None:
+            return _check_audio_range(audiopath, audio)
+
     if audiopath[-4:] == '.wav':
         audio, lsr = load_wav_to_torch(audiopath)
     elif audiopath[-4:] == '.mp3':
@@ -37,23 +45,87 @@ def load_audio(audiopath, sampling_rate):
     if lsr != sampling_rate:
         audio = torchaudio.functional.resample(audio, lsr, sampling_rate)
 
+    return _check_audio_range(audiopath, audio).unsqueeze(0)
+
+
+def _check_audio_range(audiopath, audio):
     # Check some assumptions about audio range. This should be automatically fixed in load_wav_to_torch, but might not be in some edge cases, where we should squawk.
     # '10' is arbitrarily chosen since it seems like audio will often "overdrive" the [-1,1] bounds.
     if torch.any(audio > 10) or not torch.any(audio < 0):
         print(f"Error with {audiopath}. Max={audio.max()} min={audio.min()}")
-    audio.clip_(-1, 1)
+    return audio.clip_(-1, 1)
+
+
+def get_audio_length(audiopath, sampling_rate, shards=None):
+    """ Returns the number of samples load_audio() would return for <audiopath>, avoiding a full decode where possible. """
+    if shards is not None:
+        length = get_audio_length_from_shards(audiopath, sampling_rate, shards)
+        if length is not None:
+            return length
+    try:
+        info = torchaudio.info(audiopath)
+        if info.num_frames > 0:
+            return info.num_frames * sampling_rate // info.sample_rate
+    except:
+        pass
+    return load_audio(audiopath, sampling_rate).shape[-1]
+
+
+# Consolidated similarity tables registered through use_similarity_index(), keyed by normalized directory.
+_similarity_index = {}
+
+
+def _mtime_or_none(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
 
-    return audio.unsqueeze(0)
+# Both caches below are keyed by (path, mtime), so a table or directory that changes on disk is simply re-read.
+@functools.lru_cache(maxsize=512)
+def _load_similarities(sim_path, mtime):
+    return torch.load(sim_path)
 
 
-def load_similar_clips(path, sample_length, sample_rate, n=3, fallback_to_self=True):
-    sim_path = os.path.join(os.path.dirname(path), 'similarities.pth')
+@functools.lru_cache(maxsize=512)
+def _list_audio_files(dirname, mtime):
+    return find_files_of_type('img', dirname, qualifier=is_audio_file)[0]
+
+
+def build_similarity_index(roots, output_file):
+    """
+    Consolidates every similarities.pth file found beneath <roots> into a single index at <output_file>, which
+    datasets can load once through the `similarity_index` option instead of reading one table per directory.
+    """
+    if not isinstance(roots, list):
+        roots = [roots]
+    index = {}
+    for root in roots:
+        for dirpath, _, fnames in os.walk(root):
+            if 'similarities.pth' in fnames:
+                index[os.path.normpath(os.path.abspath(dirpath))] = torch.load(os.path.join(dirpath, 'similarities.pth'))
+    torch.save(index, output_file)
+    return index
+
+
+def use_similarity_index(index_file):
+    _similarity_index.update(torch.load(index_file))
+
+
+def get_similar_clip_candidates(path, fallback_to_self=True):
+    dirname = os.path.dirname(path)
+    similarities = _similarity_index.get(os.path.normpath(os.path.abspath(dirname)), None) if _similarity_index else None
+    if similarities is None:
+        sim_path = os.path.join(dirname, 'similarities.pth')
+        mtime = _mtime_or_none(sim_path)
+        if mtime is not None:
+            similarities = _load_similarities(sim_path, mtime)
     candidates = []
-    if os.path.exists(sim_path):
-        similarities = torch.load(sim_path)
+    if similarities is not None:
         fname = os.path.basename(path)
         if fname in similarities.keys():
-            candidates = [os.path.join(os.path.dirname(path), s) for s in similarities[fname]]
+            candidates = [os.path.join(dirname, s) for s in similarities[fname]]
         else:
             print(f'Similarities list found for {path} but {fname} was not in that list.')
         #candidates.append(path)  # Always include self as a possible similar clip.
@@ -61,12 +133,17 @@ def load_similar_clips(path, sample_length, sample_rate, n=3, fallback_to_self=T
         if fallback_to_self:
             candidates = [path]
         else:
-            candidates = find_files_of_type('img', os.path.dirname(path), qualifier=is_audio_file)[0]
+            candidates = _list_audio_files(dirname, _mtime_or_none(dirname))
 
     assert len(candidates) < 50000  # Sanity check to ensure we aren't loading "related files" that aren't actually related.
     if len(candidates) == 0:
         print(f"No conditioning candidates found for {path}")
         raise NotImplementedError()
+    return candidates
+
+
+def load_similar_clips(path, sample_length, sample_rate, n=3, fallback_to_self=True, shards=None):
+    candidates = get_similar_clip_candidates(path, fallback_to_self)
 
     # Sample with replacement. This can get repeats, but more conveniently handles situations where there are not enough candidates.
     related_clips = []
@@ -74,7 +151,7 @@ def load_similar_clips(path, sample_length, sample_rate, n=3, fallback_to_self=T
     for k in range(n):
         rel_path = random.choice(candidates)
         contains_self = contains_self or (rel_path == path)
-        rel_clip = load_audio(rel_path, sample_rate)
+        rel_clip = load_audio(rel_path, sample_rate, shards)
         gap = rel_clip.shape[-1] - sample_length
         if gap < 0:
             rel_clip = F.pad(rel_clip, pad=(0, abs(gap)))
@@ -123,9 +200,16 @@ class UnsupervisedAudioDataset(torch.utils.data.Dataset):
 
         self.debug_loading_failures = opt_get(opt, ['debug_loading_failures'], True)
 
+        self.audio_shards = opt_get(opt, ['audio_shards'], None)
+        if self.audio_shards is not None:
+            self.audio_shards = open_audio_shards(self.audio_shards)
+        similarity_index = opt_get(opt, ['similarity_index'], None)
+        if similarity_index is not None:
+            use_similarity_index(similarity_index)
+
     def get_audio_for_index(self, index):
         audiopath = self.audiopaths[index]
-        audio = load_audio(audiopath, self.sampling_rate)
+        audio = load_audio(audiopath, self.sampling_rate, self.audio_shards)
         assert audio.shape[1] > self.min_length
         if self.dont_clip:
             assert audio.shape[1] <= self.pad_to
@@ -135,7 +219,8 @@ class UnsupervisedAudioDataset(torch.utils.data.Dataset):
         if self.extra_samples <= 0:
             return None, 0
         audiopath = self.audiopaths[index]
-        return load_similar_clips(audiopath, self.extra_sample_len, self.sampling_rate, n=self.extra_samples)
+        return load_similar_clips(audiopath, self.extra_sample_len, self.sampling_rate, n=self.extra_samples,
+                                  shards=self.audio_shards)
 
     def __getitem__(self, index):
         try:
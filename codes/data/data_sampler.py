@@ -63,3 +63,85 @@ class DistIterSampler(Sampler):
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+
+class LengthBucketedBatchSampler(Sampler):
+    """Batch sampler that groups items of similar length and sizes batches dynamically under a padded cost budget.
+
+    Every epoch, the dataset is shuffled and cut into windows of `sort_window` items. Each window is sorted by length
+    and greedily packed into batches such that, for every length dimension d, (max length in batch) * (batch size) does
+    not exceed `max_batch_cost[d]`. The resulting batches are shuffled again so that consecutive steps do not see
+    monotonically changing lengths. Pair with a collate function that pads to the longest item in the batch (e.g.
+    ZeroPadDictCollate).
+
+    Like DistIterSampler, every rank builds the same batch list from a shared seed and takes an exclusive,
+    interleaved subset of it.
+
+    Arguments:
+        lengths: (N, D) LongTensor holding D length measures (e.g. audio samples and text tokens) for every item.
+        max_batch_cost: List of D padded-cost budgets, one per length dimension. None disables a dimension.
+        max_batch_size (optional): Hard cap on the number of items in a batch.
+        max_lengths (optional): List of D maximum lengths. Items exceeding any of them are never sampled.
+        sort_window (optional): Number of items that are sorted together before being packed into batches.
+        num_replicas (optional): Number of processes participating in distributed training.
+        rank (optional): Rank of the current process within num_replicas.
+    """
+
+    def __init__(self, lengths, max_batch_cost, max_batch_size=None, max_lengths=None, sort_window=4096,
+                 num_replicas=1, rank=0, seed=0):
+        self.lengths = lengths
+        self.max_batch_cost = max_batch_cost
+        self.max_batch_size = max_batch_size
+        self.sort_window = sort_window
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        valid = torch.ones(lengths.shape[0], dtype=torch.bool)
+        if max_lengths is not None:
+            for d, max_len in enumerate(max_lengths):
+                if max_len is not None:
+                    valid = valid & (lengths[:, d] <= max_len)
+        self.valid_indices = torch.nonzero(valid).squeeze(-1)
+        self.length_rows = lengths.tolist()  # Python lists are much faster than tensor indexing in the packing loop.
+        self.set_epoch(0)
+
+    def _fits(self, batch_max, batch_size):
+        if self.max_batch_size is not None and batch_size > self.max_batch_size:
+            return False
+        for d, budget in enumerate(self.max_batch_cost):
+            if budget is not None and batch_max[d] * batch_size > budget:
+                return False
+        return True
+
+    def _build_batches(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        indices = self.valid_indices[torch.randperm(self.valid_indices.shape[0], generator=g)]
+        batches = []
+        for w in range(0, indices.shape[0], self.sort_window):
+            window = indices[w:w+self.sort_window]
+            window = window[torch.sort(self.lengths[window, 0], descending=True).indices].tolist()
+            batch, batch_max = [], [0 for _ in self.max_batch_cost]
+            for i in window:
+                item_max = [max(m, l) for m, l in zip(batch_max, self.length_rows[i])]
+                if len(batch) > 0 and not self._fits(item_max, len(batch) + 1):
+                    batches.append(batch)
+                    batch, item_max = [], list(self.length_rows[i])
+                batch.append(i)
+                batch_max = item_max
+            if len(batch) > 0:
+                batches.append(batch)
+        batches = [batches[i] for i in torch.randperm(len(batches), generator=g).tolist()]
+        # Every rank must perform the same number of steps.
+        batches = batches[:len(batches) - len(batches) % self.num_replicas]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.batches = self._build_batches()
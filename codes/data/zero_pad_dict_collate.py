@@ -6,7 +6,13 @@ class ZeroPadDictCollate():
     """
     Given a list of dictionary outputs with torch.Tensors from a Dataset, iterates through each one, finds the longest
     tensor, and zero pads all the other tensors together.
+
+    Tensors under the keys of <pad_fns> are instead padded along their last dimension with pad_fns[key](tensor, length),
+    e.g. to pad MELs with the MEL of silence.
     """
+    def __init__(self, pad_fns=None):
+        self.pad_fns = {} if pad_fns is None else pad_fns
+
     def collate_tensors(self, batch, key):
         result = []
         largest_dims = [0 for _ in range(len(batch[0][key].shape))]
@@ -14,6 +20,8 @@ class ZeroPadDictCollate():
             result.append(elem[key])
             largest_dims = [max(current_largest, new_consideration) for current_largest, new_consideration in zip(largest_dims, elem[key].shape)]
         # Now pad each tensor by the largest dimension.
+        if key in self.pad_fns.keys():
+            return torch.stack([self.pad_fns[key](r, largest_dims[-1]) for r in result], dim=0)
         for i in range(len(result)):
             padding_tuple = ()
             for d in range(len(largest_dims)):
@@ -528,6 +528,7 @@ class AttentionBlock(nn.Module):
         use_new_attention_order=False,
         do_checkpoint=True,
         do_activation=False,
+        attention_backend='einsum',
     ):
         super().__init__()
         self.channels = channels
@@ -545,10 +546,10 @@ class AttentionBlock(nn.Module):
         self.qkv = conv_nd(1, channels, out_channels * 3, 1)
         if use_new_attention_order:
             # split qkv before split heads
-            self.attention = QKVAttention(self.num_heads)
+            self.attention = QKVAttention(self.num_heads, backend=attention_backend)
         else:
             # split heads before split qkv
-            self.attention = QKVAttentionLegacy(self.num_heads)
+            self.attention = QKVAttentionLegacy(self.num_heads, backend=attention_backend)
 
         self.x_proj = nn.Identity() if out_channels == channels else conv_nd(1, channels, out_channels, 1)
         self.proj_out = zero_module(conv_nd(1, out_channels, out_channels, 1))
@@ -587,14 +588,102 @@ class AttentionBlock(nn.Module):
         return (xp + h).reshape(b, xp.shape[1], *spatial)
 
 
+ATTENTION_BACKENDS = ['einsum', 'sdpa', 'chunked', 'auto']
+
+
+def _einsum_attention(q, k, v, mask, qk_bias, scale):
+    weight = torch.einsum(
+        "bct,bcs->bts", q * scale, k * scale
+    )  # More stable with f16 than dividing afterwards
+    weight = weight + qk_bias
+    if mask is not None:
+        weight[mask.logical_not()] = -torch.inf
+    weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+    return torch.einsum("bts,bcs->bct", weight, v)
+
+
+def _chunked_attention(q, k, v, mask, qk_bias, scale, chunk_size):
+    # Computes the same thing as _einsum_attention() for <chunk_size> queries at a time, so that only a
+    # (B*H, chunk_size, T) slice of the weight matrix is ever alive. Masking is applied out-of-place with masked_fill.
+    k = k * scale
+    out = []
+    for start in range(0, q.shape[-1], chunk_size):
+        end = min(start + chunk_size, q.shape[-1])
+        weight = torch.einsum("bct,bcs->bts", q[:, :, start:end] * scale, k)
+        if torch.is_tensor(qk_bias):
+            weight = weight + (qk_bias if qk_bias.shape[-2] == 1 else qk_bias[..., start:end, :])
+        else:
+            weight = weight + qk_bias
+        if mask is not None:
+            weight = weight.masked_fill(mask[:, start:end].logical_not(), -torch.inf)
+        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+        out.append(torch.einsum("bts,bcs->bct", weight, v))
+    return torch.cat(out, dim=-1)
+
+
+def _sdpa_attention(q, k, v, mask, qk_bias):
+    # A scalar bias shifts every logit equally and has no effect on the softmax. A boolean mask is passed to SDPA as is;
+    # only a tensor bias has to be turned into a float mask.
+    attn_mask = mask
+    if torch.is_tensor(qk_bias):
+        attn_mask = qk_bias.to(q.dtype)
+        if mask is not None:
+            attn_mask = attn_mask.masked_fill(mask.logical_not(), -torch.inf)
+    if attn_mask is not None:
+        attn_mask = attn_mask.unsqueeze(1)
+    # The fused (flash and memory-efficient) kernels only accept 4D (batch, heads, T, C) inputs.
+    a = F.scaled_dot_product_attention(q.transpose(1, 2).unsqueeze(1), k.transpose(1, 2).unsqueeze(1),
+                                       v.transpose(1, 2).unsqueeze(1), attn_mask=attn_mask)
+    return a.squeeze(1).transpose(1, 2)
+
+
+def qkv_attention(q, k, v, mask=None, qk_bias=0, backend='einsum', chunk_size=1024):
+    """
+    Computes softmax(q^T k / sqrt(c) + qk_bias) attention over v.
+
+    :param q, k, v: [N x C x T] tensors, where N=batch*heads.
+    :param mask: optional boolean [N x T x T] tensor; False entries are excluded from attention.
+    :param qk_bias: scalar or tensor broadcastable to [N x T x T], added to the attention logits.
+    :param backend: 'einsum' materializes the full weight matrix (the original implementation). 'sdpa' uses
+                    torch's scaled_dot_product_attention, which dispatches to fused kernels. 'chunked' processes
+                    <chunk_size> queries at a time, bounding memory to O(T*chunk_size). 'auto' picks 'sdpa' when
+                    this torch version has it and it can use a fused kernel, and 'chunked' otherwise.
+    :return: an [N x C x T] tensor.
+    """
+    scale = 1 / math.sqrt(math.sqrt(q.shape[1]))
+    if backend == 'auto':
+        # A tensor bias becomes a float mask, which rules out the fused SDPA kernels, as does a mask on long sequences
+        # on many torch versions. SDPA then materializes the full weight matrix, which chunking avoids.
+        unfused = torch.is_tensor(qk_bias) or (mask is not None and q.shape[-1] > chunk_size)
+        backend = 'sdpa' if hasattr(F, 'scaled_dot_product_attention') and not unfused else 'chunked'
+    if backend == 'einsum':
+        return _einsum_attention(q, k, v, mask, qk_bias, scale)
+    elif backend == 'chunked':
+        return _chunked_attention(q, k, v, mask, qk_bias, scale, chunk_size)
+    elif backend == 'sdpa':
+        return _sdpa_attention(q, k, v, mask, qk_bias)
+    raise NotImplementedError(f'Unknown attention backend {backend}. Choose from {ATTENTION_BACKENDS}.')
+
+
+def set_attention_backend(module, backend, chunk_size=1024):
+    """ Switches every QKVAttention/QKVAttentionLegacy within <module> to the given attention backend. """
+    assert backend in ATTENTION_BACKENDS, f'Unknown attention backend {backend}. Choose from {ATTENTION_BACKENDS}.'
+    for m in module.modules():
+        if isinstance(m, (QKVAttention, QKVAttentionLegacy)):
+            m.backend = backend
+            m.chunk_size = chunk_size
+
+
 class QKVAttentionLegacy(nn.Module):
     """
     A module which performs QKV attention. Matches legacy QKVAttention + input/ouput heads shaping
     """
 
-    def __init__(self, n_heads):
+    def __init__(self, n_heads, backend='einsum', chunk_size=1024):
         super().__init__()
         self.n_heads = n_heads
+        self.backend = backend
+        self.chunk_size = chunk_size
 
     def forward(self, qkv, mask=None, qk_bias=0):
         """
@@ -607,17 +696,9 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = torch.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = weight + qk_bias
         if mask is not None:
             mask = mask.repeat(self.n_heads, 1, 1)
-            weight[mask.logical_not()] = -torch.inf
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = torch.einsum("bts,bcs->bct", weight, v)
-
+        a = qkv_attention(q, k, v, mask, qk_bias, self.backend, self.chunk_size)
         return a.reshape(bs, -1, length)
 
 
@@ -626,9 +707,11 @@ class QKVAttention(nn.Module):
     A module which performs QKV attention and splits in a different order.
     """
 
-    def __init__(self, n_heads):
+    def __init__(self, n_heads, backend='einsum', chunk_size=1024):
         super().__init__()
         self.n_heads = n_heads
+        self.backend = backend
+        self.chunk_size = chunk_size
 
     def forward(self, qkv, mask=None, qk_bias=0):
         """
@@ -641,17 +724,12 @@ class QKVAttention(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.chunk(3, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = torch.einsum(
-            "bct,bcs->bts",
-            (q * scale).view(bs * self.n_heads, ch, length),
-            (k * scale).view(bs * self.n_heads, ch, length),
-        )  # More stable with f16 than dividing afterwards
         if mask is not None:
             mask = mask.repeat(self.n_heads, 1, 1)
-            weight[mask.logical_not()] = -torch.inf
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = torch.einsum("bts,bcs->bct", weight, v.reshape(bs * self.n_heads, ch, length))
+        # Unlike QKVAttentionLegacy, this module has always ignored qk_bias. Models were trained that way, so it still
+        # does.
+        a = qkv_attention(q.reshape(bs * self.n_heads, ch, length), k.reshape(bs * self.n_heads, ch, length),
+                          v.reshape(bs * self.n_heads, ch, length), mask, 0, self.backend, self.chunk_size)
         return a.reshape(bs, -1, length)
 
 
@@ -1110,3 +1188,24 @@ def gather_2d(input, index):
     if b == 1:
         result = result.unsqueeze(0)
     return result
+
+
+if __name__ == '__main__':
+    # Every attention backend must match the original einsum implementation, with and without masks and biases.
+    heads, ch, length = 4, 16, 50
+    qkv = torch.randn(2, 3 * heads * ch, length)
+    mask = torch.rand(2, length, length) > .3
+    mask[:, :, 0] = True  # Fully masked rows are NaN for every backend.
+    qk_bias = torch.randn(2 * heads, length, length)
+    for attention_type in [QKVAttention, QKVAttentionLegacy]:
+        attention = attention_type(heads)
+        for m, b in [(None, 0), (mask, 0), (None, qk_bias), (mask, qk_bias)]:
+            expected = attention(qkv, m, b)
+            for backend in ['sdpa', 'chunked']:
+                if backend == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+                    continue
+                set_attention_backend(attention, backend, chunk_size=16)
+                err = (attention(qkv, m, b) - expected).abs().max().item()
+                print(f'{attention_type.__name__} {backend} mask={m is not None} bias={torch.is_tensor(b)}: {err}')
+                assert err < 1e-4
+            set_attention_backend(attention, 'einsum')
@@ -141,10 +141,29 @@ class Wav2VecWrapper(nn.Module):
         pred = logits.argmax(dim=-1)
         return [self.decode_ctc(p) for p in pred]
 
-    def inference_logits(self, audio):
-        audio_norm = (audio - audio.mean()) / torch.sqrt(audio.var() + 1e-7)
-        logits = self.w2v(input_values=audio_norm.squeeze(1)).logits
-        return logits
+    def inference_logits(self, audio, wav_lengths=None):
+        """
+        Returns CTC logits for <audio>. If <wav_lengths> is given, <audio> is a zero-padded batch: every clip is
+        normalized over its own samples, exactly as it would be on its own, and padding is masked out where the model
+        supports an attention mask. Logits past inference_output_lengths(wav_lengths) should be ignored.
+        """
+        if wav_lengths is None:
+            audio_norm = (audio - audio.mean()) / torch.sqrt(audio.var() + 1e-7)
+            return self.w2v(input_values=audio_norm.squeeze(1)).logits
+
+        audio = audio.squeeze(1)
+        mask = torch.arange(audio.shape[-1], device=audio.device).unsqueeze(0) < wav_lengths.unsqueeze(1)
+        n = wav_lengths.unsqueeze(1).to(audio.dtype)
+        mean = (audio * mask).sum(dim=-1, keepdim=True) / n
+        var = (((audio - mean) * mask) ** 2).sum(dim=-1, keepdim=True) / (n - 1)
+        audio_norm = ((audio - mean) / torch.sqrt(var + 1e-7)) * mask
+        # Models whose feature extractor uses group norm were trained without attention masks and expect plain zero
+        # padding instead.
+        attention_mask = mask.long() if self.w2v.config.feat_extract_norm == 'layer' else None
+        return self.w2v(input_values=audio_norm, attention_mask=attention_mask).logits
+
+    def inference_output_lengths(self, wav_lengths):
+        return self.w2v._get_feat_extract_output_lengths(wav_lengths)
 
     def update_for_step(self, step, *args):
         if self.ramp_dropout_mode and step % 10 == 0:
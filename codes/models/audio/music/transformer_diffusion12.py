@@ -208,10 +208,21 @@ class TransformerDiffusion(nn.Module):
             code_emb = F.interpolate(code_emb.permute(0,2,1), size=expected_seq_len, mode='nearest').permute(0,2,1)
         return code_emb
 
+    def timestep_independent_kwargs(self, model_kwargs, expected_seq_len):
+        """ Replaces the conditioning inputs in <model_kwargs> with the output of timestep_independent(). """
+        if model_kwargs.get('codes', None) is None:
+            return model_kwargs
+        kwargs = {k: v for k, v in model_kwargs.items() if k not in ['codes', 'conditioning_input']}
+        codes = model_kwargs['codes']
+        if self.permute_codes:
+            codes = codes.permute(0,2,1)
+        kwargs['precomputed_code_embeddings'] = self.timestep_independent(codes, expected_seq_len)
+        return kwargs
+
     def forward(self, x, timesteps, codes=None, conditioning_input=None, precomputed_code_embeddings=None, conditioning_free=False):
         if precomputed_code_embeddings is not None:
             assert codes is None and conditioning_input is None, "Do not provide precomputed embeddings and the other parameters. It is unclear what you want me to do here."
-        if self.permute_codes:
+        if self.permute_codes and codes is not None:
             codes = codes.permute(0,2,1)
 
         unused_params = []
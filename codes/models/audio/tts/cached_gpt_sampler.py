@@ -0,0 +1,188 @@
+"""
+A native autoregressive decoding loop for the HuggingFace GPT2Model stacks used by the unified_voice models.
+
+Instead of going through GPT2InferenceModel and HF generate(), the transformer blocks are driven directly against a
+single key/value cache that is preallocated for the full generation length. The conditioning+text prefix is encoded
+once per input and its cache entries are shared by every candidate sampled from that input. Token selection
+(repetition penalty, temperature, top-k, top-p) runs entirely on the model's device.
+
+SlottedKVCacheGPT2Decoder extends this to continuous batching, where independent sequences enter and leave a shared
+cache while it is being decoded (see scripts/audio/gen/tts_server.py).
+"""
+import torch
+import torch.nn.functional as F
+
+
+class KVCacheGPT2Decoder:
+    """
+    Runs the blocks of a HF GPT2Model over consecutive chunks of input embeddings, storing keys and values for every
+    processed position in a preallocated (layers, 2, batch, heads, max_len, head_dim) buffer.
+    """
+    def __init__(self, gpt, batch_size, max_len, device, dtype):
+        self.gpt = gpt
+        attn = gpt.h[0].attn
+        self.heads = attn.num_heads
+        self.head_dim = attn.head_dim
+        self.split_size = attn.split_size
+        self.max_len = max_len
+        self.cache = torch.zeros((len(gpt.h), 2, batch_size, self.heads, max_len, self.head_dim), device=device, dtype=dtype)
+        self.length = 0
+
+    def load_prefix(self, other, repeats):
+        """ Copies the cache of <other> into this cache, repeating every batch element <repeats> times. """
+        self.cache[:, :, :, :, :other.length] = other.cache[:, :, :, :, :other.length].repeat_interleave(repeats, dim=2)
+        self.length = other.length
+
+    def forward(self, emb):
+        """
+        Processes (b,t,d) input embeddings at the next t positions and returns the final hidden states (after ln_f)
+        for those positions.
+        """
+        b, t, _ = emb.shape
+        start, end = self.length, self.length + t
+        assert end <= self.max_len
+        causal_mask = torch.ones((t, end), dtype=torch.bool, device=emb.device).tril(diagonal=start)
+        h = emb
+        for l, block in enumerate(self.gpt.h):
+            attn = block.attn
+            q, k, v = attn.c_attn(block.ln_1(h)).split(self.split_size, dim=2)
+            q, k, v = [x.view(b, t, self.heads, self.head_dim).transpose(1, 2) for x in (q, k, v)]
+            self.cache[l, 0, :, :, start:end] = k
+            self.cache[l, 1, :, :, start:end] = v
+            keys, values = self.cache[l, 0, :, :, :end], self.cache[l, 1, :, :, :end]
+            w = torch.matmul(q, keys.transpose(-1, -2))
+            if attn.scale_attn_weights:
+                w = w / (self.head_dim ** .5)
+            if getattr(attn, 'scale_attn_by_inverse_layer_idx', False):
+                w = w / float(l + 1)
+            w = w.masked_fill(~causal_mask, torch.finfo(w.dtype).min).softmax(dim=-1)
+            a = torch.matmul(w, values).transpose(1, 2).reshape(b, t, self.heads * self.head_dim)
+            h = h + attn.c_proj(a)
+            h = h + block.mlp(block.ln_2(h))
+        self.length = end
+        return self.gpt.ln_f(h)
+
+
+class SlottedKVCacheGPT2Decoder:
+    """
+    Key/value cache for continuous batching: every row ("slot") of the cache holds an independent sequence with its
+    own length. Sequences are inserted into free slots and released when they finish, while all other slots keep
+    decoding, so the batch never has to drain before new work is admitted.
+    """
+    def __init__(self, gpt, num_slots, max_len, device, dtype):
+        self.gpt = gpt
+        attn = gpt.h[0].attn
+        self.heads = attn.num_heads
+        self.head_dim = attn.head_dim
+        self.split_size = attn.split_size
+        self.num_slots = num_slots
+        self.max_len = max_len
+        self.cache = torch.zeros((len(gpt.h), 2, num_slots, self.heads, max_len, self.head_dim), device=device, dtype=dtype)
+        self.lengths = torch.zeros((num_slots,), dtype=torch.long, device=device)
+        self.free_slots = list(range(num_slots))
+
+    def insert(self, prefix, index=0, repeats=1):
+        """
+        Copies the cache of batch element <index> of the KVCacheGPT2Decoder <prefix> into <repeats> free slots and
+        returns the slot numbers.
+        """
+        assert len(self.free_slots) >= repeats and prefix.length <= self.max_len
+        slots, self.free_slots = self.free_slots[:repeats], self.free_slots[repeats:]
+        for slot in slots:
+            self.cache[:, :, slot, :, :prefix.length] = prefix.cache[:, :, index, :, :prefix.length]
+            self.lengths[slot] = prefix.length
+        return slots
+
+    def release(self, slots):
+        self.free_slots.extend(slots)
+
+    def forward(self, emb, slots):
+        """
+        Processes one (n,1,d) input embedding for each of the n <slots> at the next position of that slot and returns
+        the final hidden states (after ln_f).
+        """
+        n = emb.shape[0]
+        slots = torch.tensor(slots, dtype=torch.long, device=emb.device)
+        positions = self.lengths[slots]
+        assert int(positions.max()) < self.max_len
+        end = int(positions.max()) + 1
+        # Each slot only attends to its own history. Positions past a slot's length hold stale entries from earlier
+        # occupants and are masked out.
+        mask = (torch.arange(end, device=emb.device).unsqueeze(0) <= positions.unsqueeze(1)).view(n, 1, 1, end)
+        h = emb
+        for l, block in enumerate(self.gpt.h):
+            attn = block.attn
+            q, k, v = attn.c_attn(block.ln_1(h)).split(self.split_size, dim=2)
+            q, k, v = [x.view(n, 1, self.heads, self.head_dim).transpose(1, 2) for x in (q, k, v)]
+            layer_keys, layer_values = self.cache[l, 0], self.cache[l, 1]
+            layer_keys[slots, :, positions] = k[:, :, 0]
+            layer_values[slots, :, positions] = v[:, :, 0]
+            keys = layer_keys[:, :, :end].index_select(0, slots)
+            values = layer_values[:, :, :end].index_select(0, slots)
+            w = torch.matmul(q, keys.transpose(-1, -2))
+            if attn.scale_attn_weights:
+                w = w / (self.head_dim ** .5)
+            if getattr(attn, 'scale_attn_by_inverse_layer_idx', False):
+                w = w / float(l + 1)
+            w = w.masked_fill(~mask, torch.finfo(w.dtype).min).softmax(dim=-1)
+            a = torch.matmul(w, values).transpose(1, 2).reshape(n, 1, self.heads * self.head_dim)
+            h = h + attn.c_proj(a)
+            h = h + block.mlp(block.ln_2(h))
+        self.lengths[slots] = positions + 1
+        return self.gpt.ln_f(h)
+
+
+def process_logits(logits, seen_tokens=None, temperature=1.0, top_k=0, top_p=1.0, repetition_penalty=1.0):
+    """
+    Applies the same logit processors HF generate() applies for the given settings, in the same order, without
+    leaving the device.
+    """
+    if repetition_penalty != 1.0 and seen_tokens is not None:
+        logits = torch.where(seen_tokens, torch.where(logits < 0, logits * repetition_penalty, logits / repetition_penalty), logits)
+    if temperature != 1.0:
+        logits = logits / temperature
+    if top_k > 0:
+        kth = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth, -float('inf'))
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=False, dim=-1)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        sorted_to_remove = cumulative_probs <= (1 - top_p)
+        sorted_to_remove[:, -1] = False  # Always keep the most likely token.
+        to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+        logits = logits.masked_fill(to_remove, -float('inf'))
+    return logits
+
+
+def trim_finished(sequences, stop_token):
+    """ Trims trailing columns in which every sequence has already emitted <stop_token>, as HF generate() does. """
+    is_stop = sequences == stop_token
+    first_stop = torch.where(is_stop.any(dim=1), is_stop.float().argmax(dim=1), torch.full_like(is_stop[:, 0], sequences.shape[1], dtype=torch.long))
+    return sequences[:, :min(int(first_stop.max()) + 1, sequences.shape[1])]
+
+
+if __name__ == '__main__':
+    # Benchmarks tokens/sec of UnifiedVoice.inference_speech_native() against the HF generate() path on CPU.
+    from time import time
+    from models.audio.tts.unified_voice2 import UnifiedVoice
+
+    torch.manual_seed(0)
+    gpt = UnifiedVoice(layers=8, model_dim=512, heads=8, max_text_tokens=120, max_mel_tokens=250, max_conditioning_inputs=1,
+                       checkpointing=False, average_conditioning_embeddings=True).eval()
+    cond = torch.randn(1, 80, 200)
+    text = torch.randint(low=2, high=255, size=(1, 60))
+
+    with torch.no_grad():
+        # Greedy decoding must produce identical codes.
+        hf = gpt.inference_speech(cond, text, do_sample=False)
+        native = gpt.inference_speech_native(cond, text, do_sample=False)
+        print(f'Greedy parity: {hf.shape == native.shape and torch.equal(hf, native)}')
+
+        for name, fn in [('hf generate()', lambda: gpt.inference_speech(cond, text, do_sample=True, top_p=.8, temperature=.8,
+                                                                        num_return_sequences=4, repetition_penalty=2.0)),
+                         ('native', lambda: gpt.inference_speech_native(cond, text, do_sample=True, top_p=.8, temperature=.8,
+                                                                        num_return_sequences=4, repetition_penalty=2.0))]:
+            start = time()
+            codes = fn()
+            elapsed = time() - start
+            print(f'{name}: {codes.numel() / elapsed:.1f} tokens/sec ({codes.shape[0]}x{codes.shape[1]} in {elapsed:.2f}s)')
@@ -192,6 +192,15 @@ class TransformerDiffusionTTS(nn.Module):
 
         return expanded_code_emb, cond_emb
 
+    def timestep_independent_kwargs(self, model_kwargs, expected_seq_len):
+        """ Replaces the conditioning inputs in <model_kwargs> with the output of timestep_independent(). """
+        if model_kwargs.get('codes', None) is None or model_kwargs.get('conditioning_input', None) is None:
+            return model_kwargs
+        kwargs = {k: v for k, v in model_kwargs.items() if k not in ['codes', 'conditioning_input', 'prenet_latent']}
+        kwargs['precomputed_code_embeddings'], kwargs['precomputed_cond_embeddings'] = \
+            self.timestep_independent(model_kwargs['codes'], model_kwargs['conditioning_input'], expected_seq_len,
+                                      model_kwargs.get('prenet_latent', None))
+        return kwargs
 
     def forward(self, x, timesteps, codes=None, conditioning_input=None, clvp_input=None, type=None, prenet_latent=None, precomputed_code_embeddings=None,
                 precomputed_cond_embeddings=None, conditioning_free=False):
@@ -131,6 +131,8 @@ class DiffusionTts(nn.Module):
     :param use_new_attention_order: use a different attention pattern for potentially
                                     increased efficiency.
     """
+    # Accepts a per-element conditioning_free mask; see GaussianDiffusion.p_mean_variance().
+    supports_batched_conditioning_free = True
 
     def __init__(
             self,
@@ -402,24 +404,63 @@ class DiffusionTts(nn.Module):
         }
         return groups
 
-    def fix_alignment(self, x, aligned_conditioning):
+    def fix_alignment(self, x, aligned_conditioning=None):
         """
         The UNet requires that the input <x> is a certain multiple of 2, defined by the UNet depth. Enforce this by
         padding both <x> and <aligned_conditioning> before forward propagation and removing the padding before returning.
         """
         cm = ceil_multiple(x.shape[-1], self.alignment_size)
         if cm != 0:
-            pc = (cm-x.shape[-1])/x.shape[-1]
+            if aligned_conditioning is not None:
+                aligned_conditioning = self.pad_aligned_conditioning(aligned_conditioning, x.shape[-1])
             x = F.pad(x, (0,cm-x.shape[-1]))
-            # Also fix aligned_latent, which is aligned to x.
-            if is_latent(aligned_conditioning):
-                aligned_conditioning = torch.cat([aligned_conditioning,
-                                                  self.aligned_latent_padding_embedding.repeat(x.shape[0], 1, int(pc * aligned_conditioning.shape[-1]))], dim=-1)
-            else:
-                aligned_conditioning = F.pad(aligned_conditioning, (0,int(pc*aligned_conditioning.shape[-1])))
         return x, aligned_conditioning
 
-    def forward(self, x, timesteps, aligned_conditioning, conditioning_input, lr_input=None, conditioning_free=False):
+    def pad_aligned_conditioning(self, aligned_conditioning, seq_len):
+        """ Pads <aligned_conditioning> (in BxCxS format) the same way fix_alignment() pads an <x> of length <seq_len>. """
+        cm = ceil_multiple(seq_len, self.alignment_size)
+        if cm == 0:
+            return aligned_conditioning
+        pc = (cm-seq_len)/seq_len
+        # Also fix aligned_latent, which is aligned to x.
+        if is_latent(aligned_conditioning):
+            return torch.cat([aligned_conditioning,
+                              self.aligned_latent_padding_embedding.repeat(aligned_conditioning.shape[0], 1, int(pc * aligned_conditioning.shape[-1]))], dim=-1)
+        else:
+            return F.pad(aligned_conditioning, (0,int(pc*aligned_conditioning.shape[-1])))
+
+    def timestep_independent(self, aligned_conditioning, conditioning_input, expected_seq_len):
+        """
+        Computes the code embedding for an output of length <expected_seq_len>. This does not depend on the timestep, so
+        during inference it only needs to be computed once per sample and can then be fed to forward() through
+        <precomputed_code_embeddings>.
+        """
+        # Shuffle aligned_latent to BxCxS format
+        if is_latent(aligned_conditioning):
+            aligned_conditioning = aligned_conditioning.permute(0, 2, 1)
+        aligned_conditioning = self.pad_aligned_conditioning(aligned_conditioning, expected_seq_len)
+        with autocast(aligned_conditioning.device.type, enabled=self.enable_fp16):
+            cond_emb = self.contextual_embedder(conditioning_input)
+            if len(cond_emb.shape) == 3:  # Just take the first element.
+                cond_emb = cond_emb[:, :, 0]
+            if is_latent(aligned_conditioning):
+                code_emb = self.latent_converter(aligned_conditioning)
+            else:
+                code_emb = self.code_converter(aligned_conditioning)
+            cond_emb = cond_emb.unsqueeze(-1).repeat(1, 1, code_emb.shape[-1])
+            return self.conditioning_conv(torch.cat([cond_emb, code_emb], dim=1))
+
+    def timestep_independent_kwargs(self, model_kwargs, expected_seq_len):
+        """ Replaces the conditioning inputs in <model_kwargs> with the output of timestep_independent(). """
+        if model_kwargs.get('aligned_conditioning', None) is None or model_kwargs.get('conditioning_input', None) is None:
+            return model_kwargs
+        kwargs = {k: v for k, v in model_kwargs.items() if k not in ['aligned_conditioning', 'conditioning_input']}
+        kwargs['precomputed_code_embeddings'] = self.timestep_independent(model_kwargs['aligned_conditioning'],
+                                                                          model_kwargs['conditioning_input'], expected_seq_len)
+        return kwargs
+
+    def forward(self, x, timesteps, aligned_conditioning=None, conditioning_input=None, lr_input=None, conditioning_free=False,
+                precomputed_code_embeddings=None):
         """
         Apply the model to an input batch.
 
@@ -429,9 +470,15 @@ class DiffusionTts(nn.Module):
         :param conditioning_input: a full-resolution audio clip that is used as a reference to the style you want decoded.
         :param lr_input: for super-sampling models, a guidance audio clip at a lower sampling rate.
         :param conditioning_free: When set, all conditioning inputs (including tokens and conditioning_input) will not be considered.
+                                  May also be a [N] bool Tensor, in which case this only applies to the selected batch elements.
+        :param precomputed_code_embeddings: Embeddings returned from self.timestep_independent(), used in place of
+                                            <aligned_conditioning> and <conditioning_input>.
         :return: an [N x C x ...] Tensor of outputs.
         """
-        assert conditioning_input is not None
+        if precomputed_code_embeddings is not None:
+            assert aligned_conditioning is None and conditioning_input is None, "Do not provide precomputed embeddings and the other parameters. It is unclear what you want me to do here."
+        else:
+            assert conditioning_input is not None
         if self.super_sampling_enabled:
             assert lr_input is not None
             if self.training and self.super_sampling_max_noising_factor > 0:
@@ -440,32 +487,28 @@ class DiffusionTts(nn.Module):
             lr_input = F.interpolate(lr_input, size=(x.shape[-1],), mode='nearest')
             x = torch.cat([x, lr_input], dim=1)
 
-        # Shuffle aligned_latent to BxCxS format
-        if is_latent(aligned_conditioning):
-            aligned_conditioning = aligned_conditioning.permute(0, 2, 1)
-
         # Fix input size to the proper multiple of 2 so we don't get alignment errors going down and back up the U-net.
+        # aligned_conditioning is padded to match by timestep_independent().
         orig_x_shape = x.shape[-1]
-        x, aligned_conditioning = self.fix_alignment(x, aligned_conditioning)
+        x, _ = self.fix_alignment(x)
 
         with autocast(x.device.type, enabled=self.enable_fp16):
 
             hs = []
             time_emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
 
-            # Note: this block does not need to repeated on inference, since it is not timestep-dependent.
-            if conditioning_free:
+            # Note: this block does not need to repeated on inference, since it is not timestep-dependent. See timestep_independent().
+            batched_conditioning_free = torch.is_tensor(conditioning_free)
+            if not batched_conditioning_free and conditioning_free:
                 code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, 1)
             else:
-                cond_emb = self.contextual_embedder(conditioning_input)
-                if len(cond_emb.shape) == 3:  # Just take the first element.
-                    cond_emb = cond_emb[:, :, 0]
-                if is_latent(aligned_conditioning):
-                    code_emb = self.latent_converter(aligned_conditioning)
+                if precomputed_code_embeddings is not None:
+                    code_emb = precomputed_code_embeddings
                 else:
-                    code_emb = self.code_converter(aligned_conditioning)
-                cond_emb = cond_emb.unsqueeze(-1).repeat(1, 1, code_emb.shape[-1])
-                code_emb = self.conditioning_conv(torch.cat([cond_emb, code_emb], dim=1))
+                    code_emb = self.timestep_independent(aligned_conditioning, conditioning_input, orig_x_shape)
+                if batched_conditioning_free:
+                    code_emb = torch.where(conditioning_free.view(-1, 1, 1), self.unconditioned_embedding.repeat(x.shape[0], 1, 1),
+                                           code_emb)
             # Mask out the conditioning branch for whole batch elements, implementing something similar to classifier-free guidance.
             if self.training and self.unconditioned_percentage > 0:
                 unconditioned_batches = torch.rand((code_emb.shape[0], 1, 1),
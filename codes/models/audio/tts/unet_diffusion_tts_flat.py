@@ -156,6 +156,9 @@ class DiffusionLayer(TimestepBlock):
 
 
 class DiffusionTtsFlat(nn.Module):
+    # Accepts a per-element conditioning_free mask; see GaussianDiffusion.p_mean_variance().
+    supports_batched_conditioning_free = True
+
     def __init__(
             self,
             model_channels=512,
@@ -291,6 +294,15 @@ class DiffusionTtsFlat(nn.Module):
             mel_pred = mel_pred * unconditioned_batches.logical_not()
             return expanded_code_emb, mel_pred
 
+    def timestep_independent_kwargs(self, model_kwargs, expected_seq_len):
+        """ Replaces the conditioning inputs in <model_kwargs> with the output of timestep_independent(). """
+        if model_kwargs.get('aligned_conditioning', None) is None or model_kwargs.get('conditioning_input', None) is None \
+                or model_kwargs.get('return_code_pred', False):
+            return model_kwargs
+        kwargs = {k: v for k, v in model_kwargs.items() if k not in ['aligned_conditioning', 'conditioning_input']}
+        kwargs['precomputed_aligned_embeddings'] = self.timestep_independent(model_kwargs['aligned_conditioning'],
+                                                                             model_kwargs['conditioning_input'], expected_seq_len, False)
+        return kwargs
 
     def forward(self, x, timesteps, aligned_conditioning=None, conditioning_input=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False):
         """
@@ -302,13 +314,15 @@ class DiffusionTtsFlat(nn.Module):
         :param conditioning_input: a full-resolution audio clip that is used as a reference to the style you want decoded.
         :param precomputed_aligned_embeddings: Embeddings returned from self.timestep_independent()
         :param conditioning_free: When set, all conditioning inputs (including tokens and conditioning_input) will not be considered.
+                                  May also be a [N] bool Tensor, in which case this only applies to the selected batch elements.
         :return: an [N x C x ...] Tensor of outputs.
         """
         assert precomputed_aligned_embeddings is not None or (aligned_conditioning is not None and conditioning_input is not None)
         assert not (return_code_pred and precomputed_aligned_embeddings is not None)  # These two are mutually exclusive.
 
         unused_params = list(self.mel_head.parameters())
-        if conditioning_free:
+        batched_conditioning_free = torch.is_tensor(conditioning_free)
+        if not batched_conditioning_free and conditioning_free:
             code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, x.shape[-1])
             unused_params.extend(list(self.code_converter.parameters()) + list(self.code_embedding.parameters()))
             unused_params.extend(list(self.latent_conditioner.parameters()))
@@ -322,7 +336,11 @@ class DiffusionTtsFlat(nn.Module):
                 else:
                     unused_params.extend(list(self.latent_conditioner.parameters()))
 
-            unused_params.append(self.unconditioned_embedding)
+            if batched_conditioning_free:
+                code_emb = torch.where(conditioning_free.view(-1, 1, 1), self.unconditioned_embedding.repeat(x.shape[0], 1, x.shape[-1]),
+                                       code_emb)
+            else:
+                unused_params.append(self.unconditioned_embedding)
 
         time_emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
         code_emb = self.conditioning_timestep_integrator(code_emb, time_emb)
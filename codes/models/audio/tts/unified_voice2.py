@@ -373,7 +373,7 @@ class UnifiedVoice(nn.Module):
             return first_logits
 
     def forward(self, speech_conditioning_input, text_inputs, text_lengths, mel_codes, wav_lengths, text_first=True, raw_mels=None, return_attentions=False,
-                return_latent=False):
+                return_latent=False, conditioning_latents=None):
         """
         Forward pass that uses both text and voice in either text conditioning mode or voice conditioning mode
         (actuated by `text_first`).
@@ -384,6 +384,7 @@ class UnifiedVoice(nn.Module):
         mel_inputs:  long tensor, (b,m)
         wav_lengths: long tensor, (b,)
         raw_mels: MEL float tensor (b,80,s)
+        conditioning_latents: optional output of get_conditioning_latents(), used in place of speech_conditioning_input
 
         If return_attentions is specified, only logits are returned.
         If return_latent is specified, loss & logits are not computed or returned. Only the predicted latents are returned.
@@ -401,13 +402,10 @@ class UnifiedVoice(nn.Module):
             raw_mels = raw_mels[:, :, :max_mel_len*4]
         mel_codes = self.set_mel_padding(mel_codes, wav_lengths)
 
-        speech_conditioning_input = speech_conditioning_input.unsqueeze(1) if len(speech_conditioning_input.shape) == 3 else speech_conditioning_input
-        conds = []
-        for j in range(speech_conditioning_input.shape[1]):
-            conds.append(self.conditioning_encoder(speech_conditioning_input[:, j]))
-        conds = torch.stack(conds, dim=1)
-        if self.average_conditioning_embeddings:
-            conds = conds.mean(dim=1).unsqueeze(1)
+        if conditioning_latents is not None:
+            conds = conditioning_latents.expand(text_inputs.shape[0], -1, -1)
+        else:
+            conds = self.get_conditioning_latents(speech_conditioning_input)
 
         text_inputs, text_targets = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
         text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
@@ -538,6 +536,175 @@ class UnifiedVoice(nn.Module):
             return gen.sequences[:, fake_inputs.shape[1]:]
 
 
+    def get_conditioning_latents(self, speech_conditioning_input):
+        """
+        Runs the conditioning encoder over (b,80,s) or (b,n,80,s) conditioning MELs and returns the (b,c,d) latents that
+        inference prepends to the text. These only depend on the voice, so callers can compute them once per voice.
+        """
+        speech_conditioning_input = speech_conditioning_input.unsqueeze(1) if len(speech_conditioning_input.shape) == 3 else speech_conditioning_input
+        conds = []
+        for j in range(speech_conditioning_input.shape[1]):
+            conds.append(self.conditioning_encoder(speech_conditioning_input[:, j]))
+        conds = torch.stack(conds, dim=1)
+        if self.average_conditioning_embeddings:
+            conds = conds.mean(dim=1).unsqueeze(1)
+        return conds
+
+    def build_inference_prefix(self, speech_conditioning_input, text_inputs, conditioning_latents=None):
+        """
+        Builds the embeddings that precede the first generated MEL token during inference: the conditioning latents,
+        the text and one placeholder MEL token per conditioning input, the last being the start token. This replicates
+        the inputs inference_speech() feeds to HF generate(), so every decoding path produces the same codes.
+
+        If <conditioning_latents> (from get_conditioning_latents()) are given, <speech_conditioning_input> is ignored.
+
+        Returns the (b,s,d) prefix and the (b,c) placeholder MEL tokens.
+        """
+        text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
+        text_inputs, text_targets = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
+        text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
+
+        if conditioning_latents is not None:
+            conds = conditioning_latents.expand(text_emb.shape[0], -1, -1)
+        else:
+            conds = self.get_conditioning_latents(speech_conditioning_input)
+
+        start_tokens = torch.full((text_inputs.shape[0], conds.shape[1]), fill_value=1, dtype=torch.long, device=text_inputs.device)
+        start_tokens[:, -1] = self.start_mel_token
+        start_emb = self.mel_embedding(start_tokens) + self.mel_pos_embedding(start_tokens)
+        return torch.cat([conds, text_emb, start_emb], dim=1), start_tokens
+
+    def get_inference_sequence_length(self):
+        """ Returns the maximum length of a prefix plus generated MEL tokens during inference. """
+        return 2002 if self.max_mel_tokens == -1 else self.max_mel_tokens + self.max_text_tokens + 2
+
+    def get_max_generate_length(self, prefix_length, num_start_tokens):
+        """ Returns how many MEL tokens inference_speech() may generate after a prefix of the given length. """
+        max_new = self.get_inference_sequence_length() - prefix_length
+        if self.max_mel_tokens != -1:
+            max_new = min(max_new, self.max_mel_tokens - num_start_tokens)
+        return max_new
+
+    def get_mel_position_embedding(self, positions):
+        """ Returns MEL position embeddings for a (b,) tensor of per-sequence positions, as a (b,1,d) tensor. """
+        return self.mel_pos_embedding.emb(positions).unsqueeze(1)
+
+    def _native_decode_steps(self, prefix, start_tokens, num_return_sequences, max_new, do_sample=True, temperature=1.0,
+                             top_k=0, top_p=1.0, repetition_penalty=1.0):
+        """
+        Generator behind inference_speech_native() and inference_speech_stream(). Decodes up to <max_new> tokens for
+        <num_return_sequences> candidates of every input of <prefix> and yields (tokens, finished) after each step: the
+        sampled tokens and a mask of the sequences that have emitted the stop token. Decoding stops as soon as the
+        consumer stops iterating.
+        """
+        from models.audio.tts.cached_gpt_sampler import KVCacheGPT2Decoder, process_logits
+
+        b, device = prefix.shape[0], prefix.device
+        prefix_decoder = KVCacheGPT2Decoder(self.gpt, b, prefix.shape[1], device, prefix.dtype)
+        hidden = prefix_decoder.forward(prefix)[:, -1:]
+        n = b * num_return_sequences
+        decoder = KVCacheGPT2Decoder(self.gpt, n, prefix.shape[1] + max_new, device, prefix.dtype)
+        decoder.load_prefix(prefix_decoder, num_return_sequences)
+        del prefix_decoder
+        hidden = hidden.repeat_interleave(num_return_sequences, dim=0)
+
+        seen = torch.zeros((n, self.number_mel_codes), dtype=torch.bool, device=device)
+        seen.scatter_(1, start_tokens.repeat_interleave(num_return_sequences, dim=0), True)
+        finished = torch.zeros((n,), dtype=torch.bool, device=device)
+        for i in range(max_new):
+            logits = self.mel_head(self.final_norm(hidden[:, -1]))
+            logits = process_logits(logits, seen, temperature=temperature if do_sample else 1.0, top_k=top_k if do_sample else 0,
+                                    top_p=top_p if do_sample else 1.0, repetition_penalty=repetition_penalty)
+            if do_sample:
+                next_tokens = torch.multinomial(logits.softmax(dim=-1), num_samples=1).squeeze(1)
+            else:
+                next_tokens = logits.argmax(dim=-1)
+            next_tokens = torch.where(finished, torch.full_like(next_tokens, self.stop_mel_token), next_tokens)
+            seen.scatter_(1, next_tokens.unsqueeze(1), True)
+            finished = finished | (next_tokens == self.stop_mel_token)
+            yield next_tokens, finished
+            if i == max_new - 1:
+                break
+            emb = self.mel_embedding(next_tokens.unsqueeze(1)) + self.mel_pos_embedding.get_fixed_embedding(start_tokens.shape[1] + i + 1, device)
+            hidden = decoder.forward(emb)
+
+    def inference_speech_native(self, speech_conditioning_input, text_inputs, num_return_sequences=1, max_generate_length=None,
+                                do_sample=True, temperature=1.0, top_k=0, top_p=1.0, repetition_penalty=1.0,
+                                stop_check_interval=8, conditioning_latents=None):
+        """
+        Drop-in alternative to inference_speech() that decodes with a native loop over a preallocated key/value cache
+        rather than HF generate(). The conditioning+text prefix is encoded once per input and shared by all
+        <num_return_sequences> candidates. Sampling arguments mirror those of HF generate(). Precomputed
+        <conditioning_latents> (see get_conditioning_latents()) may be passed in place of the conditioning MELs.
+
+        Returns a (b*num_return_sequences, s) tensor of MEL codes, formatted like the output of inference_speech().
+        """
+        from models.audio.tts.cached_gpt_sampler import trim_finished
+
+        prefix, start_tokens = self.build_inference_prefix(speech_conditioning_input, text_inputs, conditioning_latents)
+        max_new = self.get_max_generate_length(prefix.shape[1], start_tokens.shape[1])
+        if max_generate_length is not None:
+            max_new = min(max_new, max_generate_length)
+        assert max_new > 0
+
+        sequences = torch.full((prefix.shape[0] * num_return_sequences, max_new), fill_value=self.stop_mel_token, dtype=torch.long, device=prefix.device)
+        steps = self._native_decode_steps(prefix, start_tokens, num_return_sequences, max_new, do_sample=do_sample, temperature=temperature,
+                                          top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty)
+        for i, (next_tokens, finished) in enumerate(steps):
+            sequences[:, i] = next_tokens
+            # Checking for completion forces a device sync, so only do it periodically.
+            if i % stop_check_interval == 0 and finished.all():
+                break
+        return trim_finished(sequences[:, :i+1], self.stop_mel_token)
+
+    def inference_speech_stream(self, speech_conditioning_input, text_inputs, chunk_size=16, max_generate_length=None,
+                                do_sample=True, temperature=1.0, top_k=0, top_p=1.0, repetition_penalty=1.0,
+                                conditioning_latents=None):
+        """
+        Decodes a single sequence like inference_speech_native() but yields it while it is being generated, as
+        (codes, latents) chunks of <chunk_size> tokens with shapes (1,n) and (1,n,d). The latents of each chunk are
+        computed by running forward() with return_latent=True over all codes generated so far, so they match what the
+        diffusion models were trained on (the model is causal, so they do not depend on later codes). This lets
+        diffusion decoding start before the sequence is complete. The stop token is not yielded.
+
+        Like inference_speech(), the text is limited to max_text_tokens and the generated codes to max_mel_tokens;
+        longer texts must be split by the caller.
+        """
+        assert text_inputs.shape[0] == 1, 'Only a single input can be streamed.'
+        if conditioning_latents is None:
+            conditioning_latents = self.get_conditioning_latents(speech_conditioning_input)
+        prefix, start_tokens = self.build_inference_prefix(None, text_inputs, conditioning_latents)
+        max_new = self.get_max_generate_length(prefix.shape[1], start_tokens.shape[1])
+        if max_generate_length is not None:
+            max_new = min(max_new, max_generate_length)
+        assert max_new > 0
+
+        text_lengths = torch.tensor([text_inputs.shape[-1]], device=text_inputs.device)
+        sequence = torch.zeros((1, 0), dtype=torch.long, device=text_inputs.device)
+        codes = []
+        steps = self._native_decode_steps(prefix, start_tokens, 1, max_new, do_sample=do_sample, temperature=temperature,
+                                          top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty)
+        for i, (next_tokens, _) in enumerate(steps):
+            codes.append(next_tokens)
+            if len(codes) < chunk_size and i < max_new - 1:
+                continue
+            codes = torch.stack(codes, dim=1)
+            # Only checked once per chunk since it forces a device sync.
+            stops = (codes[0] == self.stop_mel_token).nonzero()
+            finished = len(stops) > 0
+            if finished:
+                codes = codes[:, :int(stops[0])]
+            if codes.shape[1] > 0:
+                sequence = torch.cat([sequence, codes], dim=1)
+                length = sequence.shape[1]
+                wav_lengths = torch.tensor([length if self.tortoise_compat else length * self.mel_length_compression], device=sequence.device)
+                latents = self(None, text_inputs, text_lengths, sequence, wav_lengths, return_latent=True,
+                               conditioning_latents=conditioning_latents)
+                yield codes, latents[:, length - codes.shape[1]:length]
+            if finished:
+                return
+            codes = []
+
     # Turns the (utterly insane) output of HF.generate() into a far more sane output:
     # [tensors(B,H,S,S)]. Outer=layers, B=batch,H=head,S=sequence
     def make_hf_generate_attentions_sane(self, attentions):
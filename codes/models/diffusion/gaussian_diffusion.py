@@ -6,6 +6,7 @@ Docstrings have been added, as well as DDIM sampling and a new collection of bet
 """
 
 import enum
+import functools
 import math
 import random
 
@@ -17,6 +18,7 @@ from tqdm import tqdm
 
 from models.diffusion.nn import mean_flat
 from models.diffusion.losses import normal_kl, discretized_gaussian_log_likelihood
+from models.diffusion.multistep_solvers import SOLVERS, multistep_sample_loop_progressive
 
 
 def causal_timestep_adjustment(t, S, num_timesteps, causal_slope=1, add_jitter=True):
@@ -157,6 +159,14 @@ class GaussianDiffusion:
     :param rescale_timesteps: if True, pass floating point timesteps into the
                               model so that they are always scaled like in the
                               original paper (0 to 1000).
+    :param batched_conditioning_free: if True, the conditioned and unconditioned
+                                      predictions of conditioning-free guidance
+                                      are computed in a single forward pass over a
+                                      doubled batch for models that support it.
+    :param precompute_timestep_independent: if True, sampling loops run the
+                                            timestep-independent part of models
+                                            that expose one once per sample
+                                            rather than at every step.
     """
 
     def __init__(
@@ -170,6 +180,8 @@ class GaussianDiffusion:
         conditioning_free=False,
         conditioning_free_k=1,
         ramp_conditioning_free=True,
+        batched_conditioning_free=True,
+        precompute_timestep_independent=True,
     ):
         self.model_mean_type = ModelMeanType(model_mean_type)
         self.model_var_type = ModelVarType(model_var_type)
@@ -178,6 +190,8 @@ class GaussianDiffusion:
         self.conditioning_free = conditioning_free
         self.conditioning_free_k = conditioning_free_k
         self.ramp_conditioning_free = ramp_conditioning_free
+        self.batched_conditioning_free = batched_conditioning_free
+        self.precompute_timestep_independent = precompute_timestep_independent
 
         # Use float64 for accuracy.
         betas = np.array(betas, dtype=np.float64)
@@ -285,6 +299,34 @@ class GaussianDiffusion:
         )
         return posterior_mean, posterior_variance, posterior_log_variance_clipped
 
+    def timestep_independent_kwargs(self, model, shape, model_kwargs, cond_fn=None):
+        """
+        Returns <model_kwargs> with the conditioning inputs replaced by the output of the model's timestep-independent
+        stage, so that it is computed once per sample instead of at every step of a sampling loop. Models opt in by
+        implementing timestep_independent_kwargs(model_kwargs, expected_seq_len); <model_kwargs> is returned unchanged
+        for all other models, and when <cond_fn> (which receives the raw model_kwargs) is in use.
+        """
+        if not self.precompute_timestep_independent or model_kwargs is None or cond_fn is not None:
+            return model_kwargs
+        fn = find_model_attribute(model, 'timestep_independent_kwargs')
+        if fn is None:
+            return model_kwargs
+        with th.no_grad():
+            return fn(model_kwargs, shape[-1])
+
+    def _batched_conditioning_free_forward(self, model, x, t, model_kwargs):
+        """
+        Computes the conditioned and unconditioned model outputs for conditioning-free guidance with one forward pass.
+        x, t and every model_kwarg with a leading batch dimension are concatenated with themselves and the model is told
+        to ignore its conditioning inputs for the second half through a per-element `conditioning_free` mask.
+        """
+        B = x.shape[0]
+        doubled_kwargs = {k: th.cat([v, v], dim=0) if th.is_tensor(v) and v.dim() > 0 and v.shape[0] == B else v
+                          for k, v in model_kwargs.items()}
+        mask = th.arange(2 * B, device=x.device) >= B
+        out = model(th.cat([x, x], dim=0), self._scale_timesteps(th.cat([t, t], dim=0)), conditioning_free=mask, **doubled_kwargs)
+        return out[:B], out[B:]
+
     def p_mean_variance(
         self, model, x, t, clip_denoised=True, denoised_fn=None, model_kwargs=None
     ):
@@ -313,9 +355,12 @@ class GaussianDiffusion:
 
         B, C = x.shape[:2]
         assert t.shape == (B,) or t.shape == (B,1,x.shape[-1])
-        model_output = model(x, self._scale_timesteps(t), **model_kwargs)
-        if self.conditioning_free:
-            model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
+        if self.conditioning_free and self.batched_conditioning_free and find_model_attribute(model, 'supports_batched_conditioning_free', False):
+            model_output, model_output_no_conditioning = self._batched_conditioning_free_forward(model, x, t, model_kwargs)
+        else:
+            model_output = model(x, self._scale_timesteps(t), **model_kwargs)
+            if self.conditioning_free:
+                model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
 
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, C * 2, *x.shape[2:])
@@ -372,10 +417,12 @@ class GaussianDiffusion:
                 self._predict_xstart_from_xprev(x_t=x, t=t, xprev=model_output)
             )
             model_mean = model_output
+            eps = self._predict_eps_from_xstart(x_t=x, t=t, pred_xstart=pred_xstart)
         elif self.model_mean_type in [ModelMeanType.START_X, ModelMeanType.EPSILON]:
             if self.model_mean_type == ModelMeanType.START_X:
                 assert 'bad boy.'
                 pred_xstart = process_xstart(model_output)
+                eps = self._predict_eps_from_xstart(x_t=x, t=t, pred_xstart=pred_xstart)
             else:
                 eps = model_output
                 pred_xstart = process_xstart(
@@ -597,6 +644,7 @@ class GaussianDiffusion:
         else:
             img = th.randn(*shape, device=device)
         indices = list(range(self.num_timesteps))[::-1]
+        model_kwargs = self.timestep_independent_kwargs(model, shape, model_kwargs, cond_fn)
 
         orig_img = img
         for i in tqdm(indices):
@@ -911,6 +959,7 @@ class GaussianDiffusion:
         else:
             img = th.randn(*shape, device=device)
         indices = list(range(self.num_timesteps))[::-1]
+        model_kwargs = self.timestep_independent_kwargs(model, shape, model_kwargs, cond_fn)
 
         if progress:
             # Lazy import so that we don't depend on tqdm.
@@ -944,6 +993,69 @@ class GaussianDiffusion:
                     img[mask] = orig_img[mask]  # For causal diffusion, keep resetting these predictions until they are unmasked.
                 orig_img = orig_img
 
+    def multistep_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        causal=False,
+        causal_slope=1,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        solver='unipc',
+        steps=20,
+        order=2,
+        schedule='karras',
+    ):
+        """
+        Generate samples from the model with a multistep ODE solver (DPM-Solver++ or UniPC) in <steps> model
+        evaluations. See models/diffusion/multistep_solvers.py.
+
+        Arguments are the same as p_sample_loop(), plus the solver settings. Causal diffusion and cond_fn guidance
+        are not supported.
+        """
+        assert not causal and cond_fn is None, "The multistep solvers do not support causal diffusion or cond_fn."
+        final = None
+        for sample in self.multistep_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            solver=solver,
+            steps=steps,
+            order=order,
+            schedule=schedule,
+        ):
+            final = sample
+        return final["sample"]
+
+    def multistep_sample_loop_progressive(self, model, shape, **kwargs):
+        """
+        Same usage as multistep_sample_loop(), but yields the intermediate samples of every solver step.
+        """
+        return multistep_sample_loop_progressive(self, model, shape, **kwargs)
+
+    def get_sampling_fn(self, sampler='p', **solver_args):
+        """
+        Returns the sampling loop named <sampler>, which is called like p_sample_loop(): 'p' for ancestral sampling,
+        'ddim', or one of the multistep solvers in SOLVERS, configured with <solver_args> (steps, order, schedule).
+        """
+        if sampler == 'p':
+            return self.p_sample_loop
+        elif sampler == 'ddim':
+            return self.ddim_sample_loop
+        elif sampler in SOLVERS:
+            return functools.partial(self.multistep_sample_loop, solver=sampler, **solver_args)
+        raise NotImplementedError(sampler)
+
     def _vb_terms_bpd(
         self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
     ):
@@ -1169,6 +1281,17 @@ class GaussianDiffusion:
         }
 
 
+def find_model_attribute(model, name, default=None):
+    """
+    Looks up attribute <name> of <model>, looking through the wrappers placed around it by SpacedDiffusion and
+    DataParallel/DistributedDataParallel.
+    """
+    from models.diffusion.respace import _WrappedModel
+    while isinstance(model, (_WrappedModel, th.nn.DataParallel, th.nn.parallel.DistributedDataParallel)):
+        model = model.model if isinstance(model, _WrappedModel) else model.module
+    return getattr(model, name, default)
+
+
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
     Extract values from a 1-D numpy array for a batch of indices.
@@ -1200,6 +1323,32 @@ def test_causal_training_losses():
     model = IdentityTwoArg()
     diff.causal_training_losses(model, torch.randn(4,256,400), torch.tensor([500,1000,3000,3500]), causal_slope=4)
 
+def test_sampling_shortcut_parity():
+    # Batched conditioning-free guidance and precomputed timestep-independent embeddings must produce the same samples
+    # as the plain sampling path.
+    from models.diffusion.respace import SpacedDiffusion
+    from models.diffusion.respace import space_timesteps
+    from models.audio.tts.unet_diffusion_tts_flat import DiffusionTtsFlat
+
+    model = DiffusionTtsFlat(model_channels=128, num_layers=2, in_channels=100, out_channels=200, in_latent_channels=128,
+                             num_heads=4, layer_drop=0, unconditioned_percentage=0).eval()
+    kwargs = {'aligned_conditioning': torch.randn(2, 25, 128), 'conditioning_input': torch.randn(2, 100, 200)}
+    noise = torch.randn(2, 100, 100)
+    for sampler in ['p_sample_loop', 'ddim_sample_loop']:
+        outs = []
+        for batched, precompute in [(False, False), (True, False), (False, True), (True, True)]:
+            diff = SpacedDiffusion(use_timesteps=space_timesteps(4000, [20]), model_mean_type='epsilon',
+                                   model_var_type='learned_range', loss_type='mse', betas=get_named_beta_schedule('linear', 4000),
+                                   conditioning_free=True, conditioning_free_k=2, ramp_conditioning_free=False,
+                                   batched_conditioning_free=batched, precompute_timestep_independent=precompute)
+            torch.manual_seed(0)
+            with torch.no_grad():
+                outs.append(getattr(diff, sampler)(model, noise.shape, noise=noise, model_kwargs=kwargs, progress=False))
+        for out in outs[1:]:
+            print(f'{sampler} max abs difference: {(outs[0] - out).abs().max().item()}')
+            assert torch.allclose(outs[0], out, atol=1e-4)
+
+
 def graph_causal_timestep_adjustment():
     import matplotlib.pyplot as plt
     S = 400
@@ -1248,5 +1397,6 @@ def graph_causal_timestep_adjustment_by_timestep():
 
 if __name__ == '__main__':
     #test_causal_training_losses()
+    #test_sampling_shortcut_parity()
     #graph_causal_timestep_adjustment()
     graph_causal_timestep_adjustment_by_timestep()
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""
+Multistep ODE solvers that sample from a GaussianDiffusion in 10-25 network evaluations instead of the hundreds that
+ancestral sampling needs.
+
+Both solvers integrate the probability flow ODE in its data-prediction form. They use the diffusion's alphas_cumprod as
+the noise schedule and its p_mean_variance() to get x_0 predictions, so model mean and variance types, clipping and
+conditioning-free guidance behave exactly as they do for p_sample_loop().
+
+- 'dpm++': DPM-Solver++ multistep (Lu et al. 2022, https://arxiv.org/abs/2211.01095). At order 2 this is exactly
+  DPM-Solver++(2M); higher orders use the UniP-p predictor, which generalizes it.
+- 'unipc': UniPC (Zhao et al. 2023, https://arxiv.org/abs/2302.04867). This is the same predictor plus a corrector
+  that reuses the model evaluation of the following step, raising the order of accuracy at no extra cost.
+"""
+import numpy as np
+import torch as th
+from tqdm import tqdm
+
+SOLVERS = ['dpm++', 'unipc']
+
+
+def get_solver_timesteps(alphas_cumprod, steps, schedule='karras', rho=7.0):
+    """
+    Picks up to <steps>+1 decreasing timesteps of a discrete diffusion process with the given cumulative alphas, from
+    its last timestep down to 0. Fewer are returned when rounding maps several noise levels to the same timestep.
+
+    :param schedule: 'karras' spaces noise levels as in Karras et al. 2022 (https://arxiv.org/abs/2206.00364),
+                     concentrating steps at low noise; 'logsnr' spaces them evenly in log-SNR; 'uniform' spaces the
+                     timesteps themselves evenly.
+    """
+    num_timesteps = len(alphas_cumprod)
+    # Increases monotonically with the timestep.
+    log_sigmas = 0.5 * np.log((1 - alphas_cumprod) / alphas_cumprod)
+    if schedule == 'uniform':
+        ts = np.linspace(num_timesteps - 1, 0, steps + 1)
+    else:
+        if schedule == 'karras':
+            min_inv_rho, max_inv_rho = np.exp(log_sigmas[0]) ** (1 / rho), np.exp(log_sigmas[-1]) ** (1 / rho)
+            targets = rho * np.log(max_inv_rho + np.linspace(0, 1, steps + 1) * (min_inv_rho - max_inv_rho))
+        elif schedule == 'logsnr':
+            targets = np.linspace(log_sigmas[-1], log_sigmas[0], steps + 1)
+        else:
+            raise NotImplementedError(schedule)
+        ts = np.interp(targets, log_sigmas, np.arange(num_timesteps))
+    return sorted(set(np.round(ts).astype(np.int64).tolist()), reverse=True)
+
+
+def _multistep_update(x, history, t, order, predict_xstart, use_corrector, alphas, sigmas, lambdas):
+    """
+    Advances <x> from the timestep of the most recent entry of <history> (a list of (timestep, x_0 prediction) pairs)
+    to timestep <t> with the UniP-<order> predictor and, if requested, the UniC corrector (the "bh2" variant, with
+    B(h) = e^h - 1). Returns the new sample and the x_0 prediction made at the predicted sample, which the corrector
+    needs and which becomes the newest history entry; the latter is None when the corrector is not used.
+    """
+    t_prev, model_prev = history[-1]
+    h = lambdas[t] - lambdas[t_prev]
+    rks, d1s = [], []
+    for k in range(1, order):
+        t_k, model_k = history[-(k + 1)]
+        rk = (lambdas[t_k] - lambdas[t_prev]) / h
+        rks.append(rk)
+        d1s.append((model_k - model_prev) / float(rk))
+    rks.append(1.0)
+    rks = np.array(rks)
+
+    hh = -h
+    h_phi_1 = np.expm1(hh)
+    h_phi_k = h_phi_1 / hh - 1
+    b_h = np.expm1(hh)
+    R, b = [], []
+    factorial = 1
+    for i in range(1, order + 1):
+        R.append(rks ** (i - 1))
+        b.append(h_phi_k * factorial / b_h)
+        factorial *= i + 1
+        h_phi_k = h_phi_k / hh - 1 / factorial
+    R, b = np.stack(R), np.array(b)
+
+    x_base = float(sigmas[t] / sigmas[t_prev]) * x - float(alphas[t] * h_phi_1) * model_prev
+    pred_res = 0
+    if len(d1s) > 0:
+        rhos_p = np.array([0.5]) if order == 2 else np.linalg.solve(R[:-1, :-1], b[:-1])
+        pred_res = sum(float(rho) * d for rho, d in zip(rhos_p, d1s))
+    x_t = x_base - float(alphas[t] * b_h) * pred_res
+    if not use_corrector:
+        return x_t, None
+
+    model_t = predict_xstart(x_t, t)
+    rhos_c = np.array([0.5]) if order == 1 else np.linalg.solve(R, b)
+    corr_res = sum(float(rho) * d for rho, d in zip(rhos_c[:-1], d1s))
+    x_t = x_base - float(alphas[t] * b_h) * (corr_res + float(rhos_c[-1]) * (model_t - model_prev))
+    return x_t, model_t
+
+
+def multistep_sample_loop_progressive(diffusion, model, shape, solver='unipc', steps=20, order=2, schedule='karras',
+                                      noise=None, clip_denoised=True, denoised_fn=None, model_kwargs=None, device=None,
+                                      progress=False):
+    """
+    Samples from <model> with a multistep solver, yielding a dict with the current 'sample' and 'pred_xstart' after
+    every step. Takes <steps> model evaluations. Timesteps are picked from those of <diffusion>, so a SpacedDiffusion
+    limits the solver to its respaced timesteps; use one that retains every trained timestep.
+
+    :param solver: one of SOLVERS.
+    :param order: the solver order. Orders above 3 are rarely stable.
+    :param schedule: how steps are distributed across noise levels; see get_solver_timesteps().
+    """
+    assert solver in SOLVERS, f'Unknown solver {solver}'
+    if device is None:
+        device = next(model.parameters()).device
+    assert isinstance(shape, (tuple, list))
+    x = noise if noise is not None else th.randn(*shape, device=device)
+    model_kwargs = diffusion.timestep_independent_kwargs(model, shape, model_kwargs)
+
+    alphas = np.sqrt(diffusion.alphas_cumprod)
+    sigmas = np.sqrt(1.0 - diffusion.alphas_cumprod)
+    lambdas = np.log(alphas) - np.log(sigmas)
+    timesteps = get_solver_timesteps(diffusion.alphas_cumprod, steps, schedule)
+
+    def predict_xstart(x, t):
+        out = diffusion.p_mean_variance(model, x, th.tensor([t] * shape[0], device=device), clip_denoised=clip_denoised,
+                                        denoised_fn=denoised_fn, model_kwargs=model_kwargs)
+        return out['pred_xstart']
+
+    with th.no_grad():
+        history = []
+        model_x = predict_xstart(x, timesteps[0])
+        indices = range(1, len(timesteps))
+        if progress:
+            indices = tqdm(indices)
+        for i in indices:
+            history = (history + [(timesteps[i - 1], model_x)])[-order:]
+            last = i == len(timesteps) - 1
+            step_order = min(order, len(history))
+            if len(timesteps) <= 10:
+                # Lower order final steps noticeably improve stability when there are only a few steps.
+                step_order = min(step_order, len(timesteps) - i)
+            x, model_x = _multistep_update(x, history, timesteps[i], step_order, predict_xstart,
+                                           solver == 'unipc' and not last, alphas, sigmas, lambdas)
+            if model_x is None and not last:
+                model_x = predict_xstart(x, timesteps[i])
+            yield {'sample': x, 'pred_xstart': history[-1][1]}
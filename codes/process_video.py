@@ -5,6 +5,7 @@ import os.path as osp
 import subprocess
 import time
 
+import numpy as np
 import torch
 import torch.utils.data as data
 import torchvision.transforms.functional as F
@@ -17,8 +18,21 @@ import utils.util as util
 from data import create_dataloader
 
 
+def probe_video_size(video):
+    ''' Returns the (width, height) of the first video stream of <video>. '''
+    out = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height',
+                          '-of', 'csv=p=0', video], stdout=subprocess.PIPE, check=True).stdout
+    w, h = out.decode('utf-8').strip().split(',')[:2]
+    return int(w), int(h)
+
+
 class FfmpegBackedVideoDataset(data.Dataset):
-    '''Pulls frames from a video one at a time using FFMPEG.'''
+    '''Pulls frames from a video one at a time using FFMPEG.
+
+    In sequential_decode mode (the default), a single ffmpeg process decodes the video from start_at_seconds at
+    frame_rate and streams raw RGB frames through a pipe into a reusable buffer. Reading frames in order (as the
+    non-shuffled test dataloader does) then costs a single decode per frame. Reading out of order restarts the
+    decoder at the requested frame. Otherwise, every frame is extracted to a PNG by its own ffmpeg process.'''
 
     def __init__(self, opt, working_dir):
         super(FfmpegBackedVideoDataset, self).__init__()
@@ -36,6 +50,70 @@ class FfmpegBackedVideoDataset(data.Dataset):
         self.data_type = self.opt['data_type']
         self.vertical_splits = self.opt['vertical_splits'] if 'vertical_splits' in opt.keys() else 1
 
+        self.sequential_decode = self.opt['sequential_decode'] if 'sequential_decode' in opt.keys() else True
+        self.decoder = None
+        self.next_frame = None  # Index of the frame the decoder will produce next.
+        self.frame_buffer = None
+        self.last_frame = (None, None)  # (index, tensor) of the most recently decoded frame; shared by vertical splits.
+
+    def __del__(self):
+        self.close_decoder()
+
+    def __getstate__(self):
+        # Decoder processes cannot be shared with dataloader workers; each worker starts its own.
+        state = self.__dict__.copy()
+        state['decoder'] = None
+        state['next_frame'] = None
+        return state
+
+    def close_decoder(self):
+        if self.decoder is not None:
+            self.decoder.stdout.close()
+            self.decoder.kill()
+            self.decoder.wait()
+            self.decoder = None
+
+    def start_decoder(self, frame):
+        self.close_decoder()
+        if self.frame_buffer is None:
+            self.width, self.height = probe_video_size(self.video)
+            self.frame_buffer = bytearray(self.width * self.height * 3)
+        ffmpeg_args = ['ffmpeg', '-ss', self.get_time_for_it(frame), '-i', self.video, '-vf', 'fps=%s' % (self.frame_rate,),
+                       '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+        self.decoder = subprocess.Popen(ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        bufsize=len(self.frame_buffer))
+        self.next_frame = frame
+
+    def decode_frame(self, frame):
+        ''' Returns frame <frame> as a (3,h,w) tensor from the streaming decoder. '''
+        if self.last_frame[0] == frame:
+            return self.last_frame[1]
+        if self.decoder is None or self.next_frame > frame or frame - self.next_frame > self.frame_rate:
+            self.start_decoder(frame)
+        view = memoryview(self.frame_buffer)
+        while self.next_frame <= frame:
+            read = 0
+            while read < len(view):
+                n = self.decoder.stdout.readinto(view[read:])
+                if not n:
+                    raise EOFError('Video ended before frame %d.' % (frame,))
+                read += n
+            self.next_frame += 1
+        img = torch.frombuffer(self.frame_buffer, dtype=torch.uint8).view(self.height, self.width, 3)
+        img = img.permute(2, 0, 1).float() / 255
+        self.last_frame = (frame, img)
+        return img
+
+    def extract_frame(self, frame):
+        ''' Returns frame <frame> as a (3,h,w) tensor by extracting it with a dedicated ffmpeg process. '''
+        # Extract the frame. Command template: `ffmpeg -ss 17:00.0323 -i <video file>.mp4 -vframes 1 destination.png`
+        working_file_name = osp.join(self.working_dir, "working_%d.png" % (frame % self.max_working_files,))
+        vid_time = self.get_time_for_it(frame)
+        ffmpeg_args = ['ffmpeg', '-y', '-ss', vid_time, '-i', self.video, '-vframes', '1', working_file_name]
+        process = subprocess.Popen(ffmpeg_args, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        process.wait()
+        return F.to_tensor(Image.open(working_file_name))
+
     def get_time_for_it(self, it):
         secs = it / self.frame_rate + self.start_at
         mins = int(secs / 60)
@@ -50,23 +128,14 @@ class FfmpegBackedVideoDataset(data.Dataset):
         else:
             actual_index = index
 
-        # Extract the frame. Command template: `ffmpeg -ss 17:00.0323 -i <video file>.mp4 -vframes 1 destination.png`
-        working_file_name = osp.join(self.working_dir, "working_%d.png" % (actual_index % self.max_working_files,))
-        vid_time = self.get_time_for_it(actual_index)
-        ffmpeg_args = ['ffmpeg', '-y', '-ss', vid_time, '-i', self.video, '-vframes', '1', working_file_name]
-        process = subprocess.Popen(ffmpeg_args, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-        process.wait()
-
         # get LQ image
-        LQ_path = working_file_name
-        img_LQ = Image.open(LQ_path)
+        img_LQ = self.decode_frame(actual_index) if self.sequential_decode else self.extract_frame(actual_index)
         split_index = (index % self.vertical_splits)
         if self.vertical_splits > 0:
-            w, h = img_LQ.size
+            _, h, w = img_LQ.shape
             w_per_split = int(w / self.vertical_splits)
             left = w_per_split * split_index
-            img_LQ = F.crop(img_LQ, 0, left, h, w_per_split)
-        img_LQ = F.to_tensor(img_LQ)
+            img_LQ = img_LQ[:, :, left:left+w_per_split]
 
         mask = torch.ones(1, img_LQ.shape[1], img_LQ.shape[2])
         ref = torch.cat([img_LQ, mask], dim=0)
@@ -94,6 +163,33 @@ class FfmpegBackedVideoDataset(data.Dataset):
     def __len__(self):
         return self.frame_count * self.vertical_splits
 
+class MinividEncoder:
+    '''Encodes frames into a video by piping raw BGR frames (as produced by util.tensor2img) into ffmpeg.'''
+
+    def __init__(self, output_path, frame_rate, crf):
+        self.output_path = output_path
+        self.frame_rate = frame_rate
+        self.crf = crf
+        self.proc = None
+
+    def write(self, img):
+        if self.proc is None:
+            h, w = img.shape[:2]
+            cmd = ['ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '%dx%d' % (w, h), '-framerate', str(self.frame_rate),
+                   '-i', '-', '-c:v', 'libx265', '-crf', str(self.crf), '-preset', 'slow', '-pix_fmt', 'yuv444p', self.output_path]
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        self.proc.stdin.write(np.ascontiguousarray(img).tobytes())
+
+    def close(self):
+        ''' Finishes the input stream. The encoder keeps running until wait() is called. '''
+        if self.proc is not None:
+            self.proc.stdin.close()
+
+    def wait(self):
+        if self.proc is not None:
+            self.proc.wait()
+
+
 def merge_images(files, output_path):
     """Merges several image files together across the vertical axis
     """
@@ -153,6 +249,13 @@ if __name__ == "__main__":
     scale = opt['scale']
     first_frame = True
     ffmpeg_proc = None
+    # Pipe frames straight into the minivid encoder rather than writing them out as PNGs first.
+    encode_pipe = opt['minivid_pipe'] if 'minivid_pipe' in opt.keys() else True
+    num_splits = opt['dataset']['vertical_splits'] if 'vertical_splits' in opt['dataset'].keys() else 1
+    # Every minivid must end on a whole frame, i.e. after all the splits of its last frame.
+    assert not encode_pipe or frames_per_vid % max(num_splits, 1) == 0, 'frames_per_mini_vid must be a multiple of vertical_splits.'
+    encoder = None
+    pending_splits = []
 
     tq = tqdm(test_loader)
     for data in tq:
@@ -180,6 +283,24 @@ if __name__ == "__main__":
         for i in range(visuals.shape[0]):
             sr_img = util.tensor2img(visuals[i])  # uint8
 
+            if encode_pipe:
+                pending_splits.append(sr_img)
+                if len(pending_splits) == num_splits:
+                    if encoder is None:
+                        encoder = MinividEncoder(osp.join(vid_output, "mini_%06d.mkv" % (vid_counter,)),
+                                                 opt['dataset']['frame_rate'], minivid_crf)
+                    encoder.write(np.concatenate(pending_splits, axis=1))
+                    pending_splits = []
+                frame_counter += 1
+                if frame_counter % frames_per_vid == 0:
+                    if ffmpeg_proc is not None:
+                        ffmpeg_proc.wait()
+                    encoder.close()
+                    ffmpeg_proc, encoder = encoder, None
+                    vid_counter += 1
+                    frame_counter = 0
+                continue
+
             # save images
             save_img_path = osp.join(dataset_dir, '%08d.png' % (frame_counter,))
             util.save_img(sr_img, save_img_path)
@@ -214,4 +335,10 @@ if __name__ == "__main__":
 
 
             if want_just_images:
-                continue
\ No newline at end of file
+                continue
+
+    if encoder is not None:
+        encoder.close()
+        encoder.wait()
+    if ffmpeg_proc is not None:
+        ffmpeg_proc.wait()
@@ -0,0 +1,126 @@
+"""
+On-disk cache of per-voice conditioning inputs (conditioning MELs and ConditioningEncoder latents), so that inference
+only has to read and encode the reference clips of a voice the first time it is used.
+
+Entries are content-addressed: the key hashes the contents of every clip in the voice directory, the identity of the
+model checkpoint and any parameters that affect the result. Editing a clip, swapping checkpoints or changing the
+parameters therefore produces a new entry rather than a stale hit. The cache directory is kept below a size budget by
+evicting the least recently used entries.
+"""
+import functools
+import hashlib
+import os
+import threading
+
+import torch
+
+from data.audio.precomputed_clip_cache import hash_file
+from data.util import find_files_of_type, is_audio_file
+
+
+@functools.lru_cache(maxsize=4096)
+def _hash_clip(path, size, mtime):
+    # Keyed by (size, mtime) so unchanged clips are only ever read once per process.
+    return hash_file(path)
+
+
+def _file_identity(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def list_voice_clips(voice):
+    """ Returns the sorted reference clips of <voice>, which is either a single audio file or a directory of them. """
+    if os.path.isdir(voice):
+        return sorted(find_files_of_type('img', voice, qualifier=is_audio_file)[0])
+    return [voice]
+
+
+def compute_voice_key(voice, checkpoint=None, **params):
+    """
+    Computes the cache key for the conditioning inputs of <voice> as produced by the model stored at <checkpoint>
+    with the given <params>. Checkpoints are identified by path, size and modification time since they are too large
+    to hash on every request; clips are identified by content.
+    """
+    h = hashlib.sha1()
+    for clip in list_voice_clips(voice):
+        h.update(os.path.basename(clip).encode('utf-8'))
+        h.update(_hash_clip(clip, *_file_identity(clip)).encode('utf-8'))
+    if checkpoint is not None:
+        h.update(os.path.abspath(checkpoint).encode('utf-8'))
+        h.update(str(_file_identity(checkpoint)).encode('utf-8'))
+    for k in sorted(params.keys()):
+        h.update(f'{k}={params[k]}'.encode('utf-8'))
+    return h.hexdigest()
+
+
+class ConditioningCache:
+    """
+    A directory of <key>.pth files, each holding a dict of CPU tensors. The modification time of an entry doubles as
+    its last-use time and is refreshed on every hit; when the directory grows beyond <max_bytes>, the entries used
+    longest ago are deleted.
+    """
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pth')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            entry = torch.load(path, map_location='cpu')
+        except (OSError, EOFError, RuntimeError):
+            # Missing, or truncated by a process that died mid-write (writes are atomic, but be defensive).
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        entry = {k: v.detach().cpu() if torch.is_tensor(v) else v for k, v in entry.items()}
+        path = self._path(key)
+        # Unique per writer, so that concurrent puts of the same key never interleave in one file.
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        torch.save(entry, tmp)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith('.pth'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, fname))
+            except OSError:
+                continue  # Evicted concurrently.
+            entries.append((st.st_mtime, st.st_size, fname))
+        total = sum(e[1] for e in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, fname))
+            except OSError:
+                pass
+            total -= size
+
+    def get_or_compute(self, key, fn):
+        """ Returns the entry for <key>, calling <fn>() to build (and store) it on a miss. """
+        entry = self.get(key)
+        if entry is None:
+            entry = fn()
+            self.put(key, entry)
+        return entry
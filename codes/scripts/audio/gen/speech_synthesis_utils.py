@@ -8,7 +8,8 @@ from data.util import find_files_of_type, is_audio_file
 from models.audio.vocoders.univnet.generator import UnivNetGenerator
 from models.diffusion.gaussian_diffusion import get_named_beta_schedule
 from models.diffusion.respace import SpacedDiffusion, space_timesteps
-from trainer.injectors.audio_injectors import TorchMelSpectrogramInjector, MelSpectrogramInjector
+from trainer.injectors.audio_injectors import TorchMelSpectrogramInjector, MelSpectrogramInjector, get_mel_frontend, \
+    compute_mel_batch
 from utils.audio import plot_spectrogram
 from utils.util import load_model_from_config
 
@@ -40,20 +41,34 @@ def load_clvp():
     return clvp
 
 
+def _speech_mel_frontend(device, mel_norms_file):
+    return get_mel_frontend(TorchMelSpectrogramInjector, device, mel_norm_file=mel_norms_file)
+
+
+def _univnet_mel_frontend(device, do_normalization):
+    return get_mel_frontend(MelSpectrogramInjector, device, sampling_rate=24000, n_mel_channels=100, mel_fmax=12000,
+                            do_normalization=do_normalization)
+
+
 def wav_to_mel(wav, mel_norms_file='../experiments/clips_mel_norms.pth'):
     """
     Converts an audio clip into a MEL tensor that the vocoder, DVAE and GptTts models use whenever a MEL is called for.
     """
-    return TorchMelSpectrogramInjector({'in': 'wav', 'out': 'mel', 'mel_norm_file': mel_norms_file},{})({'wav': wav})['mel']
+    return _speech_mel_frontend(wav.device, mel_norms_file)({'in': wav})['out']
+
+
+def wavs_to_mels(wavs, mel_norms_file='../experiments/clips_mel_norms.pth'):
+    """
+    Batched version of wav_to_mel() for a list of mono clips of different lengths. Returns a list of (1,80,s) MELs.
+    """
+    return compute_mel_batch(_speech_mel_frontend(wavs[0].device, mel_norms_file), wavs)
 
 
 def wav_to_univnet_mel(wav, do_normalization=False):
     """
     Converts an audio clip into a MEL tensor that the univnet vocoder knows how to decode.
     """
-    return MelSpectrogramInjector({'in': 'wav', 'out': 'mel', 'sampling_rate': 24000,
-                                   'n_mel_channels': 100, 'mel_fmax': 12000,
-                                   'do_normalization': do_normalization},{})({'wav': wav})['mel']
+    return _univnet_mel_frontend(wav.device, do_normalization)({'in': wav})['out']
 
 
 def convert_mel_to_codes(dvae_model, mel):
@@ -93,10 +108,13 @@ def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusi
                            conditioning_free=enable_conditioning_free_guidance, conditioning_free_k=conditioning_free_k)
 
 
-def do_spectrogram_diffusion(diffusion_model, dvae_model, diffuser, mel_codes, conditioning_input, spectrogram_compression_factor=128, plt_spec=False, mean=False):
+def do_spectrogram_diffusion(diffusion_model, dvae_model, diffuser, mel_codes, conditioning_input, spectrogram_compression_factor=128, plt_spec=False, mean=False,
+                             sampler='p', **solver_args):
     """
     Uses the specified diffusion model and DVAE model to convert the provided MEL & conditioning inputs into an audio clip.
+    <sampler> and <solver_args> select the sampling loop; see GaussianDiffusion.get_sampling_fn().
     """
+    sampling_fn = diffuser.get_sampling_fn(sampler, **solver_args)
     diffusion_model.eval()
     dvae_model.eval()
     with torch.no_grad():
@@ -113,8 +131,8 @@ def do_spectrogram_diffusion(diffusion_model, dvae_model, diffuser, mel_codes, c
 
         output_shape = (mel.shape[0], 1, mel.shape[-1] * spectrogram_compression_factor)
         if mean:
-            return diffuser.p_sample_loop(diffusion_model, output_shape, noise=torch.zeros(output_shape, device=mel_codes.device),
-                                          model_kwargs={'spectrogram': mel, 'conditioning_input': conditioning_input})
+            return sampling_fn(diffusion_model, output_shape, noise=torch.zeros(output_shape, device=mel_codes.device),
+                               model_kwargs={'spectrogram': mel, 'conditioning_input': conditioning_input})
         else:
-            return diffuser.p_sample_loop(diffusion_model, output_shape, model_kwargs={'spectrogram': mel, 'conditioning_input': conditioning_input})
+            return sampling_fn(diffusion_model, output_shape, model_kwargs={'spectrogram': mel, 'conditioning_input': conditioning_input})
 
@@ -0,0 +1,194 @@
+"""
+Streaming TTS for long-form text. Instead of diffusing and vocoding the whole utterance at once, the GPT code stream is
+cut into overlapping windows of latents. Each window is decoded through the diffusion model and the UnivNet vocoder as
+soon as the GPT has produced it, and consecutive windows are crossfaded over their overlap. Audio therefore starts
+playing after the first window is decoded, and memory stays bounded by the window size however long the text is.
+
+The GPT can only read max_text_tokens of text and emit max_mel_tokens of codes at a time, so long texts are split into
+segments at sentence (or, failing that, word) boundaries. The segments are generated one after the other and their
+latents are decoded as a single stream.
+
+Since candidates cannot be reranked before they are complete, a single candidate is sampled and CLVP is not used.
+
+Example (run from codes/):
+  python scripts/audio/gen/streaming_tts.py -text "a very long text" -voice D:\\voices\\simmons -output out.wav
+"""
+import argparse
+import re
+from time import time
+
+import torch
+import torchaudio
+
+from data.audio.voice_tokenizer import VoiceBpeTokenizer
+from models.diffusion.multistep_solvers import SOLVERS
+from scripts.audio.gen.speech_synthesis_utils import load_univnet_vocoder, load_discrete_vocoder_diffuser
+from scripts.audio.gen.tts_server import GPT_SAMPLE_RATE, OUTPUT_SAMPLE_RATE, VoiceCache
+from trainer.injectors.audio_injectors import denormalize_mel
+from utils.util import load_model_from_config
+
+
+def latents_to_frames(num_latents):
+    """ Returns the number of output MEL frames that correspond to <num_latents> GPT latents. """
+    return round(num_latents * 4 * OUTPUT_SAMPLE_RATE / GPT_SAMPLE_RATE)
+
+
+def split_text(tokenizer, text, max_tokens):
+    """
+    Splits <text> into segments that encode to at most <max_tokens> tokens, breaking at sentence boundaries where
+    possible and at word boundaries otherwise.
+    """
+    def fits(segment):
+        return len(tokenizer.encode(segment)) <= max_tokens
+
+    pieces = []
+    for sentence in re.split(r'(?<=[.!?;])\s+', text.strip()):
+        if fits(sentence):
+            pieces.append(sentence)
+        else:
+            pieces.extend(sentence.split())
+    segments = []
+    for piece in pieces:
+        if len(segments) > 0 and fits(segments[-1] + ' ' + piece):
+            segments[-1] = segments[-1] + ' ' + piece
+        else:
+            assert fits(piece), f'"{piece}" is too long to be spoken.'
+            segments.append(piece)
+    return segments
+
+
+class StreamingDecoder:
+    """
+    Turns a stream of (1,n,d) GPT latent chunks into a stream of (1,s) waveform chunks.
+
+    Latents are decoded in windows of <window> latents, each starting <overlap> latents before the previous one ended.
+    The diffusion model sees the overlap as context, which keeps windows consistent with each other, and the waveforms
+    of consecutive windows are linearly crossfaded across it. <first_window> (default: <window>) can be set lower to
+    trade the quality of the first chunk for latency.
+
+    <sampling_fn> is the diffusion sampling loop, called like GaussianDiffusion.p_sample_loop(); see
+    GaussianDiffusion.get_sampling_fn().
+    """
+    def __init__(self, diffusion, sampling_fn, vocoder, diffusion_cond, window=64, overlap=8, first_window=None):
+        assert 0 < overlap < window
+        self.diffusion = diffusion
+        self.sampling_fn = sampling_fn
+        self.vocoder = vocoder
+        self.diffusion_cond = diffusion_cond
+        self.window = window
+        self.overlap = overlap
+        self.first_window = window if first_window is None else first_window
+        assert overlap < self.first_window
+
+    def decode_window(self, latents, start, end):
+        """ Decodes latents [start,end) of the stream, <latents>, into a (1,s) waveform. """
+        frames = latents_to_frames(end) - latents_to_frames(start)
+        mel = self.sampling_fn(self.diffusion, (1, self.diffusion_cond.shape[1], frames),
+                               model_kwargs={'aligned_conditioning': latents, 'conditioning_input': self.diffusion_cond})
+        wav = self.vocoder.inference(denormalize_mel(mel))
+        hop = wav.shape[-1] // frames
+        return wav[0, :, :frames * hop].clamp(-1, 1).cpu(), hop
+
+    def crossfade(self, tail, head):
+        fade = torch.linspace(0, 1, tail.shape[-1] + 2)[1:-1]
+        return tail * (1 - fade) + head * fade
+
+    def stream(self, latent_chunks):
+        """ Generator which yields waveform chunks as soon as the latents from <latent_chunks> can be decoded. """
+        buffer = None
+        start = 0  # Index of the first latent in the buffer within the whole stream.
+        tail = None  # Decoded audio of the current overlap, waiting to be crossfaded with the next window.
+        window = self.first_window
+
+        def decode(end, last):
+            nonlocal buffer, start, tail, window
+            wav, hop = self.decode_window(buffer[:, :end - start], start, end)
+            if tail is not None:
+                wav[:, :tail.shape[-1]] = self.crossfade(tail, wav[:, :tail.shape[-1]])
+            if last:
+                tail = None
+                return wav
+            next_start = end - self.overlap
+            ov = (latents_to_frames(end) - latents_to_frames(next_start)) * hop
+            wav, tail = wav[:, :-ov], wav[:, -ov:]
+            buffer = buffer[:, next_start - start:]
+            start = next_start
+            window = self.window
+            return wav
+
+        with torch.no_grad():
+            for chunk in latent_chunks:
+                buffer = chunk if buffer is None else torch.cat([buffer, chunk], dim=1)
+                while buffer.shape[1] >= window:
+                    yield decode(start + window, last=False)
+            if buffer is None:
+                return
+            # After the first window, the buffer begins with the overlap whose audio is held in <tail>.
+            if tail is None or buffer.shape[1] > self.overlap:
+                yield decode(start + buffer.shape[1], last=True)
+            else:
+                yield tail
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt_gpt', type=str, help='Path to options YAML file used to train the GPT-TTS model', default='../experiments/train_gpt_tts_unified.yml')
+    parser.add_argument('-gpt_name', type=str, help='Name of the GPT TTS model in opt.', default='gpt')
+    parser.add_argument('-gpt_path', type=str, help='GPT TTS model checkpoint to load.', default='../experiments/tortoise_ar.pth')
+    parser.add_argument('-opt_diffusion', type=str, help='Path to options YAML file used to train the diffusion model', default='../experiments/train_diffusion_tts9_mel.yml')
+    parser.add_argument('-diffusion_name', type=str, help='Name of the diffusion model in opt.', default='generator')
+    parser.add_argument('-diffusion_path', type=str, help='Diffusion model checkpoint to load.', default='../experiments/tortoise_diffusion.pth')
+    parser.add_argument('-diffusion_steps', type=int, help='Number of diffusion steps to perform per window.', default=50)
+    parser.add_argument('-sampler', type=str, help='Diffusion sampler: p, ddim or one of the multistep solvers (dpm++, unipc), which need far fewer steps (10-25).', default='p')
+    parser.add_argument('-solver_order', type=int, help='Order of the multistep solvers.', default=2)
+    parser.add_argument('-solver_schedule', type=str, help='Timestep schedule of the multistep solvers: karras, logsnr or uniform.', default='karras')
+    parser.add_argument('-diffusion_schedule', type=str, help='Beta schedule the diffusion model was trained with.', default='linear')
+    parser.add_argument('-conditioning_free', action='store_true', help='Enable conditioning-free guidance during diffusion.')
+    parser.add_argument('-conditioning_free_k', type=float, help='Conditioning-free guidance strength.', default=2)
+    parser.add_argument('-tokenizer', type=str, help='BPE vocab file for the text.', default='../experiments/bpe_lowercase_asr_256.json')
+    parser.add_argument('-text', type=str, help='Text to speak.', default="I'm only doing this for the money and the fame.")
+    parser.add_argument('-voice', type=str, help='Reference clip or directory of clips of the voice to use.', default='Z:\\voices\\simmons')
+    parser.add_argument('-output', type=str, help='Where to write the generated audio.', default='../results/streaming_tts.wav')
+    parser.add_argument('-chunk_size', type=int, help='Number of codes the GPT emits per chunk.', default=16)
+    parser.add_argument('-window', type=int, help='Number of GPT latents decoded per diffusion window.', default=64)
+    parser.add_argument('-first_window', type=int, help='Size of the first window; lower values reduce latency to the first chunk.', default=32)
+    parser.add_argument('-overlap', type=int, help='Number of latents consecutive windows share.', default=8)
+    parser.add_argument('-temperature', type=float, default=.8)
+    parser.add_argument('-top_p', type=float, default=.8)
+    parser.add_argument('-repetition_penalty', type=float, default=2.0)
+    parser.add_argument('-device', type=str, help='Device to run on', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    print("Loading models..")
+    gpt = load_model_from_config(args.opt_gpt, args.gpt_name, also_load_savepoint=False, load_path=args.gpt_path, device=torch.device('cpu'))
+    gpt = gpt.to(device).eval()
+    diffusion = load_model_from_config(args.opt_diffusion, args.diffusion_name, also_load_savepoint=False, load_path=args.diffusion_path, device=torch.device('cpu'))
+    diffusion = diffusion.to(device).eval()
+    # The multistep solvers pick their own timesteps from the full schedule.
+    diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=4000 if args.sampler in SOLVERS else args.diffusion_steps,
+                                              schedule=args.diffusion_schedule, enable_conditioning_free_guidance=args.conditioning_free,
+                                              conditioning_free_k=args.conditioning_free_k)
+    sampling_fn = diffuser.get_sampling_fn(args.sampler, steps=args.diffusion_steps, order=args.solver_order, schedule=args.solver_schedule)
+    vocoder = load_univnet_vocoder().to(device)
+    tokenizer = VoiceBpeTokenizer(args.tokenizer)
+    conds = VoiceCache(gpt, 3, 132300, device).get(args.voice)
+
+    start = time()
+    # UnifiedVoice stores max_text_tokens with room for the start and stop tokens.
+    segments = [args.text] if gpt.max_text_tokens == -1 else split_text(tokenizer, args.text, gpt.max_text_tokens - 2)
+    texts = [torch.tensor(tokenizer.encode(segment), dtype=torch.long, device=device).unsqueeze(0) for segment in segments]
+    with torch.no_grad():
+        latent_chunks = (latents for text in texts for _, latents in gpt.inference_speech_stream(
+            None, text, chunk_size=args.chunk_size, temperature=args.temperature, top_p=args.top_p,
+            repetition_penalty=args.repetition_penalty, conditioning_latents=conds['latents']))
+        decoder = StreamingDecoder(diffusion, sampling_fn, vocoder, conds['diffusion_cond'], window=args.window,
+                                   overlap=args.overlap, first_window=args.first_window)
+        chunks = []
+        for wav in decoder.stream(latent_chunks):
+            if len(chunks) == 0:
+                print(f'First chunk ({wav.shape[-1] / OUTPUT_SAMPLE_RATE:.2f}s of audio) after {time() - start:.2f}s')
+            chunks.append(wav)
+    wav = torch.cat(chunks, dim=-1)
+    print(f'Generated {wav.shape[-1] / OUTPUT_SAMPLE_RATE:.2f}s of audio in {time() - start:.2f}s')
+    torchaudio.save(args.output, wav, OUTPUT_SAMPLE_RATE)
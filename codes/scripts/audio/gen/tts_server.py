@@ -0,0 +1,689 @@
+"""
+Long-lived TTS inference service. All models (autoregressive GPT, CLVP, diffusion decoder, UnivNet vocoder) are loaded
+once and kept resident. Requests flow through four stages, each running on its own thread and batching whatever work
+is queued for it:
+
+  gpt       - continuous batching: every request occupies one key/value cache slot per candidate. Requests join the
+              batch as soon as enough slots are free and leave it as soon as all of their candidates have finished, so
+              short and long requests never wait on each other.
+  rerank    - CLVP scores all candidates of the queued requests in one pass; the best candidate of each request is then
+              converted into GPT latents.
+  diffusion - converts latents into MEL spectrograms.
+  vocoder   - converts MELs into waveforms.
+
+Per-stage latency, queue and batch statistics are available from TtsServer.get_metrics() (GET /metrics over HTTP).
+
+Examples (run from codes/):
+  python scripts/audio/gen/tts_server.py -listen 127.0.0.1:8910 -device cpu
+  curl -d '{"text": "hello world", "voice": "D:\\voices\\simmons"}' 127.0.0.1:8910/tts > out.wav
+
+  echo '{"text": "hello world", "voice": "voices/simmons", "output": "out.wav"}' | python scripts/audio/gen/tts_server.py -stdin
+
+  python scripts/audio/gen/tts_server.py -smoke_test
+"""
+import argparse
+import io
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+
+import torch
+import torch.nn.functional as F
+import torchaudio
+
+from data.audio.unsupervised_audio_dataset import load_audio
+from data.audio.voice_tokenizer import VoiceBpeTokenizer
+from models.audio.tts.cached_gpt_sampler import KVCacheGPT2Decoder, SlottedKVCacheGPT2Decoder, process_logits
+from models.diffusion.multistep_solvers import SOLVERS
+from scripts.audio.gen.conditioning_cache import ConditioningCache, compute_voice_key, list_voice_clips
+from scripts.audio.gen.speech_synthesis_utils import load_clvp, load_univnet_vocoder, load_discrete_vocoder_diffuser, \
+    wav_to_mel, wav_to_univnet_mel
+from trainer.injectors.audio_injectors import denormalize_mel
+from utils.util import load_model_from_config, pad_or_truncate
+
+
+# MEL code the DVAE emits for silence. Generated codes are padded with it past the stop token (see
+# fix_autoregressive_output() in use_gpt_tts.py).
+CALM_TOKEN = 83
+GPT_SAMPLE_RATE = 22050
+OUTPUT_SAMPLE_RATE = 24000
+
+
+class TtsRequest:
+    def __init__(self, text, voice, num_candidates=16, temperature=.8, top_k=0, top_p=.8, repetition_penalty=2.0):
+        self.text = text
+        self.voice = voice
+        self.num_candidates = num_candidates
+        self.sampling = (temperature, top_k, top_p, repetition_penalty)
+        self.future = Future()
+        self.created = time()
+        self.enqueued = None
+        # Intermediate results, filled in by the stages.
+        self.text_tokens = None
+        self.gpt_conds = None
+        self.conditioning_latents = None
+        self.diffusion_cond = None
+        self.codes = None
+        self.latents = None
+        self.mel = None
+        self.output_frames = None
+
+
+class StageMetrics:
+    def __init__(self, inbox):
+        self.inbox = inbox
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.batches = 0
+        self.batch_items = 0
+        self.busy = 0
+        self.queue_wait = 0
+        self.latency = 0
+
+    def record_batch(self, size, elapsed):
+        with self.lock:
+            self.batches += 1
+            self.batch_items += size
+            self.busy += elapsed
+
+    def record_request(self, queue_wait, latency, failed=False):
+        with self.lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+                self.queue_wait += queue_wait
+                self.latency += latency
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'queued': self.inbox.qsize(),
+                'completed': self.completed,
+                'failed': self.failed,
+                'batches': self.batches,
+                'mean_batch_size': self.batch_items / max(self.batches, 1),
+                'busy_seconds': self.busy,
+                'mean_queue_wait': self.queue_wait / max(self.completed, 1),
+                'mean_latency': self.latency / max(self.completed, 1),
+            }
+
+
+class Stage(threading.Thread):
+    """
+    A pipeline stage that repeatedly takes up to <max_batch_size> queued requests, processes them together and hands
+    them to the next stage (or resolves their futures, for the last stage).
+    """
+    def __init__(self, name, max_batch_size):
+        super().__init__(name=name, daemon=True)
+        self.max_batch_size = max_batch_size
+        self.inbox = queue.Queue()
+        self.metrics = StageMetrics(self.inbox)
+        self.next_stage = None
+
+    def submit(self, request):
+        request.enqueued = time()
+        self.inbox.put(request)
+
+    def collect(self, block=True):
+        batch = []
+        try:
+            batch.append(self.inbox.get(block=block))
+            while len(batch) < self.max_batch_size:
+                batch.append(self.inbox.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def started(self, request):
+        request.started = time()
+
+    def finish(self, request):
+        now = time()
+        self.metrics.record_request(request.started - request.enqueued, now - request.enqueued)
+        if self.next_stage is not None:
+            self.next_stage.submit(request)
+        else:
+            request.future.set_result((request.wav, OUTPUT_SAMPLE_RATE))
+
+    def fail(self, request, e):
+        self.metrics.record_request(0, 0, failed=True)
+        if not request.future.done():
+            request.future.set_exception(e)
+
+    def process(self, batch):
+        raise NotImplementedError
+
+    def run(self):
+        with torch.no_grad():
+            while True:
+                batch = self.collect()
+                start = time()
+                for r in batch:
+                    self.started(r)
+                try:
+                    self.process(batch)
+                except Exception as e:
+                    for r in batch:
+                        self.fail(r, e)
+                    continue
+                self.metrics.record_batch(len(batch), time() - start)
+                for r in batch:
+                    self.finish(r)
+
+
+class GptStage(Stage):
+    """
+    Continuously batched autoregressive decoding. Each step decodes one token for every occupied cache slot; requests
+    are admitted whenever enough slots are free and retired as soon as all of their candidates emit the stop token.
+    """
+    def __init__(self, gpt, num_slots, device):
+        super().__init__('gpt', num_slots)
+        self.gpt = gpt
+        self.device = device
+        dtype = next(gpt.parameters()).dtype
+        self.decoder = SlottedKVCacheGPT2Decoder(gpt.gpt, num_slots, gpt.get_inference_sequence_length(), device, dtype)
+        self.hidden = torch.zeros((num_slots, gpt.model_dim), device=device, dtype=dtype)
+        self.seen = torch.zeros((num_slots, gpt.number_mel_codes), dtype=torch.bool, device=device)
+        self.generated = [0 for _ in range(num_slots)]
+        self.owners = {}
+        self.pending = None
+
+    def submit(self, request):
+        if request.num_candidates > self.decoder.num_slots:
+            request.future.set_exception(ValueError(f'At most {self.decoder.num_slots} candidates can be requested.'))
+            return
+        super().submit(request)
+
+    def admit(self, request):
+        self.started(request)
+        prefix, start_tokens = self.gpt.build_inference_prefix(request.gpt_conds, request.text_tokens, request.conditioning_latents)
+        request.max_new = self.gpt.get_max_generate_length(prefix.shape[1], start_tokens.shape[1])
+        if request.max_new <= 0:
+            raise ValueError('Text is too long for this model.')
+        prefix_decoder = KVCacheGPT2Decoder(self.gpt.gpt, 1, prefix.shape[1], self.device, prefix.dtype)
+        hidden = prefix_decoder.forward(prefix)[0, -1]
+        request.num_start_tokens = start_tokens.shape[1]
+        request.codes = [[] for _ in range(request.num_candidates)]
+        request.live = request.num_candidates
+        for c, slot in enumerate(self.decoder.insert(prefix_decoder, 0, request.num_candidates)):
+            self.hidden[slot] = hidden
+            self.seen[slot] = False
+            self.seen[slot, start_tokens[0]] = True
+            self.generated[slot] = 0
+            self.owners[slot] = (request, c)
+
+    def admit_waiting(self):
+        # Requests are admitted in arrival order, so a large request is never starved by smaller ones behind it.
+        while True:
+            if self.pending is None:
+                self.pending = self.collect_one(block=len(self.owners) == 0)
+                if self.pending is None:
+                    return
+            if self.pending.num_candidates > len(self.decoder.free_slots):
+                return
+            request, self.pending = self.pending, None
+            try:
+                self.admit(request)
+            except Exception as e:
+                self.fail(request, e)
+
+    def collect_one(self, block):
+        try:
+            return self.inbox.get(block=block)
+        except queue.Empty:
+            return None
+
+    def sample(self, slots):
+        idx = torch.tensor(slots, dtype=torch.long, device=self.device)
+        logits = self.gpt.mel_head(self.gpt.final_norm(self.hidden[idx]))
+        seen = self.seen[idx]
+        next_tokens = torch.empty((len(slots),), dtype=torch.long, device=self.device)
+        # Requests may use different sampling settings, so logit processors are applied per group of settings.
+        groups = {}
+        for row, slot in enumerate(slots):
+            groups.setdefault(self.owners[slot][0].sampling, []).append(row)
+        for (temperature, top_k, top_p, repetition_penalty), rows in groups.items():
+            rows = torch.tensor(rows, dtype=torch.long, device=self.device)
+            do_sample = temperature > 0
+            l = process_logits(logits[rows], seen[rows], temperature=temperature if do_sample else 1.0,
+                               top_k=top_k if do_sample else 0, top_p=top_p if do_sample else 1.0,
+                               repetition_penalty=repetition_penalty)
+            if do_sample:
+                next_tokens[rows] = torch.multinomial(l.softmax(dim=-1), num_samples=1).squeeze(1)
+            else:
+                next_tokens[rows] = l.argmax(dim=-1)
+        self.seen[idx, next_tokens] = True
+        return next_tokens
+
+    def step(self):
+        start = time()
+        slots = sorted(self.owners.keys())
+        next_tokens = self.sample(slots)
+        continuing = []
+        for row, token in enumerate(next_tokens.tolist()):
+            slot = slots[row]
+            request, c = self.owners[slot]
+            request.codes[c].append(token)
+            self.generated[slot] += 1
+            if token == self.gpt.stop_mel_token or self.generated[slot] >= request.max_new:
+                del self.owners[slot]
+                self.decoder.release([slot])
+                request.live -= 1
+                if request.live == 0:
+                    self.finish(request)
+            else:
+                continuing.append(row)
+        if len(continuing) > 0:
+            cslots = [slots[row] for row in continuing]
+            positions = torch.tensor([self.owners[s][0].num_start_tokens + self.generated[s] for s in cslots], dtype=torch.long, device=self.device)
+            tokens = next_tokens[torch.tensor(continuing, dtype=torch.long, device=self.device)]
+            emb = self.gpt.mel_embedding(tokens.unsqueeze(1)) + self.gpt.get_mel_position_embedding(positions)
+            self.hidden[torch.tensor(cslots, dtype=torch.long, device=self.device)] = self.decoder.forward(emb, cslots)[:, -1]
+        self.metrics.record_batch(len(slots), time() - start)
+
+    def run(self):
+        with torch.no_grad():
+            while True:
+                self.admit_waiting()
+                if len(self.owners) == 0:
+                    continue
+                try:
+                    self.step()
+                except Exception as e:
+                    # The cache state can no longer be trusted; fail everything that is in flight.
+                    for request, _ in list(self.owners.values()):
+                        self.fail(request, e)
+                    self.decoder.release(list(self.owners.keys()))
+                    self.owners = {}
+
+
+def fix_codes(codes, stop_token):
+    """ Replaces the stop token and everything after it with CALM_TOKEN, returning the codes and their length. """
+    codes = list(codes)
+    length = codes.index(stop_token) if stop_token in codes else len(codes)
+    return codes[:length] + [CALM_TOKEN] * (len(codes) - length), length
+
+
+class RerankStage(Stage):
+    """ Scores every candidate with CLVP, keeps the best one per request and converts it into GPT latents. """
+    def __init__(self, gpt, clvp, max_batch_size, device):
+        super().__init__('rerank', max_batch_size)
+        self.gpt = gpt
+        self.clvp = clvp
+        self.device = device
+
+    def process(self, batch):
+        texts, codes, lengths = [], [], []
+        for request in batch:
+            for c in request.codes:
+                fixed, length = fix_codes(c, self.gpt.stop_mel_token)
+                texts.append(request.text_tokens[0])
+                codes.append(torch.tensor(fixed, dtype=torch.long))
+                lengths.append(length)
+        max_text = max(t.shape[0] for t in texts)
+        max_codes = max(c.shape[0] for c in codes)
+        texts = torch.stack([F.pad(t, (0, max_text - t.shape[0])) for t in texts], dim=0)
+        codes = torch.stack([F.pad(c, (0, max_codes - c.shape[0]), value=CALM_TOKEN) for c in codes], dim=0).to(self.device)
+        scores = self.clvp(texts, codes, return_loss=False)
+
+        offset = 0
+        for request in batch:
+            best = offset + int(scores[offset:offset+request.num_candidates].argmax())
+            offset += request.num_candidates
+            length = max(lengths[best], 1)
+            best_codes = codes[best:best+1, :length]
+            # Latents are computed one request at a time: padding the text of a shorter request would change them.
+            wav_lengths = torch.tensor([length if self.gpt.tortoise_compat else length * self.gpt.mel_length_compression], device=self.device)
+            latents = self.gpt(request.gpt_conds, request.text_tokens,
+                               torch.tensor([request.text_tokens.shape[-1]], device=self.device), best_codes, wav_lengths,
+                               return_latent=True)
+            request.latents = latents[:, :length]
+            request.output_frames = length * 4 * OUTPUT_SAMPLE_RATE // GPT_SAMPLE_RATE
+
+
+class DiffusionStage(Stage):
+    """ Decodes the latents of a batch of requests into MEL spectrograms with a single sampling loop. """
+    def __init__(self, model, sampling_fn, max_batch_size, device):
+        super().__init__('diffusion', max_batch_size)
+        self.model = model
+        self.sampling_fn = sampling_fn
+        self.device = device
+
+    def pad_latents(self, latents, length):
+        gap = length - latents.shape[1]
+        if gap == 0:
+            return latents
+        # Prefer the padding embedding the model learned for exactly this purpose (see fix_alignment()).
+        padding = getattr(self.model, 'aligned_latent_padding_embedding', None)
+        if padding is not None:
+            return torch.cat([latents, padding.permute(0, 2, 1).repeat(latents.shape[0], gap, 1)], dim=1)
+        return F.pad(latents, (0, 0, 0, gap))
+
+    def process(self, batch):
+        max_latents = max(r.latents.shape[1] for r in batch)
+        latents = torch.cat([self.pad_latents(r.latents, max_latents) for r in batch], dim=0)
+        conds = torch.cat([r.diffusion_cond for r in batch], dim=0)
+        frames = max(r.output_frames for r in batch)
+        mel = self.sampling_fn(self.model, (len(batch), conds.shape[1], frames),
+                               model_kwargs={'aligned_conditioning': latents, 'conditioning_input': conds})
+        mel = denormalize_mel(mel)
+        for i, request in enumerate(batch):
+            request.mel = mel[i:i+1, :, :request.output_frames]
+
+
+class VocoderStage(Stage):
+    def __init__(self, vocoder, max_batch_size, device):
+        super().__init__('vocoder', max_batch_size)
+        self.vocoder = vocoder
+        self.device = device
+
+    def process(self, batch):
+        frames = max(r.mel.shape[-1] for r in batch)
+        # The vocoder pads with the MEL value of silence internally; do the same for shorter members of the batch.
+        mels = torch.cat([F.pad(r.mel, (0, frames - r.mel.shape[-1]), value=-11.5129) for r in batch], dim=0)
+        wavs = self.vocoder.inference(mels)
+        hop = wavs.shape[-1] // frames
+        for i, request in enumerate(batch):
+            request.wav = wavs[i, :, :request.mel.shape[-1] * hop].clamp(-1, 1).cpu()
+
+
+class VoiceCache:
+    """
+    Conditioning inputs for recently used voices, so that repeated requests do not re-read and re-encode clips. Voices
+    are kept in memory (up to <max_voices>) and, if a ConditioningCache is given, on disk across restarts. Concurrent
+    requests for a voice that is not cached wait for a single load rather than each loading it.
+    """
+    def __init__(self, gpt, num_clips, cond_samples, device, max_voices=64, disk_cache=None, checkpoint=None):
+        self.gpt = gpt
+        self.num_clips = num_clips
+        self.cond_samples = cond_samples
+        self.device = device
+        self.max_voices = max_voices
+        self.disk_cache = disk_cache
+        self.checkpoint = checkpoint
+        self.voices = OrderedDict()
+        self.lock = threading.Lock()
+        self.voice_locks = {}  # Held while a voice is being loaded.
+
+    def load(self, voice):
+        clips = list_voice_clips(voice)
+        if len(clips) == 0:
+            raise ValueError(f'No audio clips found for voice {voice}')
+        gpt_conds = []
+        for k in range(self.num_clips):
+            wav = pad_or_truncate(load_audio(clips[k % len(clips)], GPT_SAMPLE_RATE), self.cond_samples)
+            gpt_conds.append(wav_to_mel(wav.unsqueeze(0)).squeeze(0))
+        gpt_conds = torch.stack(gpt_conds, dim=0).unsqueeze(0).to(self.device)
+        wav = torchaudio.functional.resample(load_audio(clips[0], GPT_SAMPLE_RATE), GPT_SAMPLE_RATE, OUTPUT_SAMPLE_RATE)
+        wav = pad_or_truncate(wav, self.cond_samples * OUTPUT_SAMPLE_RATE // GPT_SAMPLE_RATE)
+        diffusion_cond = wav_to_univnet_mel(wav.unsqueeze(0), do_normalization=False).to(self.device)
+        return {'gpt_conds': gpt_conds, 'diffusion_cond': diffusion_cond, 'latents': self.gpt.get_conditioning_latents(gpt_conds)}
+
+    def lookup(self, voice):
+        with self.lock:
+            if voice in self.voices.keys():
+                self.voices.move_to_end(voice)
+                return self.voices[voice]
+            return None
+
+    def get(self, voice):
+        conds = self.lookup(voice)
+        if conds is not None:
+            return conds
+        with self.lock:
+            voice_lock = self.voice_locks.setdefault(voice, threading.Lock())
+        with voice_lock:
+            # Another request may have loaded the voice while this one waited.
+            conds = self.lookup(voice)
+            if conds is not None:
+                return conds
+            with torch.no_grad():
+                if self.disk_cache is not None:
+                    key = compute_voice_key(voice, self.checkpoint, num_clips=self.num_clips, cond_samples=self.cond_samples)
+                    conds = self.disk_cache.get_or_compute(key, lambda: self.load(voice))
+                    conds = {k: v.to(self.device) for k, v in conds.items()}
+                else:
+                    conds = self.load(voice)
+            with self.lock:
+                self.voices[voice] = conds
+                while len(self.voices) > self.max_voices:
+                    self.voices.popitem(last=False)
+                del self.voice_locks[voice]
+        return conds
+
+
+class TtsServer:
+    """
+    <sampling_fn> is the diffusion sampling loop, called like GaussianDiffusion.p_sample_loop(); see
+    GaussianDiffusion.get_sampling_fn().
+    """
+    def __init__(self, gpt, clvp, diffusion, sampling_fn, vocoder, tokenizer, device, gpt_slots=32, rerank_batch_size=4,
+                 diffusion_batch_size=4, vocoder_batch_size=8, cond_clips=3, cond_samples=132300, max_voices=64,
+                 conditioning_cache=None, gpt_checkpoint=None):
+        self.tokenizer = tokenizer
+        self.device = device
+        self.voices = VoiceCache(gpt, cond_clips, cond_samples, device, max_voices, conditioning_cache, gpt_checkpoint)
+        self.stages = [GptStage(gpt, gpt_slots, device),
+                       RerankStage(gpt, clvp, rerank_batch_size, device),
+                       DiffusionStage(diffusion, sampling_fn, diffusion_batch_size, device),
+                       VocoderStage(vocoder, vocoder_batch_size, device)]
+        for s, n in zip(self.stages[:-1], self.stages[1:]):
+            s.next_stage = n
+        for s in self.stages:
+            s.start()
+
+    def submit(self, text, voice, **sampling):
+        """ Queues a request and returns its TtsRequest; request.future resolves to (wav, sample_rate). """
+        request = TtsRequest(text, voice, **sampling)
+        try:
+            conds = self.voices.get(voice)
+            request.gpt_conds, request.diffusion_cond, request.conditioning_latents = conds['gpt_conds'], conds['diffusion_cond'], conds['latents']
+            request.text_tokens = torch.tensor(self.tokenizer.encode(text), dtype=torch.long, device=self.device).unsqueeze(0)
+        except Exception as e:
+            request.future.set_exception(e)
+            return request
+        request.future.add_done_callback(lambda f: setattr(request, 'finished', time()))
+        self.stages[0].submit(request)
+        return request
+
+    def get_metrics(self):
+        metrics = {s.name: s.metrics.snapshot() for s in self.stages}
+        gpt = self.stages[0]
+        metrics['gpt']['active_slots'] = gpt.decoder.num_slots - len(gpt.decoder.free_slots)
+        metrics['gpt']['free_slots'] = len(gpt.decoder.free_slots)
+        metrics['voices_cached'] = len(self.voices.voices)
+        return metrics
+
+
+REQUEST_PARAMS = {'candidates': 'num_candidates', 'temperature': 'temperature', 'top_k': 'top_k', 'top_p': 'top_p',
+                  'repetition_penalty': 'repetition_penalty'}
+
+
+def parse_request(spec):
+    return spec['text'], spec['voice'], {v: spec[k] for k, v in REQUEST_PARAMS.items() if k in spec.keys()}
+
+
+def make_http_handler(tts):
+    class TtsHttpHandler(BaseHTTPRequestHandler):
+        def send(self, code, body, content_type='application/json'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.send(200, json.dumps(tts.get_metrics()).encode('utf-8'))
+            else:
+                self.send(404, b'{}')
+
+        def do_POST(self):
+            if self.path != '/tts':
+                self.send(404, b'{}')
+                return
+            try:
+                spec = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                text, voice, sampling = parse_request(spec)
+            except Exception as e:
+                self.send(400, json.dumps({'error': str(e)}).encode('utf-8'))
+                return
+            try:
+                wav, sr = tts.submit(text, voice, **sampling).future.result()
+            except Exception as e:
+                self.send(500, json.dumps({'error': str(e)}).encode('utf-8'))
+                return
+            buf = io.BytesIO()
+            torchaudio.save(buf, wav, sr, format='wav')
+            self.send(200, buf.getvalue(), content_type='audio/wav')
+
+    return TtsHttpHandler
+
+
+def serve_stdin(tts):
+    """
+    Reads one JSON request per line ({"text", "voice", "output", [sampling params]}) and writes one JSON result line per
+    completed request. Requests are processed concurrently; a line reading "metrics" prints the current metrics.
+    """
+    print_lock = threading.Lock()
+
+    def emit(obj):
+        with print_lock:
+            print(json.dumps(obj), flush=True)
+
+    def done(spec, request, future):
+        try:
+            wav, sr = future.result()
+            torchaudio.save(spec['output'], wav, sr)
+            emit({'output': spec['output'], 'seconds': request.finished - request.created})
+        except Exception as e:
+            emit({'output': spec.get('output', None), 'error': str(e)})
+
+    futures = []
+    for line in sys.stdin:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        if line == 'metrics':
+            emit(tts.get_metrics())
+            continue
+        try:
+            spec = json.loads(line)
+            text, voice, sampling = parse_request(spec)
+        except Exception as e:
+            emit({'error': str(e)})
+            continue
+        request = tts.submit(text, voice, **sampling)
+        request.future.add_done_callback(lambda f, s=spec, r=request: done(s, r, f))
+        futures.append(request.future)
+    for f in futures:
+        try:
+            f.result()
+        except Exception:
+            pass
+    emit(tts.get_metrics())
+
+
+def run_smoke_test(tokenizer, device=torch.device('cpu')):
+    """
+    Pushes concurrent requests through a server built from small, randomly initialized models and checks that every
+    one of them produces audio. Needs no checkpoints, so it exercises the whole pipeline on the CPU.
+    """
+    from models.audio.tts.unet_diffusion_tts_flat import DiffusionTtsFlat
+    from models.audio.tts.unified_voice2 import UnifiedVoice
+    from models.audio.vocoders.univnet.generator import UnivNetGenerator
+    from models.clip.text_voice_clip import VoiceCLIP
+
+    torch.manual_seed(0)
+    gpt = UnifiedVoice(layers=2, model_dim=128, heads=4, max_text_tokens=64, max_mel_tokens=24, max_conditioning_inputs=2,
+                       checkpointing=False).to(device).eval()
+    clvp = VoiceCLIP(dim_text=64, dim_speech=64, dim_latent=64, text_enc_depth=1, text_heads=2, speech_enc_depth=1,
+                     speech_heads=2, num_speech_tokens=gpt.number_mel_codes).to(device).eval()
+    diffusion = DiffusionTtsFlat(model_channels=128, num_layers=2, in_latent_channels=128, num_heads=4, layer_drop=0,
+                                 unconditioned_percentage=0).to(device).eval()
+    sampling_fn = load_discrete_vocoder_diffuser(desired_diffusion_steps=4).get_sampling_fn('p', steps=4)
+    vocoder = UnivNetGenerator().to(device)
+    vocoder.eval(inference=True)
+    tts = TtsServer(gpt, clvp, diffusion, sampling_fn, vocoder, tokenizer, device, gpt_slots=6, rerank_batch_size=2,
+                    diffusion_batch_size=2, vocoder_batch_size=2, cond_clips=2, cond_samples=GPT_SAMPLE_RATE)
+
+    with tempfile.TemporaryDirectory() as voice:
+        for k in range(2):
+            torchaudio.save(os.path.join(voice, f'{k}.wav'), torch.rand(1, GPT_SAMPLE_RATE) * .2 - .1, GPT_SAMPLE_RATE)
+        requests = [tts.submit(text, voice, num_candidates=2)
+                    for text in ['hello world', 'the quick brown fox', 'a slightly longer sentence than the others']]
+        for request in requests:
+            wav, sr = request.future.result(timeout=600)
+            assert sr == OUTPUT_SAMPLE_RATE and wav.shape[0] == 1 and wav.shape[-1] > 0 and torch.isfinite(wav).all()
+            print(f'{request.text!r}: {wav.shape[-1] / sr:.2f}s of audio after {time() - request.created:.2f}s')
+    print(json.dumps(tts.get_metrics(), indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt_gpt', type=str, help='Path to options YAML file used to train the GPT-TTS model', default='../experiments/train_gpt_tts_unified.yml')
+    parser.add_argument('-gpt_name', type=str, help='Name of the GPT TTS model in opt.', default='gpt')
+    parser.add_argument('-gpt_path', type=str, help='GPT TTS model checkpoint to load.', default='../experiments/tortoise_ar.pth')
+    parser.add_argument('-opt_diffusion', type=str, help='Path to options YAML file used to train the diffusion model', default='../experiments/train_diffusion_tts9_mel.yml')
+    parser.add_argument('-diffusion_name', type=str, help='Name of the diffusion model in opt.', default='generator')
+    parser.add_argument('-diffusion_path', type=str, help='Diffusion model checkpoint to load.', default='../experiments/tortoise_diffusion.pth')
+    parser.add_argument('-diffusion_steps', type=int, help='Number of diffusion steps to perform per request.', default=50)
+    parser.add_argument('-sampler', type=str, help='Diffusion sampler: p, ddim or one of the multistep solvers (dpm++, unipc), which need far fewer steps (10-25).', default='p')
+    parser.add_argument('-solver_order', type=int, help='Order of the multistep solvers.', default=2)
+    parser.add_argument('-solver_schedule', type=str, help='Timestep schedule of the multistep solvers: karras, logsnr or uniform.', default='karras')
+    parser.add_argument('-diffusion_schedule', type=str, help='Beta schedule the diffusion model was trained with.', default='linear')
+    parser.add_argument('-conditioning_free', action='store_true', help='Enable conditioning-free guidance during diffusion.')
+    parser.add_argument('-conditioning_free_k', type=float, help='Conditioning-free guidance strength.', default=2)
+    parser.add_argument('-tokenizer', type=str, help='BPE vocab file for the text.', default='../experiments/bpe_lowercase_asr_256.json')
+    parser.add_argument('-gpt_slots', type=int, help='Number of sequences (across all requests) decoded concurrently by the GPT.', default=32)
+    parser.add_argument('-rerank_batch_size', type=int, help='Max requests reranked together.', default=4)
+    parser.add_argument('-diffusion_batch_size', type=int, help='Max requests diffused together.', default=4)
+    parser.add_argument('-vocoder_batch_size', type=int, help='Max requests vocoded together.', default=8)
+    parser.add_argument('-max_voices', type=int, help='Number of voices whose conditioning inputs stay cached.', default=64)
+    parser.add_argument('-conditioning_cache', type=str, help='Directory in which conditioning inputs of voices are persisted across restarts.', default=None)
+    parser.add_argument('-conditioning_cache_gb', type=float, help='Size budget of the conditioning cache.', default=1)
+    parser.add_argument('-device', type=str, help='Device to run on', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('-listen', type=str, help='host:port to serve HTTP on.', default='127.0.0.1:8910')
+    parser.add_argument('-stdin', action='store_true', help='Read requests from stdin instead of serving HTTP.')
+    parser.add_argument('-smoke_test', action='store_true', help='Run a few requests through small, randomly initialized models on the CPU and exit.')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    if args.smoke_test:
+        run_smoke_test(VoiceBpeTokenizer(args.tokenizer))
+        sys.exit(0)
+
+    print("Loading models..")
+    gpt = load_model_from_config(args.opt_gpt, args.gpt_name, also_load_savepoint=False, load_path=args.gpt_path, device=torch.device('cpu'))
+    gpt = gpt.to(device).eval()
+    clvp = load_clvp().to(device).eval()
+    diffusion = load_model_from_config(args.opt_diffusion, args.diffusion_name, also_load_savepoint=False, load_path=args.diffusion_path, device=torch.device('cpu'))
+    diffusion = diffusion.to(device).eval()
+    # The multistep solvers pick their own timesteps from the full schedule.
+    diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=4000 if args.sampler in SOLVERS else args.diffusion_steps,
+                                              schedule=args.diffusion_schedule, enable_conditioning_free_guidance=args.conditioning_free,
+                                              conditioning_free_k=args.conditioning_free_k)
+    sampling_fn = diffuser.get_sampling_fn(args.sampler, steps=args.diffusion_steps, order=args.solver_order, schedule=args.solver_schedule)
+    vocoder = load_univnet_vocoder().to(device)
+    tts = TtsServer(gpt, clvp, diffusion, sampling_fn, vocoder, VoiceBpeTokenizer(args.tokenizer), device,
+                    gpt_slots=args.gpt_slots, rerank_batch_size=args.rerank_batch_size,
+                    diffusion_batch_size=args.diffusion_batch_size, vocoder_batch_size=args.vocoder_batch_size,
+                    max_voices=args.max_voices, gpt_checkpoint=args.gpt_path,
+                    conditioning_cache=None if args.conditioning_cache is None else
+                    ConditioningCache(args.conditioning_cache, int(args.conditioning_cache_gb * (1 << 30))))
+
+    if args.stdin:
+        serve_stdin(tts)
+    else:
+        host, port = args.listen.rsplit(':', 1)
+        print(f"Serving on http://{host}:{port} (POST /tts, GET /metrics)")
+        ThreadingHTTPServer((host, int(port)), make_http_handler(tts)).serve_forever()
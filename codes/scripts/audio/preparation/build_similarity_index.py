@@ -0,0 +1,20 @@
+"""
+Consolidates the similarities.pth files produced by phase_3_generate_similarities.py into a single index. Point the
+`similarity_index` option of an audio dataset at the output to avoid per-directory table loads during training.
+
+Example:
+  python scripts/audio/preparation/build_similarity_index.py -path Y:/clips/books1 Y:/clips/books2 -output Y:/clips/similarities_index.pth
+"""
+import argparse
+
+from data.audio.unsupervised_audio_dataset import build_similarity_index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-path', type=str, nargs='+', help='Root path(s) to search for similarities.pth files from', required=True)
+    parser.add_argument('-output', type=str, help='Where to save the consolidated index', required=True)
+    args = parser.parse_args()
+
+    index = build_similarity_index(args.path, args.output)
+    print(f'Indexed similarities for {len(index)} directories.')
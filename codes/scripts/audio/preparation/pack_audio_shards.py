@@ -0,0 +1,62 @@
+"""
+Packs the audio referenced by a TSV file, an LJSpeech-style list or a directory into a few large shards of
+pre-resampled int16 PCM (see data/audio/audio_shards.py). Point any of paired_voice_audio, fast_paired_voice_audio or
+unsupervised_audio datasets at the output with the `audio_shards` option to read clips from the shards instead of
+decoding the loose files.
+
+Example:
+  python scripts/audio/preparation/pack_audio_shards.py -input Y:/libritts/train-clean-100/transcribed-oco.tsv -mode tsv -output Y:/shards/libritts-100
+"""
+import argparse
+from multiprocessing.pool import ThreadPool
+
+from tqdm import tqdm
+
+from data.audio.audio_shards import AudioShardWriter
+from data.audio.paired_voice_audio_dataset import load_tsv
+from data.audio.unsupervised_audio_dataset import load_audio
+from data.util import find_audio_files
+from models.audio.tts.tacotron2 import load_filepaths_and_text
+
+
+def gather_paths(input, mode):
+    if mode == 'tsv':
+        return [apt[0] for apt in load_tsv(input)]
+    elif mode == 'lj':
+        return [apt[0] for apt in load_filepaths_and_text(input)]
+    elif mode == 'dir':
+        return find_audio_files(input, include_nonwav=True)
+    else:
+        raise NotImplementedError(mode)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-input', type=str, help='TSV file, LJSpeech-style list or directory of audio files.', required=True)
+    parser.add_argument('-mode', type=str, help='One of tsv, lj or dir.', default='tsv')
+    parser.add_argument('-output', type=str, help='Directory to write shards into.', required=True)
+    parser.add_argument('-sample_rate', type=int, default=22050)
+    parser.add_argument('-shard_size_gb', type=float, default=2)
+    parser.add_argument('-num_threads', type=int, default=8)
+    args = parser.parse_args()
+
+    writer = AudioShardWriter(args.output, args.sample_rate, max_shard_bytes=int(args.shard_size_gb * (1 << 30)))
+    paths = [p for p in gather_paths(args.input, args.mode) if p not in writer]
+    print(f'Packing {len(paths)} clips..')
+
+    def load(path):
+        try:
+            return path, load_audio(path, args.sample_rate)
+        except:
+            print(f'Error loading {path}. Skipping.')
+            return path, None
+
+    with ThreadPool(args.num_threads) as pool:
+        for path, audio in tqdm(pool.imap(load, paths), total=len(paths)):
+            if audio is not None:
+                writer.add(path, audio)
+    writer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Precomputes the MEL spectrograms and DVAE codes that the GPT training recipe (utils/BASE_gpt.yaml) otherwise derives
+every step with the torch_mel_spectrogram, for_each and discrete_token injectors. The output is a sharded cache that
+paired_voice_audio datasets can read by setting `precomputed_cache` to the directory printed by this script.
+
+Example:
+  python scripts/audio/preparation/precompute_gpt_cache.py -opt ../experiments/EXAMPLE_gpt.yml -output ../experiments/gpt_cache
+
+Once built, the training config replaces the three injectors with the dataset outputs:
+  datasets.train.precomputed_cache: <printed directory>
+  gpt in: [conditioning_mel, padded_text, text_lengths, mel_codes, wav_lengths]
+"""
+import argparse
+import os
+from multiprocessing.pool import ThreadPool
+
+import torch
+import torch.nn.functional as F
+import yaml
+from tqdm import tqdm
+
+from data.audio.precomputed_clip_cache import PrecomputedClipCacheWriter, compute_cache_signature, hash_file
+from data.audio.unsupervised_audio_dataset import load_audio, get_similar_clip_candidates
+from trainer.injectors.audio_injectors import TorchMelSpectrogramInjector
+from utils.options import Loader
+from utils.util import load_model_from_config
+
+
+def gather_clip_paths(dataset_opt):
+    from data import create_dataset
+    dataset_opt = dict(dataset_opt)
+    dataset_opt.pop('precomputed_cache', None)
+    ds = create_dataset(dataset_opt)
+    paths = set(apt[0] for apt in ds.audiopaths_and_text)
+    if ds.load_conditioning:
+        # Conditioning clips are drawn from similar clips, which are not necessarily part of the dataset itself.
+        for p in list(paths):
+            try:
+                paths.update(get_similar_clip_candidates(p))
+            except:
+                pass
+    return sorted(paths)
+
+
+def load_clip(path, sample_rate, hop_length, compression):
+    try:
+        clip_hash = hash_file(path)
+        wav = load_audio(path, sample_rate)
+    except:
+        print(f'Error loading {path}. Skipping.')
+        return None
+    # Pad so that the MEL has a multiple of <compression> frames, mirroring how max_wav_length is chosen for training.
+    padded_len = ((wav.shape[-1] + 1 + hop_length * compression - 1) // (hop_length * compression)) * hop_length * compression - 1
+    return path, clip_hash, wav.shape[-1], F.pad(wav, (0, padded_len - wav.shape[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-opt', type=str, help='Training config containing paired_voice_audio datasets to precompute.', required=True)
+    parser.add_argument('-output', type=str, help='Root directory of the cache.', required=True)
+    parser.add_argument('-dvae_config', type=str, default='../experiments/train_diffusion_vocoder_22k_level.yml')
+    parser.add_argument('-dvae_name', type=str, default='dvae')
+    parser.add_argument('-mel_norm_file', type=str, default='../experiments/clips_mel_norms.pth')
+    parser.add_argument('-batch_size', type=int, default=32)
+    parser.add_argument('-clips_per_shard', type=int, default=4096)
+    parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    with open(args.opt, mode='r') as f:
+        opt = yaml.load(f, Loader=Loader)
+    with open(args.dvae_config, mode='r') as f:
+        dvae_opt = yaml.load(f, Loader=Loader)
+    hop_length, compression = 256, 4
+
+    signature = compute_cache_signature(dvae_opt['path'][f'pretrain_model_{args.dvae_name}'], args.mel_norm_file,
+                                        hop_length=hop_length, n_fft=1024, n_mels=80)
+    cache_dir = os.path.join(args.output, signature)
+    mel_inj = TorchMelSpectrogramInjector({'in': 'wav', 'out': 'mel', 'mel_norm_file': args.mel_norm_file}, {})
+    dvae = load_model_from_config(preloaded_options=dvae_opt, model_name=args.dvae_name).to(args.device).eval()
+    silence_frame = mel_inj({'wav': torch.zeros(1, hop_length * compression)})['mel'][0, :, 0]
+    writer = PrecomputedClipCacheWriter(cache_dir, signature, silence_frame, clips_per_shard=args.clips_per_shard)
+
+    for phase, dataset_opt in opt['datasets'].items():
+        if dataset_opt['mode'] != 'paired_voice_audio':
+            print(f'Skipping dataset {phase}: only paired_voice_audio datasets can be precomputed.')
+            continue
+        paths = [p for p in gather_clip_paths(dataset_opt) if not writer.is_cached(p)]
+        print(f'Precomputing {len(paths)} clips for dataset {phase}..')
+        sample_rate = dataset_opt['sample_rate']
+        with ThreadPool(8) as pool, torch.no_grad():
+            batch = []
+            loaded = pool.imap(lambda p: load_clip(p, sample_rate, hop_length, compression), paths)
+            for clip in tqdm(loaded, total=len(paths)):
+                if clip is not None:
+                    path, clip_hash, _, _ = clip
+                    if writer.contains_hash(clip_hash):
+                        writer.add_path(path, clip_hash)
+                    else:
+                        batch.append(clip)
+                if len(batch) == args.batch_size:
+                    process_batch(batch, mel_inj, dvae, writer, args.device, compression)
+                    batch = []
+            if len(batch) > 0:
+                process_batch(batch, mel_inj, dvae, writer, args.device, compression)
+    writer.close()
+    print(f'Cache written to {cache_dir}')
+
+
+def process_batch(batch, mel_inj, dvae, writer, device, compression):
+    max_len = max(c[3].shape[-1] for c in batch)
+    wavs = torch.stack([F.pad(c[3], (0, max_len - c[3].shape[-1])) for c in batch], dim=0).to(device)
+    mels = mel_inj({'wav': wavs})['mel']
+    codes = dvae.get_codebook_indices(mels)
+    for i, (path, clip_hash, wav_length, padded_wav) in enumerate(batch):
+        frames = padded_wav.shape[-1] // mel_inj.hop_length + 1
+        writer.add(path, clip_hash, mels[i, :, :frames], codes[i, :frames // compression], wav_length)
+
+
+if __name__ == '__main__':
+    main()
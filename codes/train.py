@@ -13,12 +13,13 @@ from data.data_sampler import DistIterSampler
 from trainer.eval.evaluator import create_evaluator
 
 from utils import util, options as option
-from data import create_dataloader, create_dataset, get_dataset_debugger
+from data import create_dataloader, create_dataset, get_dataset_debugger, create_length_bucketed_sampler
 from trainer.ExtensibleTrainer import ExtensibleTrainer
 from time import time
 from datetime import datetime
 
 from utils.util import opt_get, map_cuda_to_correct_device
+from utils.loss_accumulator import metrics_to_cpu
 
 
 def init_dist(backend, **kwargs):
@@ -119,14 +120,22 @@ class Trainer:
                 train_size = int(math.ceil(len(self.train_set) / dataset_opt['batch_size']))
                 total_iters = int(opt['train']['niter'])
                 self.total_epochs = int(math.ceil(total_iters / train_size))
-                if opt['dist']:
+                batch_sampler = None
+                if 'length_bucketing' in dataset_opt.keys():
+                    self.train_sampler = batch_sampler = create_length_bucketed_sampler(self.train_set, dataset_opt,
+                                                    self.world_size if opt['dist'] else 1, max(self.rank, 0))
+                    train_size = len(batch_sampler)
+                    self.total_epochs = int(math.ceil(total_iters / train_size))
+                    shuffle = False
+                elif opt['dist']:
                     self.train_sampler = DistIterSampler(self.train_set, self.world_size, self.rank, dataset_ratio)
                     self.total_epochs = int(math.ceil(total_iters / (train_size * dataset_ratio)))
                     shuffle = False
                 else:
                     self.train_sampler = None
                     shuffle = True
-                self.train_loader = create_dataloader(self.train_set, dataset_opt, opt, self.train_sampler, collate_fn=collate_fn, shuffle=shuffle)
+                self.train_loader = create_dataloader(self.train_set, dataset_opt, opt, self.train_sampler if batch_sampler is None else None,
+                                                      collate_fn=collate_fn, shuffle=shuffle, batch_sampler=batch_sampler)
                 if self.rank <= 0:
                     self.logger.info('Number of training data elements: {:,d}, iters: {:,d}'.format(
                         len(self.train_set), train_size))
@@ -209,7 +218,20 @@ class Trainer:
             print("Update LR: %f" % (time() - _t))
         _t = time()
         self.model.feed_data(train_data, self.current_step)
-        gradient_norms_dict = self.model.optimize_parameters(self.current_step, return_grad_norms=will_log)
+        retry = False
+        try:
+            gradient_norms_dict = self.model.optimize_parameters(self.current_step, return_grad_norms=will_log)
+        except Exception as e:
+            if not self.model.empty_cache_policy.should_retry(e):
+                raise
+            retry = True
+        # Retried outside of the except block: the traceback references the failed step's activations until then.
+        if retry:
+            self.logger.info('Ran out of GPU memory. Emptying the CUDA cache and retrying the step.')
+            self.model.discard_step_metrics()
+            self.model.feed_data(train_data, self.current_step)
+            self.model.empty_cache_policy.before_retry()
+            gradient_norms_dict = self.model.optimize_parameters(self.current_step, return_grad_norms=will_log)
         iteration_rate = (time() - _t) / batch_size
         if self._profile:
             print("Model feed + step: %f" % (time() - _t))
@@ -230,6 +252,8 @@ class Trainer:
             if self.dataset_debugger is not None:
                 logs.update(self.dataset_debugger.get_debugging_map())
             logs.update(gradient_norms_dict)
+            # Fetch every metric still on the GPU at once, rather than syncing with it once per metric.
+            logs = metrics_to_cpu(logs)
             message = '[epoch:{:3d}, iter:{:8,d}, lr:('.format(self.epoch, self.current_step)
             for v in self.model.get_current_learning_rate():
                 message += '{:.3e},'.format(v)
@@ -267,6 +291,15 @@ class Trainer:
                 else:
                     self.logger.info('Saving model.')
 
+                self.model.save(self.current_step)
+                state = {'epoch': self.epoch, 'iter': self.current_step, 'total_data_processed': self.total_training_data_encountered}
+                if self.dataset_debugger is not None:
+                    state['dataset_debugger_state'] = self.dataset_debugger.get_state()
+                if opt['logger']['disable_state_saving'] is False:
+                    self.model.save_training_state(state)
+                else:
+                    self.logger.info("State saving is disabled. Skipping state save, you won't be able to resume training from this session.")
+
                 if opt['upgrades']['number_of_checkpoints_to_save'] > 0 or \
                         opt['upgrades']['number_of_states_to_save'] > 0:
 
@@ -277,20 +310,13 @@ class Trainer:
                         f"Leaving only {opt['upgrades']['number_of_checkpoints_to_save']} checkpoints and "
                         f"{number_of_states_to_save} states"
                     )
-                    self.model.limit_number_of_checkpoints_and_states(
-                        next(iter(opt['networks'].keys())),
+                    # Prune only once the checkpoints above are on disk, so a failed write never costs an older one.
+                    network_name = next(iter(opt['networks'].keys()))
+                    self.model.after_checkpoints_written(lambda: self.model.limit_number_of_checkpoints_and_states(
+                        network_name,
                         models_number=opt['upgrades']['number_of_checkpoints_to_save'],
                         state_number=opt['upgrades']['number_of_states_to_save'],
-                    )
-
-                self.model.save(self.current_step)
-                state = {'epoch': self.epoch, 'iter': self.current_step, 'total_data_processed': self.total_training_data_encountered}
-                if self.dataset_debugger is not None:
-                    state['dataset_debugger_state'] = self.dataset_debugger.get_state()
-                if opt['logger']['disable_state_saving'] is False:
-                    self.model.save_training_state(state)
-                else:
-                    self.logger.info("State saving is disabled. Skipping state save, you won't be able to resume training from this session.")
+                    ))
             if 'alt_path' in opt['path'].keys():
                 import shutil
                 print("Synchronizing tb_logger to alt_path..")
@@ -344,7 +370,7 @@ class Trainer:
         self.logger.info('Start training from epoch: {:d}, iter: {:d}'.format(self.start_epoch, self.current_step))
         for epoch in range(self.start_epoch, self.total_epochs + 1):
             self.epoch = epoch
-            if self.opt['dist']:
+            if self.train_sampler is not None:
                 self.train_sampler.set_epoch(epoch)
 
             tq_ldr = tqdm(self.train_loader) if self.rank <= 0 else self.train_loader
@@ -352,12 +378,13 @@ class Trainer:
             _t = time()
             for train_data in tq_ldr:
                 self.do_step(train_data)
+        self.model.flush_checkpoints()
 
     def create_training_generator(self, index):
         self.logger.info('Start training from epoch: {:d}, iter: {:d}'.format(self.start_epoch, self.current_step))
         for epoch in range(self.start_epoch, self.total_epochs + 1):
             self.epoch = epoch
-            if self.opt['dist']:
+            if self.train_sampler is not None:
                 self.train_sampler.set_epoch(epoch)
             tq_ldr = tqdm(self.train_loader, position=index)
 
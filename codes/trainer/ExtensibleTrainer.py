@@ -14,13 +14,17 @@ import trainer.lr_scheduler as lr_scheduler
 import trainer.networks as networks
 from trainer.base_model import BaseModel
 from trainer.batch_size_optimizer import create_batch_size_optimizer
+from trainer.cpu_ema import CpuEma
 from trainer.inject import create_injector
 from trainer.injectors.audio_injectors import normalize_mel
+from trainer.memory_planning import EmptyCachePolicy, create_allocator, estimate_optimizer_state_bytes, plan_batch_factor
+from trainer.micro_batching import partition_by_padded_cost
 from trainer.steps import ConfigurableStep
 from trainer.experiments.experiments import get_experiment_for_name
 import torchvision.utils as utils
 
 from utils.loss_accumulator import LossAccumulator, InfStorageLossAccumulator
+from utils.multi_tensor import ema_update_, fan_in_grad_scales, grad_norm, scale_tensors_
 from utils.util import opt_get, denormalize
 
 from typing import Literal, Union
@@ -64,11 +68,30 @@ class ExtensibleTrainer(BaseModel):
             # It does come at the cost of a round trip to CPU memory at every batch.
             self.do_emas = opt_get(train_opt, ['ema_enabled'], True)
             self.ema_on_cpu = opt_get(train_opt, ['ema_on_cpu'], False)
+            # Under DDP, splits CPU EMAs across ranks rather than keeping a full copy on each. See CpuEma.
+            self.ema_cpu_shard = opt_get(train_opt, ['ema_cpu_shard'], False)
+            # Injectors can run on the EMA of a network rather than the network itself.
+            injector_opts = [inj for step_opt in opt['steps'].values() for inj in step_opt.get('injectors', {}).values()]
+            injector_opts += list(opt_get(opt, ['eval', 'injectors'], {}).values())
+            self.ema_consumers = any(opt_get(inj, ['use_ema'], False) for inj in injector_opts)
+            assert not (self.ema_on_cpu and self.ema_cpu_shard and self.ema_consumers), \
+                'Sharded CPU EMAs are only complete on rank 0 after a save, so injectors cannot use_ema with ema_cpu_shard.'
         self.checkpointing_cache = opt['checkpointing_enabled']
         self.auto_recover = opt_get(opt, ['automatically_recover_nan_by_reverting_n_saves'], None)
         self.batch_size_optimizer = create_batch_size_optimizer(train_opt)
         self.auto_scale_grads = opt_get(opt, ['automatically_scale_grads_for_fanin'], False)
         self.auto_scale_basis = opt_get(opt, ['automatically_scale_base_layer_size'], 1024)
+        self.auto_scale_weights = None  # Computed on first use by fan_in_grad_scales().
+        self.allocator = create_allocator()
+        self.empty_cache_policy = EmptyCachePolicy(opt_get(opt, ['train', 'empty_cache'], None), self.allocator)
+        # If specified, mega_batch_factor is picked on the first training step. See plan_mega_batch_factor().
+        self.memory_plan = opt_get(opt, ['train', 'memory_plan'], None)
+        self.memory_planned = False
+        self.memory_planning = False
+        # With a token budget, the number of micro-batches does not depend on mega_batch_factor, so there is nothing
+        # to plan.
+        assert self.memory_plan is None or opt_get(opt, ['train', 'micro_batch_token_budget'], None) is None, \
+            'memory_plan cannot be combined with micro_batch_token_budget.'
 
         self.netsG = {}
         self.netsD = {}
@@ -105,6 +128,9 @@ class ExtensibleTrainer(BaseModel):
             step = ConfigurableStep(step, self.env)
             self.step_names.append(step_name)  # This could be an OrderedDict, but it's a PITA to integrate with AMP below.
             self.steps.append(step)
+        # A retried step restarts from the first training step, which would apply the updates of the earlier ones twice.
+        assert self.empty_cache_policy.policy != 'on_oom' or len(self.steps) == 1, \
+            'empty_cache=on_oom is only supported with a single training step.'
 
         # step.define_optimizers() relies on the networks being placed in the env, so put them there. Even though
         # they aren't wrapped yet.
@@ -167,6 +193,7 @@ class ExtensibleTrainer(BaseModel):
         # Backpush the wrapped networks into the network dicts. Also build the EMA parameters.
         self.networks = {}
         self.emas = {}
+        self.cpu_emas = {}  # Built on the first update, once self.emas has been loaded.
         found = 0
         for dnet in dnets:
             for net_dict in [self.netsD, self.netsG]:
@@ -200,6 +227,8 @@ class ExtensibleTrainer(BaseModel):
         self.updated = True
 
     def feed_data(self, data, step, need_GT=True, perform_micro_batching=True):
+        if self.is_train and self.memory_plan is not None and perform_micro_batching and not self.memory_planned:
+            self.plan_mega_batch_factor(data, step)
         self.env['step'] = step
         self.batch_factor = self.mega_batch_factor
         self.opt['checkpointing_enabled'] = self.checkpointing_cache
@@ -214,7 +243,7 @@ class ExtensibleTrainer(BaseModel):
         self.eval_state = {}
         for o in self.optimizers:
             o.zero_grad()
-        torch.cuda.empty_cache()
+        self.empty_cache_policy.after_feed(step)
 
         sort_key = opt_get(self.opt, ['train', 'sort_key'], None)
         if sort_key is not None:
@@ -223,6 +252,29 @@ class ExtensibleTrainer(BaseModel):
             sort_indices = None
 
         batch_factor = self.batch_factor if perform_micro_batching else 1
+        # Micro-batches can be sized by padded cost (see trainer/micro_batching.py) instead of being equally sized:
+        # 'balance_micro_batches' splits the batch into up to batch_factor chunks of roughly equal cost, while
+        # 'micro_batch_token_budget' makes as many chunks as needed to keep each within the given number of tokens.
+        chunk_sizes = None
+        self.env['micro_batch_weights'] = None
+        token_budget = opt_get(self.opt, ['train', 'micro_batch_token_budget'], None)
+        if perform_micro_batching and sort_indices is not None and \
+                (token_budget is not None or opt_get(self.opt, ['train', 'balance_micro_batches'], False)):
+            lengths = data[sort_key][sort_indices].tolist()
+            chunk_sizes = partition_by_padded_cost(lengths, num_chunks=batch_factor, budget=token_budget)
+            self.batch_factor = len(chunk_sizes)
+            # Losses are averaged within each chunk, so weight each chunk by its share of the batch to keep every
+            # sample's contribution to the gradient what it would be without micro-batching.
+            self.env['micro_batch_weights'] = [c / len(lengths) for c in chunk_sizes]
+        elif perform_micro_batching:
+            # Batches can be smaller than batch_factor or not divisible by it, e.g. with length bucketing. torch.chunk()
+            # then returns fewer or unequally sized chunks, which are weighted the same way.
+            batch_size = next(v.shape[0] for v in data.values() if isinstance(v, torch.Tensor))
+            sizes = [len(c) for c in torch.chunk(torch.arange(batch_size), chunks=batch_factor)]
+            if len(sizes) != batch_factor or len(set(sizes)) > 1:
+                chunk_sizes = sizes
+                self.batch_factor = len(chunk_sizes)
+                self.env['micro_batch_weights'] = [c / batch_size for c in chunk_sizes]
         self.dstate = {}
         for k, v in data.items():
             if sort_indices is not None:
@@ -231,7 +283,10 @@ class ExtensibleTrainer(BaseModel):
                 else:
                     v = v[sort_indices]
             if isinstance(v, torch.Tensor):
-                self.dstate[k] = [t.to(self.device) for t in torch.chunk(v, chunks=batch_factor, dim=0)]
+                if chunk_sizes is not None:
+                    self.dstate[k] = [t.to(self.device) for t in torch.split(v, chunk_sizes, dim=0)]
+                else:
+                    self.dstate[k] = [t.to(self.device) for t in torch.chunk(v, chunks=batch_factor, dim=0)]
 
         if opt_get(self.opt, ['train', 'auto_collate'], False):
             for k, v in self.dstate.items():
@@ -246,14 +301,78 @@ class ExtensibleTrainer(BaseModel):
                             self.dstate[k][c] = self.dstate[k][c][:, :, :, :maxlen]
 
 
+    def plan_mega_batch_factor(self, data, step):
+        """
+        Picks mega_batch_factor by running the forward and backward passes of the first micro-batch of <data> (the one
+        with the longest samples, if sort_key is set) for increasing factors, until the peak memory it allocates fits
+        the target given by the memory_plan train option: either `target_gb`, or `target_fraction` (default .9) of the
+        device's memory. `candidates` overrides the factors that are tried.
+
+        The optimizers have not stepped yet when the plan is made, so the memory their state will take is estimated and
+        subtracted from the target. The planning passes run in train mode, so the buffers of every network (e.g. batch
+        norm statistics or EMA codebooks) are restored once they are done and update_for_step() is not called for them.
+
+        The plan is made from a single batch, so leave headroom in the target if sample lengths vary between batches.
+        """
+        self.memory_planned = True
+        if self.allocator is None:
+            return
+        if 'target_gb' in self.memory_plan.keys():
+            target = self.memory_plan['target_gb'] * 2 ** 30
+        else:
+            target = opt_get(self.memory_plan, ['target_fraction'], .9) * self.allocator.capacity()
+        optimizer_bytes = estimate_optimizer_state_bytes(self.optimizers)
+        target -= optimizer_bytes
+        batch_size = len(next(v for v in data.values() if isinstance(v, torch.Tensor)))
+
+        def run(factor):
+            self.mega_batch_factor = factor
+            self.env['mega_batch_factor'] = factor
+            self.memory_planning = True
+            try:
+                self.feed_data(data, step)
+                self.batch_factor = 1
+                self.optimize_parameters(step, optimize=False)
+            finally:
+                self.memory_planning = False
+                self.dstate = {}
+                for o in self.optimizers:
+                    o.zero_grad()
+
+        reduce_fn = None
+        if distributed.is_available() and distributed.is_initialized():
+            # Every rank must settle on the same factor.
+            def reduce_fn(peak):
+                peak = torch.tensor(float(peak), device=self.device)
+                distributed.all_reduce(peak, op=distributed.ReduceOp.MAX)
+                return peak.item()
+        buffers = [(b, b.detach().to('cpu', copy=True)) for net in self.networks.values() for b in net.buffers()]
+        try:
+            factor, peaks = plan_batch_factor(run, batch_size, self.allocator, target,
+                                              opt_get(self.memory_plan, ['candidates'], None), reduce_fn)
+        finally:
+            with torch.no_grad():
+                for b, saved in buffers:
+                    b.copy_(saved)
+        self.mega_batch_factor = factor
+        self.env['mega_batch_factor'] = factor
+        if self.rank <= 0:
+            logger.info(f'Memory plan: using mega_batch_factor={factor}, reserving {optimizer_bytes / 2 ** 30:.2f}GB for '
+                        f'optimizer state. Peak GB per factor: ' +
+                        ', '.join(f'{f}: {p / 2 ** 30:.2f}' for f, p in peaks.items()))
+
     def optimize_parameters(self, it, optimize=True, return_grad_norms=False):
         grad_norms = {}
 
         # Some models need to make parametric adjustments per-step. Do that here.
         for net in self.networks.values():
-            if hasattr(net.module, "update_for_step"):
+            if hasattr(net.module, "update_for_step") and not self.memory_planning:
                 net.module.update_for_step(it, os.path.join(self.opt['path']['models'], ".."))
 
+        # Injectors that use an EMA must not read it while a CPU EMA is being updated.
+        if self.ema_consumers:
+            self.flush_emas()
+
         # Iterate through the steps, performing them one at a time.
         state = self.dstate
         for step_num, step in enumerate(self.steps):
@@ -294,7 +413,8 @@ class ExtensibleTrainer(BaseModel):
                 assert enabled == len(nets_to_train)
 
                 # Update experiments
-                [e.before_step(self.opt, self.step_names[step_num], self.env, nets_to_train, state) for e in self.experiments]
+                if not self.memory_planning:
+                    [e.before_step(self.opt, self.step_names[step_num], self.env, nets_to_train, state) for e in self.experiments]
 
                 for o in step.get_optimizers():
                     o.zero_grad()
@@ -303,7 +423,11 @@ class ExtensibleTrainer(BaseModel):
             new_states = {}
             self.batch_size_optimizer.focus(net)
             for m in range(self.batch_factor):
-                ns = step.do_forward_backward(state, m, step_num, train=train_step, no_ddp_sync=(m+1 < self.batch_factor))
+                # Memory planning runs a single micro-batch; gradients must not be synchronized for it and its losses
+                # must not be logged.
+                ns = step.do_forward_backward(state, m, step_num, train=train_step,
+                                              no_ddp_sync=(m+1 < self.batch_factor) or self.memory_planning,
+                                              loss_accumulator=LossAccumulator() if self.memory_planning else None)
                 # Call into post-backward hooks.
                 for name, net in self.networks.items():
                     if hasattr(net.module, "after_backward"):
@@ -337,20 +461,11 @@ class ExtensibleTrainer(BaseModel):
                         net.module.before_step(it)
 
                 if self.auto_scale_grads:
-                    asb = sqrt(self.auto_scale_basis)
-                    for net in self.networks.values():
-                        for mod in net.modules():
-                            fan_in = -1
-                            if isinstance(mod, mbnb.nn.Linear):
-                                fan_in = mod.weight.data.shape[1]
-                            elif isinstance(mod, nn.Conv1d):
-                                fan_in = mod.weight.data.shape[0]
-                            elif isinstance(mod, nn.Conv2d) or isinstance(mod, nn.Conv3d):
-                                assert "Not yet implemented!"
-                            if fan_in != -1:
-                                p = mod.weight
-                                if hasattr(p, 'grad') and p.grad is not None:
-                                    p.grad = p.grad * asb / sqrt(fan_in)
+                    if self.auto_scale_weights is None:
+                        self.auto_scale_weights = fan_in_grad_scales(self.networks.values(), self.auto_scale_basis)
+                    weights, scales = self.auto_scale_weights
+                    scaled = [(w.grad, s) for w, s in zip(weights, scales) if w.grad is not None]
+                    scale_tensors_([g for g, _ in scaled], [s for _, s in scaled])
 
                 if return_grad_norms and train_step:
                     for name in nets_to_train:
@@ -360,24 +475,21 @@ class ExtensibleTrainer(BaseModel):
                         else:
                             pgroups = {f'{name}_all_parameters': list(model.parameters())}
                     for name in pgroups.keys():
-                        stacked_grads = []
-                        for p in pgroups[name]:
-                            if hasattr(p, 'grad') and p.grad is not None:
-                                stacked_grads.append(torch.norm(p.grad.detach(), 2))
-                        if not stacked_grads:
+                        norm = grad_norm(pgroups[name])
+                        if norm is None:
                             continue
-                        grad_norms[name] = torch.norm(torch.stack(stacked_grads), 2)
+                        grad_norms[name] = norm
                         if distributed.is_available() and distributed.is_initialized():
                             # Gather the metric from all devices if in a distributed setting.
                             distributed.all_reduce(grad_norms[name], op=distributed.ReduceOp.SUM)
                             grad_norms[name] /= distributed.get_world_size()
-                        grad_norms[name] = grad_norms[name].cpu()
 
                 self.consume_gradients(state, step, it)
 
 
         # Record visual outputs for usage in debugging and testing.
-        if 'visuals' in self.opt['logger'].keys() and self.rank <= 0 and it % self.opt['logger']['visual_debug_rate'] == 0:
+        if 'visuals' in self.opt['logger'].keys() and self.rank <= 0 and it % self.opt['logger']['visual_debug_rate'] == 0 \
+                and not self.memory_planning:
             def fix_image(img):
                 if opt_get(self.opt, ['logger', 'is_mel_spectrogram'], False):
                     if img.min() < -2:
@@ -418,6 +530,9 @@ class ExtensibleTrainer(BaseModel):
     def consume_gradients(self, state, step, it):
         [e.before_optimize(state) for e in self.experiments]
         self.restore_optimizers()
+        # The parameters are about to change; they must not while CPU EMAs are still copying them.
+        for ema in self.cpu_emas.values():
+            ema.wait_for_snapshot()
         step.do_step(it)
         self.stash_optimizers()
 
@@ -426,25 +541,36 @@ class ExtensibleTrainer(BaseModel):
             if hasattr(net.module, "after_step"):
                 net.module.after_step(it)
             if self.do_emas:
-                # When the EMA is on the CPU, only update every 10 steps to save processing time.
-                if self.ema_on_cpu and it % 10 != 0:
-                    continue
-                ema_params = self.emas[name].parameters()
-                net_params = net.parameters()
-                for ep, np in zip(ema_params, net_params):
-                    ema_rate = self.ema_rate
-                    new_rate = 1 - ema_rate
-                    if self.ema_on_cpu:
-                        np = np.cpu()
-                        ema_rate = ema_rate ** 10  # Because it only happens every 10 steps.
-                        mid = (1 - (ema_rate+new_rate))/2
-                        ema_rate += mid
-                        new_rate += mid
-                    ep.detach().mul_(ema_rate).add_(np, alpha=1 - ema_rate)
+                if self.ema_on_cpu:
+                    # Updated from a background thread; see CpuEma.
+                    if name not in self.cpu_emas.keys():
+                        assert not (self.ema_cpu_shard and hasattr(net.module, 'provide_ema')), \
+                            'Networks that use their EMA during training cannot shard it.'
+                        self.cpu_emas[name] = CpuEma(self.emas[name], net, self.ema_rate, shard=self.ema_cpu_shard)
+                    self.cpu_emas[name].update()
+                else:
+                    ema_update_(list(self.emas[name].parameters()), list(net.parameters()), self.ema_rate)
         [e.after_optimize(state) for e in self.experiments]
 
 
+    def discard_step_metrics(self):
+        """ Drops the losses logged so far, e.g. those of a step that failed part of the way through. """
+        for step in self.steps:
+            step.loss_accumulator.clear()
+
+    def flush_emas(self):
+        """ Waits for pending CPU EMA updates, so that self.emas can be read. """
+        for ema in self.cpu_emas.values():
+            ema.flush()
+
+    def consolidate_state(self):
+        super().consolidate_state()
+        # Bring CPU EMAs up to date and, if they are sharded, gather them on rank 0 so that they can be saved.
+        for ema in self.cpu_emas.values():
+            ema.consolidate()
+
     def test(self):
+        self.flush_emas()
         for net in self.netsG.values():
             net.eval()
 
@@ -479,7 +605,7 @@ class ExtensibleTrainer(BaseModel):
             net.train()
         return accum_metrics
 
-    # Fetches a summary of the log.
+    # Fetches a summary of the log. Metrics may still reside on the GPU; fetch them with utils.loss_accumulator.metrics_to_cpu().
     def get_current_log(self, step):
         log = {}
         for s in self.steps:
@@ -573,9 +699,10 @@ class ExtensibleTrainer(BaseModel):
         if not self.opt['logger']['disable_state_saving'] and state_number > 0:
             files_state = sorted(states_path.glob('*.state'), reverse=True, key=lambda p: int(p.stem))
 
-        files_to_keep = files_pth[:models_number - 1] \
-            + files_ema_pth[:models_number - 1] \
-            + files_state[:state_number - 1]
+        # Called after the latest checkpoint has been written, so it is among the files kept.
+        files_to_keep = files_pth[:models_number] \
+            + files_ema_pth[:models_number] \
+            + files_state[:state_number]
 
         for file_path in files_pth + files_ema_pth + files_state:
             if file_path not in files_to_keep:
@@ -6,6 +6,7 @@ from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.nn.parallel.distributed import DistributedDataParallel
 
 import utils.util
+from trainer.checkpoint_writer import AsyncCheckpointWriter
 from utils.util import opt_get, optimizer_to, map_to_device
 
 
@@ -24,6 +25,10 @@ class BaseModel():
         self.optimizers = []
         self.disc_optimizers = []
         self.save_history = {}
+        # Checkpoints are serialized in the background unless disabled; only the copy to host memory blocks training.
+        self.checkpoint_writer = None
+        if self.rank <= 0 and opt_get(opt, ['logger', 'async_checkpointing'], True):
+            self.checkpoint_writer = AsyncCheckpointWriter()
 
     def feed_data(self, data):
         pass
@@ -84,27 +89,51 @@ class BaseModel():
             network = network.module
         return str(network), sum(map(lambda x: x.numel(), network.parameters()))
 
+    def _write_checkpoint(self, obj, save_path, buffer_key, alt_filename, remote_subpath):
+        # Also save to the 'alt_path' which is useful for caching to Google Drive in colab, for example.
+        alt_paths = []
+        if 'alt_path' in self.opt['path'].keys():
+            alt_paths.append(os.path.join(self.opt['path']['alt_path'], alt_filename))
+        on_written = None
+        if self.opt['colab_mode']:
+            on_written = lambda: utils.util.copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
+                                                                 save_path, os.path.join(self.opt['remote_path'], remote_subpath))
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.save(obj, save_path, buffer_key, alt_paths, on_written)
+            return
+        torch.save(obj, save_path)
+        for alt_path in alt_paths:
+            torch.save(obj, alt_path)
+        if on_written is not None:
+            on_written()
+
     def save_network(self, network, network_label, iter_label):
         save_filename = '{}_{}.pth'.format(iter_label, network_label)
         save_path = os.path.join(self.opt['path']['models'], save_filename)
         if isinstance(network, nn.DataParallel) or isinstance(network, DistributedDataParallel):
             network = network.module
         state_dict = network.state_dict()
-        for key, param in state_dict.items():
-            state_dict[key] = param.cpu()
-        torch.save(state_dict, save_path)
+        if self.checkpoint_writer is None:
+            for key, param in state_dict.items():
+                state_dict[key] = param.cpu()
+        self._write_checkpoint(state_dict, save_path, network_label, save_filename, os.path.join('models', save_filename))
         if network_label not in self.save_history.keys():
             self.save_history[network_label] = []
         self.save_history[network_label].append(save_path)
-
-        # Also save to the 'alt_path' which is useful for caching to Google Drive in colab, for example.
-        if 'alt_path' in self.opt['path'].keys():
-            torch.save(state_dict, os.path.join(self.opt['path']['alt_path'], save_filename))
-        if self.opt['colab_mode']:
-            utils.util.copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
-                                            save_path, os.path.join(self.opt['remote_path'], 'models', save_filename))
         return save_path
 
+    def after_checkpoints_written(self, fn):
+        """ Calls <fn> once every checkpoint saved so far is on disk (immediately, unless checkpointing is async). """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.after_writes(fn)
+        else:
+            fn()
+
+    def flush_checkpoints(self):
+        """ Blocks until all checkpoints saved so far have been written. """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.flush()
+
     def load_network(self, load_path, network, strict=True, pretrain_base_path=None):
         # Sometimes networks are passed in as DDP modules, we want the raw parameters.
         if hasattr(network, 'module'):
@@ -148,18 +177,13 @@ class BaseModel():
             state['amp'] = amp.state_dict()
         save_filename = '{}.state'.format(utils.util.opt_get(state, ['iter'], 'no_step_provided'))
         save_path = os.path.join(self.opt['path']['training_state'], save_filename)
-        torch.save(map_to_device(state, 'cpu'), save_path)
+        if self.checkpoint_writer is None:
+            state = map_to_device(state, 'cpu')
+        self._write_checkpoint(state, save_path, '__state__', 'latest.state', os.path.join('training_state', save_filename))
         if '__state__' not in self.save_history.keys():
             self.save_history['__state__'] = []
         self.save_history['__state__'].append(save_path)
 
-        # Also save to the 'alt_path' which is useful for caching to Google Drive in colab, for example.
-        if 'alt_path' in self.opt['path'].keys():
-            torch.save(state, os.path.join(self.opt['path']['alt_path'], 'latest.state'))
-        if self.opt['colab_mode']:
-            utils.util.copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
-                                            save_path, os.path.join(self.opt['remote_path'], 'training_state', save_filename))
-
     def stash_optimizers(self):
         """
         When enabled, puts all optimizer states in CPU memory, allowing forward and backward passes more memory
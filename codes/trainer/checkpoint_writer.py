@@ -0,0 +1,106 @@
+import atexit
+import os
+import queue
+import shutil
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints from a background thread so that training only stalls for the device-to-host copy.
+
+    save() copies every tensor of the given object into a CPU buffer (pinned for CUDA tensors, so the copies run at
+    full DMA bandwidth), waits for those copies to complete and returns. Serialization happens on the worker thread,
+    which writes to a temporary file and renames it into place so that a partially written checkpoint is never visible
+    under its final name. Buffers are keyed by `buffer_key` and reused across saves, so repeated checkpoints of the same
+    network do not reallocate pinned memory.
+
+    Jobs run in submission order. Callbacks queued with after_writes() therefore run once every checkpoint submitted
+    before them has landed on disk, which is where checkpoint pruning belongs.
+    """
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.buffers = {}
+        self.pending = {}
+        self.error = None
+        self.worker = threading.Thread(target=self._run, name='checkpoint_writer', daemon=True)
+        self.worker.start()
+        # The worker is a daemon; make sure queued checkpoints are not lost when the interpreter exits normally.
+        atexit.register(self.flush)
+
+    def _snapshot(self, obj, buffers, key):
+        if isinstance(obj, torch.Tensor):
+            obj = obj.detach()
+            buf = buffers.get(key, None)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+                buffers[key] = buf
+            buf.copy_(obj, non_blocking=obj.is_cuda)
+            return buf
+        elif isinstance(obj, dict):
+            out = type(obj)() if isinstance(obj, OrderedDict) else {}
+            for k, v in obj.items():
+                out[k] = self._snapshot(v, buffers, f'{key}/{k}')
+            # nn.Module.state_dict() stores version info here, which load_state_dict() consumes.
+            if hasattr(obj, '_metadata'):
+                out._metadata = obj._metadata
+            return out
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, buffers, f'{key}/{i}') for i, v in enumerate(obj))
+        return obj
+
+    def _raise_pending_error(self):
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise RuntimeError('A background checkpoint write failed.') from e
+
+    def save(self, obj, path, buffer_key, extra_paths=[], on_written=None):
+        """
+        Snapshots <obj> and queues it to be written to <path> and copied to each of <extra_paths>. <on_written> is
+        called from the worker thread after the write completes.
+        """
+        self._raise_pending_error()
+        # The buffers of <buffer_key> may still be being serialized by an earlier save; wait for it before reusing them.
+        if buffer_key in self.pending.keys():
+            self.pending[buffer_key].wait()
+        snapshot = self._snapshot(obj, self.buffers.setdefault(buffer_key, {}), buffer_key)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        done = threading.Event()
+        self.pending[buffer_key] = done
+        self.jobs.put((self._write, (snapshot, path, extra_paths, on_written), done))
+
+    def after_writes(self, fn):
+        """ Queues <fn> to run on the worker thread once all previously submitted checkpoints have been written. """
+        self.jobs.put((fn, (), None))
+
+    def _write(self, snapshot, path, extra_paths, on_written):
+        tmp_path = path + '.tmp'
+        torch.save(snapshot, tmp_path)
+        os.replace(tmp_path, path)
+        for extra in extra_paths:
+            shutil.copyfile(path, extra + '.tmp')
+            os.replace(extra + '.tmp', extra)
+        if on_written is not None:
+            on_written()
+
+    def _run(self):
+        while True:
+            fn, args, done = self.jobs.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f'Background checkpoint job failed: {e}')
+                self.error = e
+            finally:
+                if done is not None:
+                    done.set()
+                self.jobs.task_done()
+
+    def flush(self):
+        """ Blocks until every queued checkpoint has been written and every queued callback has run. """
+        self.jobs.join()
+        self._raise_pending_error()
@@ -0,0 +1,174 @@
+"""
+EMA of a network's parameters kept in host memory and updated off the training thread. Used by ExtensibleTrainer when
+the `ema_on_cpu` train option is set.
+"""
+import queue
+import threading
+from math import ceil
+
+import torch
+from torch import distributed
+
+
+class CpuEma:
+    """
+    Maintains the EMA of <net>'s parameters in <ema_module>, which must be a copy of <net> on the CPU.
+
+    The floating point parameters of <ema_module> are moved into one contiguous float32 buffer and become views of it.
+    After every optimizer step, update() queues a non-blocking copy of <net>'s parameters into a pinned staging buffer
+    on a side CUDA stream and returns; a background thread waits for the copy and folds it into the EMA. Call
+    wait_for_snapshot() before the parameters of <net> are next modified, which makes the training stream (but not the
+    host) wait until the copy has completed.
+
+    When the background thread is still busy with the previous snapshot, update() skips the copy and the next snapshot
+    is applied with the decay of every step since the last one, rate ** steps. This equals stepping the EMA once per step
+    with the parameters held at the snapshot, so the EMA never drifts from the configured rate, however often it can be
+    updated.
+
+    If <shard> is set under DDP, each rank only keeps and updates an equal slice of the EMA, which divides host memory and
+    update work by the number of ranks. Rank 0 additionally holds the full buffer, which consolidate() fills by gathering
+    the other slices, so only rank 0's <ema_module> is usable, and only after consolidate().
+    """
+    def __init__(self, ema_module, net, rate, shard=False, gather_chunk=2 ** 24):
+        self.rate = rate
+        self.gather_chunk = gather_chunk
+        ema_params = [p for p in ema_module.parameters() if p.is_floating_point()]
+        self.net_params = [p for p in net.parameters() if p.is_floating_point()]
+        assert len(ema_params) == len(self.net_params)
+        self.total = sum(p.numel() for p in ema_params)
+
+        self.sharded = shard and distributed.is_available() and distributed.is_initialized()
+        self.rank = distributed.get_rank() if self.sharded else 0
+        self.world_size = distributed.get_world_size() if self.sharded else 1
+        self.shard_size = ceil(self.total / self.world_size)
+        self.start = min(self.rank * self.shard_size, self.total)
+        self.end = min(self.start + self.shard_size, self.total)
+
+        initial = torch.cat([p.detach().float().flatten() for p in ema_params])
+        self.full = initial if self.rank == 0 else None
+        self.shard = initial[self.start:self.end] if self.rank == 0 else initial[self.start:self.end].clone()
+        del initial
+
+        # Make the EMA module's parameters views of the flat buffer. Parameters that are not float32 cannot be views and
+        # are copied back from it whenever it changes instead.
+        self.cast_back = []
+        offset = 0
+        for p in ema_params:
+            if self.full is not None:
+                view = self.full[offset:offset+p.numel()].view(p.shape)
+                if p.dtype == torch.float32:
+                    p.data = view
+                else:
+                    self.cast_back.append((p, view))
+            else:
+                p.data = torch.empty(0, dtype=p.dtype)  # Only rank 0 holds the full EMA.
+            offset += p.numel()
+
+        # The (parameter, source range, staging range) copies that make up a snapshot of this rank's slice.
+        self.copies = []
+        offset = 0
+        for p in self.net_params:
+            a, b = max(offset, self.start), min(offset + p.numel(), self.end)
+            if a < b:
+                self.copies.append((p, a - offset, b - offset, a - self.start, b - self.start))
+            offset += p.numel()
+
+        self.use_cuda = any(p.is_cuda for p in self.net_params)
+        self.staging = torch.empty(self.end - self.start, dtype=torch.float32, pin_memory=self.use_cuda)
+        self.stream = torch.cuda.Stream(device=self.net_params[0].device) if self.use_cuda else None
+        self.event = None
+
+        self.pending_steps = 0
+        self.busy = threading.Event()
+        self.jobs = queue.Queue()
+        self.error = None
+        self.worker = threading.Thread(target=self._run, name='cpu_ema', daemon=True)
+        self.worker.start()
+
+    def _run(self):
+        while True:
+            steps = self.jobs.get()
+            try:
+                if self.event is not None:
+                    self.event.synchronize()
+                decay = self.rate ** steps
+                self.shard.mul_(decay).add_(self.staging, alpha=1 - decay)
+                if not self.sharded:
+                    self._copy_back()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.busy.clear()
+                self.jobs.task_done()
+
+    def _copy_back(self):
+        for p, view in self.cast_back:
+            p.data.copy_(view)
+
+    def _raise_pending_error(self):
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise RuntimeError('A background EMA update failed.') from e
+
+    def _snapshot(self):
+        if self.use_cuda:
+            self.stream.wait_stream(torch.cuda.current_stream(self.stream.device))
+            with torch.cuda.stream(self.stream):
+                for p, a, b, sa, sb in self.copies:
+                    self.staging[sa:sb].copy_(p.detach().reshape(-1)[a:b], non_blocking=True)
+                self.event = self.stream.record_event()
+        else:
+            for p, a, b, sa, sb in self.copies:
+                self.staging[sa:sb].copy_(p.detach().reshape(-1)[a:b])
+
+    def update(self):
+        """ Accounts for one optimizer step of the network. """
+        self._raise_pending_error()
+        self.pending_steps += 1
+        if self.busy.is_set():
+            return
+        self._snapshot()
+        self.busy.set()
+        self.jobs.put(self.pending_steps)
+        self.pending_steps = 0
+
+    def wait_for_snapshot(self):
+        """ Makes the current CUDA stream wait for the last parameter snapshot. Does not block the host. """
+        if self.event is not None:
+            torch.cuda.current_stream(self.stream.device).wait_event(self.event)
+
+    def flush(self):
+        """ Blocks until every step so far is reflected in the EMA. """
+        self.jobs.join()
+        if self.pending_steps > 0:
+            self._snapshot()
+            self.busy.set()
+            self.jobs.put(self.pending_steps)
+            self.pending_steps = 0
+            self.jobs.join()
+        self._raise_pending_error()
+
+    def consolidate(self):
+        """
+        Brings the EMA up to date and, when sharded, gathers it into rank 0's EMA module. Must be called by every rank.
+        """
+        self.flush()
+        if not self.sharded:
+            return
+        device = torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() else torch.device('cpu')
+        local_size = self.end - self.start
+        for c in range(0, self.shard_size, self.gather_chunk):
+            n = min(self.gather_chunk, self.shard_size - c)
+            local = torch.zeros(n, device=device)
+            m = max(0, min(n, local_size - c))
+            local[:m] = self.shard[c:c+m].to(device)
+            parts = [torch.empty(n, device=device) for _ in range(self.world_size)]
+            distributed.all_gather(parts, local)
+            if self.full is not None:
+                for r, part in enumerate(parts):
+                    a = r * self.shard_size + c
+                    b = min(a + n, self.total)
+                    if a < b:
+                        self.full[a:b] = part[:b-a].cpu()
+        if self.full is not None:
+            self._copy_back()
@@ -17,10 +17,12 @@ from data.audio.paired_voice_audio_dataset import load_tsv_aligned_codes
 from data.audio.unsupervised_audio_dataset import load_audio
 from data.audio.voice_tokenizer import VoiceBpeTokenizer
 from models.clip.mel_text_clip import MelTextCLIP
+from models.diffusion.multistep_solvers import SOLVERS
 from models.audio.tts.tacotron2 import text_to_sequence
-from scripts.audio.gen.speech_synthesis_utils import load_discrete_vocoder_diffuser, wav_to_mel, load_speech_dvae, \
+from trainer.eval.eval_pipeline import ArtifactWriter, isolated_rng, prefetch, sample_batched
+from scripts.audio.gen.speech_synthesis_utils import load_discrete_vocoder_diffuser, wav_to_mel, wavs_to_mels, load_speech_dvae, \
     convert_mel_to_codes, load_univnet_vocoder, wav_to_univnet_mel, load_clvp
-from trainer.injectors.audio_injectors import denormalize_mel, TorchMelSpectrogramInjector, normalize_mel
+from trainer.injectors.audio_injectors import denormalize_mel, TorchMelSpectrogramInjector, normalize_mel, get_mel_frontend
 from utils.util import ceil_multiple, opt_get, load_model_from_config, pad_or_truncate
 
 
@@ -30,6 +32,11 @@ class AudioDiffusionFid(evaluator.Evaluator):
 
     This evaluator is kind of a mess. It has been repeatedly modified to work with several different model types, which
     means it is bloated beyond belief. I would not recommend attempting to understand what is going on here.
+
+    Eval items are loaded on background threads and artifacts are written from a background thread. Projections and
+    CTC losses of the real samples do not change between evaluations and are computed once. The MEL modes (tts9_mel*,
+    ctc_to_mel, tfd, tfd_ar) can diffuse <eval_batch_size> items at once; items are zero-padded to the longest in the
+    batch, which perturbs results slightly, so compare runs that used the same batch size.
     """
     def __init__(self, model, opt_eval, env):
         super().__init__(model, opt_eval, env, uses_all_ddp=True)
@@ -55,13 +62,27 @@ class AudioDiffusionFid(evaluator.Evaluator):
             diffusion_schedule = opt_get(opt_eval, ['diffusion_schedule'], 'cosine')
         conditioning_free_diffusion_enabled = opt_get(opt_eval, ['conditioning_free'], False)
         conditioning_free_k = opt_get(opt_eval, ['conditioning_free_k'], 1)
-        self.diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_steps, schedule=diffusion_schedule,
+        # 'p', 'ddim' or one of the multistep ODE solvers. The solvers pick their own timesteps, so for them the
+        # diffuser is not respaced and diffusion_steps is the number of solver steps.
+        sampler = opt_get(opt_eval, ['sampler'], 'p')
+        self.diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=4000 if sampler in SOLVERS else diffusion_steps,
+                                                       schedule=diffusion_schedule,
                                                        enable_conditioning_free_guidance=conditioning_free_diffusion_enabled,
                                                        conditioning_free_k=conditioning_free_k)
+        self.sampling_fn = self.diffuser.get_sampling_fn(sampler, steps=diffusion_steps,
+                                                         order=opt_get(opt_eval, ['solver_order'], 2),
+                                                         schedule=opt_get(opt_eval, ['solver_schedule'], 'karras'))
         self.bpe_tokenizer = VoiceBpeTokenizer('../experiments/bpe_lowercase_asr_256.json')
         self.dev = self.env['device']
+        self.batch_size = opt_get(opt_eval, ['eval_batch_size'], 1)
+        self.loader_threads = opt_get(opt_eval, ['loader_threads'], 2)
+        self.real_cache = {}
+        self.writer = ArtifactWriter()
         mode = opt_get(opt_eval, ['diffusion_type'], 'tts')
         self.local_modules = {}
+        # Modes that are split into prepare_fn(), which builds the inputs of the diffusion model, and
+        # finish_mel_diffusion() can be batched.
+        self.prepare_fn = None
         if mode == 'tts':
             self.diffusion_fn = self.perform_diffusion_tts
         elif mode == 'original_vocoder':
@@ -71,14 +92,14 @@ class AudioDiffusionFid(evaluator.Evaluator):
             self.local_modules['dvae'] = load_speech_dvae().cpu()
             self.diffusion_fn = self.perform_diffusion_vocoder
         elif mode == 'ctc_to_mel':
-            self.diffusion_fn = self.perform_diffusion_ctc
+            self.prepare_fn = self.prepare_diffusion_ctc
             self.local_modules['vocoder'] = load_univnet_vocoder().cpu()
             self.local_modules['clvp'] = load_clvp()
         elif 'tts9_mel' in mode:
             mel_means, self.mel_max, self.mel_min, mel_stds, mel_vars = torch.load('../experiments/univnet_mel_norms.pth')
             self.local_modules['dvae'] = load_speech_dvae().cpu()
             self.local_modules['vocoder'] = load_univnet_vocoder().cpu()
-            self.diffusion_fn = self.perform_diffusion_tts9_mel_from_codes
+            self.prepare_fn = self.prepare_diffusion_tts9_mel_from_codes
             if mode == 'tts9_mel_autoin':
                 self.local_modules['autoregressive'] = load_model_from_config("../experiments/train_gpt_tts_unified.yml",
                                                                               model_name='gpt',
@@ -89,7 +110,7 @@ class AudioDiffusionFid(evaluator.Evaluator):
             else:
                 self.tts9_codegen = self.tts9_get_dvae_codes
         elif 'tfd' == mode:
-            self.diffusion_fn = self.perform_diffusion_tfd
+            self.prepare_fn = self.prepare_diffusion_tfd
             self.local_modules['vocoder'] = load_univnet_vocoder().cpu()
         elif 'tfd_ar' == mode:
             self.local_modules['dvae'] = load_speech_dvae().cpu()
@@ -98,8 +119,11 @@ class AudioDiffusionFid(evaluator.Evaluator):
                                                                           also_load_savepoint=False,
                                                                           load_path='../experiments/tortoise_ar.pth',
                                                                           device=torch.device('cpu')).cuda().eval()
-            self.diffusion_fn = self.perform_diffusion_tfd_ar_prior
+            self.prepare_fn = self.prepare_diffusion_tfd_ar_prior
             self.local_modules['vocoder'] = load_univnet_vocoder().cpu()
+        if self.prepare_fn is not None:
+            self.diffusion_fn = self.perform_mel_diffusion
+        assert self.batch_size == 1 or self.prepare_fn is not None, f'Diffusion type {mode} does not support batching.'
 
     def perform_diffusion_tts(self, audio, codes, text, sample_rate=5500):
         real_resampled = torchaudio.functional.resample(audio, 22050, sample_rate).unsqueeze(0)
@@ -111,9 +135,9 @@ class AudioDiffusionFid(evaluator.Evaluator):
         if padding_needed_for_codes > 0:
             codes = F.pad(codes, (0, padding_needed_for_codes))
         output_shape = (1, 1, padded_size)
-        gen = self.diffuser.p_sample_loop(self.model, output_shape,
-                                    model_kwargs={'tokens': codes.unsqueeze(0),
-                                                  'conditioning_input': real_resampled})
+        gen = self.sampling_fn(self.model, output_shape,
+                               model_kwargs={'tokens': codes.unsqueeze(0),
+                                             'conditioning_input': real_resampled})
         return gen, real_resampled, sample_rate
 
     def perform_original_diffusion_vocoder(self, audio, codes, text, sample_rate=11025):
@@ -131,9 +155,9 @@ class AudioDiffusionFid(evaluator.Evaluator):
         if padding_needed_for_codes > 0:
             back_to_mel = F.pad(back_to_mel, (0, padding_needed_for_codes))
         output_shape = (1, 1, padded_size)
-        gen = self.diffuser.p_sample_loop(self.model, output_shape,
-                                    model_kwargs={'spectrogram': back_to_mel,
-                                                  'conditioning_input': orig_audio.unsqueeze(0)})
+        gen = self.sampling_fn(self.model, output_shape,
+                               model_kwargs={'spectrogram': back_to_mel,
+                                             'conditioning_input': orig_audio.unsqueeze(0)})
 
         # Pop it back down to 5.5kHz for an accurate comparison with the other diffusers.
         real_resampled = torchaudio.functional.resample(real_resampled.squeeze(0), sample_rate, 5500).unsqueeze(0)
@@ -155,10 +179,10 @@ class AudioDiffusionFid(evaluator.Evaluator):
         if padding_needed_for_codes > 0:
             mel_codes = F.pad(mel_codes, (0, padding_needed_for_codes))
         output_shape = (1, 1, padded_size)
-        gen = self.diffuser.p_sample_loop(self.model, output_shape,
-                                    model_kwargs={'tokens': mel_codes,
-                                                  'conditioning_input': audio.unsqueeze(0),
-                                                  'unaligned_input': torch.tensor(text_codes, device=audio.device).unsqueeze(0)})
+        gen = self.sampling_fn(self.model, output_shape,
+                               model_kwargs={'tokens': mel_codes,
+                                             'conditioning_input': audio.unsqueeze(0),
+                                             'unaligned_input': torch.tensor(text_codes, device=audio.device).unsqueeze(0)})
         return gen, real_resampled, sample_rate
 
     def tts9_get_autoregressive_codes(self, mel, text):
@@ -176,24 +200,36 @@ class AudioDiffusionFid(evaluator.Evaluator):
     def tts9_get_dvae_codes(self, mel, text):
         return convert_mel_to_codes(self.local_modules['dvae'], mel)
 
-    def perform_diffusion_tts9_mel_from_codes(self, audio, codes, text):
+    def perform_mel_diffusion(self, audio, codes, text):
+        prep = self.prepare_fn(audio, codes, text)
+        gen_mel = self.sampling_fn(self.model, prep['shape'], model_kwargs=prep['model_kwargs'])
+        return self.finish_mel_diffusion(gen_mel, prep)
+
+    def finish_mel_diffusion(self, gen_mel, prep, need_real=True):
+        """
+        Vocodes a MEL generated from the inputs built by a prepare_fn. The real sample (the vocoded reference MEL) is
+        only computed if <need_real>; it is None otherwise.
+        """
+        SAMPLE_RATE = 24000
+        gen_mel_denorm = denormalize_mel(gen_mel)
+        gen_wav = self.local_modules['vocoder'].inference(gen_mel_denorm)
+        ref_mel = prep['ref_mel']
+        real_dec = None
+        if need_real:
+            with isolated_rng(ref_mel.device):
+                real_dec = self.local_modules['vocoder'].inference(denormalize_mel(ref_mel) if prep['normalized'] else ref_mel)
+        return gen_wav.float(), real_dec, gen_mel if prep['normalized'] else gen_mel_denorm, ref_mel, SAMPLE_RATE
+
+    def prepare_diffusion_tts9_mel_from_codes(self, audio, codes, text):
         SAMPLE_RATE = 24000
         mel = wav_to_mel(audio)
         mel_codes = self.tts9_codegen(mel, text)
         real_resampled = torchaudio.functional.resample(audio, 22050, SAMPLE_RATE).unsqueeze(0)
         univnet_mel = wav_to_univnet_mel(real_resampled, do_normalization=False)  # to be used for a conditioning input, but also guides output shape.
-        output_shape = univnet_mel.shape
-        gen_mel = self.diffuser.p_sample_loop(self.model, output_shape,
-                                    model_kwargs={'aligned_conditioning': mel_codes,
-                                                  'conditioning_input': univnet_mel})
-        # denormalize mel
-        gen_mel = denormalize_mel(gen_mel)
-
-        gen_wav = self.local_modules['vocoder'].inference(gen_mel)
-        real_dec = self.local_modules['vocoder'].inference(univnet_mel)
-        return gen_wav.float(), real_dec, gen_mel, univnet_mel, SAMPLE_RATE
+        return {'shape': univnet_mel.shape, 'ref_mel': univnet_mel, 'normalized': False,
+                'model_kwargs': {'aligned_conditioning': mel_codes, 'conditioning_input': univnet_mel}}
 
-    def perform_diffusion_ctc(self, audio, codes, text):
+    def prepare_diffusion_ctc(self, audio, codes, text):
         SAMPLE_RATE = 24000
         text_codes = torch.LongTensor(self.bpe_tokenizer.encode(text)).unsqueeze(0).to(audio.device)
         clvp_latent = self.local_modules['clvp'].embed_text(text_codes)
@@ -201,33 +237,22 @@ class AudioDiffusionFid(evaluator.Evaluator):
         real_resampled = torchaudio.functional.resample(audio, 22050, SAMPLE_RATE).unsqueeze(0)
         univnet_mel = wav_to_univnet_mel(real_resampled, do_normalization=True)
         output_shape = univnet_mel.shape
-        cond_mel = TorchMelSpectrogramInjector({'n_mel_channels': 100, 'mel_fmax': 11000, 'filter_length': 8000, 'normalize': True,
-                                                'true_normalization': True, 'in': 'in', 'out': 'out'}, {})({'in': audio})['out']
+        cond_mel = get_mel_frontend(TorchMelSpectrogramInjector, audio.device, n_mel_channels=100, mel_fmax=11000, filter_length=8000,
+                                    normalize=True, true_normalization=True)({'in': audio})['out']
 
-        gen_mel = self.diffuser.p_sample_loop(self.model, output_shape, model_kwargs={'codes': codes.unsqueeze(0),
-                                                  'conditioning_input': cond_mel, 'type': torch.tensor([0], device=codes.device),
-                                                  'clvp_input': clvp_latent})
-        gen_mel_denorm = denormalize_mel(gen_mel)
+        return {'shape': output_shape, 'ref_mel': univnet_mel, 'normalized': True,
+                'model_kwargs': {'codes': codes.unsqueeze(0), 'conditioning_input': cond_mel,
+                                 'type': torch.tensor([0], device=codes.device), 'clvp_input': clvp_latent}}
 
-        gen_wav = self.local_modules['vocoder'].inference(gen_mel_denorm)
-        real_dec = self.local_modules['vocoder'].inference(denormalize_mel(univnet_mel))
-        return gen_wav.float(), real_dec, gen_mel, univnet_mel, SAMPLE_RATE
-
-    def perform_diffusion_tfd(self, audio, codes, text):
+    def prepare_diffusion_tfd(self, audio, codes, text):
         SAMPLE_RATE = 24000
         audio_resampled = torchaudio.functional.resample(audio, 22050, SAMPLE_RATE).unsqueeze(0)
         vmel = wav_to_mel(audio)
         umel = wav_to_univnet_mel(audio_resampled, do_normalization=True)
-        gen_mel = self.diffuser.p_sample_loop(self.model, umel.shape,
-                                              model_kwargs={'truth_mel': vmel,
-                                                            'conditioning_input': None,
-                                                            'disable_diversity': True})
-
-        gen_wav = self.local_modules['vocoder'].inference(denormalize_mel(gen_mel))
-        real_dec = self.local_modules['vocoder'].inference(denormalize_mel(umel))
-        return gen_wav.float(), real_dec, gen_mel, umel, SAMPLE_RATE
+        return {'shape': umel.shape, 'ref_mel': umel, 'normalized': True,
+                'model_kwargs': {'truth_mel': vmel, 'conditioning_input': None, 'disable_diversity': True}}
 
-    def perform_diffusion_tfd_ar_prior(self, audio, codes, text):
+    def prepare_diffusion_tfd_ar_prior(self, audio, codes, text):
         SAMPLE_RATE = 24000
         audio_resampled = torchaudio.functional.resample(audio, 22050, SAMPLE_RATE).unsqueeze(0)
         vmel = wav_to_mel(audio)
@@ -243,12 +268,7 @@ class AudioDiffusionFid(evaluator.Evaluator):
                                                                     torch.tensor([mel_codes.shape[-1]*mlc], device=vmel.device),
                                                                     text_first=True, raw_mels=None, return_latent=True)
 
-        gen_mel = self.diffuser.p_sample_loop(self.model, umel.shape,
-                                              model_kwargs={'codes': auto_latents})
-
-        gen_wav = self.local_modules['vocoder'].inference(denormalize_mel(gen_mel))
-        real_dec = self.local_modules['vocoder'].inference(denormalize_mel(umel))
-        return gen_wav.float(), real_dec, gen_mel, umel, SAMPLE_RATE
+        return {'shape': umel.shape, 'ref_mel': umel, 'normalized': True, 'model_kwargs': {'codes': auto_latents}}
 
     def load_projector(self):
         """
@@ -262,28 +282,28 @@ class AudioDiffusionFid(evaluator.Evaluator):
         model.load_state_dict(weights)
         return model
 
-    def project(self, projector, sample, sample_rate):
-        sample = torchaudio.functional.resample(sample, sample_rate, 22050)
-        mel = wav_to_mel(sample)
-        return projector.get_speech_projection(mel).squeeze(0)  # Getting rid of the batch dimension means it's just [hidden_dim]
+    def project(self, projector, samples, sample_rate):
+        """ Projects each clip of <samples>. Their MELs are computed together, with a single STFT. """
+        samples = [torchaudio.functional.resample(s, sample_rate, 22050) for s in samples]
+        return [projector.get_speech_projection(mel).squeeze(0)  # Getting rid of the batch dimension means it's just [hidden_dim]
+                for mel in wavs_to_mels(samples)]
 
     def load_w2v(self):
         return Wav2Vec2ForCTC.from_pretrained("jbetker/wav2vec2-large-robust-ft-libritts-voxpopuli")
 
+    def ctc_loss(self, w2v, sample, sample_rate, real_text):
+        """ Computes the wav2vec2 CTC loss of <sample> against the text it should contain. """
+        text_codes = torch.tensor(text_to_sequence(real_text), device=sample.device)
+        s = torchaudio.functional.resample(sample, sample_rate, 16000)
+        norm_s = (s - s.mean()) / torch.sqrt(s.var() + 1e-7)
+        norm_s = norm_s.squeeze(1)
+        return w2v(input_values=norm_s, labels=text_codes).loss
+
     def intelligibility_loss(self, w2v, sample, real_sample, sample_rate, real_text):
         """
         Measures the differences between CTC losses using wav2vec2 against the real sample and the generated sample.
         """
-        text_codes = torch.tensor(text_to_sequence(real_text), device=sample.device)
-        results = []
-        for s in [sample, real_sample]:
-            s = torchaudio.functional.resample(s, sample_rate, 16000)
-            norm_s = (s - s.mean()) / torch.sqrt(s.var() + 1e-7)
-            norm_s = norm_s.squeeze(1)
-            loss = w2v(input_values=norm_s, labels=text_codes).loss
-            results.append(loss)
-        gen_loss, real_loss = results
-        return gen_loss - real_loss
+        return self.ctc_loss(w2v, sample, sample_rate, real_text) - self.ctc_loss(w2v, real_sample, sample_rate, real_text)
 
     def compute_frechet_distance(self, proj1, proj2):
         # I really REALLY FUCKING HATE that this is going to numpy. Why does "pytorch_fid" operate in numpy land. WHY?
@@ -295,6 +315,24 @@ class AudioDiffusionFid(evaluator.Evaluator):
         sigma2 = np.cov(proj2, rowvar=False)
         return torch.tensor(calculate_frechet_distance(mu1, sigma1, mu2, sigma2))
 
+    def load_item(self, item):
+        i, index = item
+        path, text, codes = self.data[index]
+        return i, index, load_audio(path, 22050), codes, text
+
+    def generate_batch(self, batch):
+        """
+        Generates a sample for each (i, index, audio, codes, text) item of <batch>. Real samples are only computed for
+        items whose real projections are not cached yet (where a mode supports skipping them).
+        """
+        batch = [(index, audio.to(self.dev), codes.to(self.dev), text) for _, index, audio, codes, text in batch]
+        if self.prepare_fn is None:
+            return [self.diffusion_fn(audio, codes, text) for _, audio, codes, text in batch]
+        preps = [self.prepare_fn(audio, codes, text) for _, audio, codes, text in batch]
+        gen_mels = sample_batched(self.sampling_fn, self.model, [p['shape'] for p in preps], [p['model_kwargs'] for p in preps])
+        return [self.finish_mel_diffusion(gen_mel, prep, need_real=index not in self.real_cache.keys())
+                for gen_mel, prep, (index, _, _, _) in zip(gen_mels, preps, batch)]
+
     def perform_eval(self):
         save_path = osp.join(self.env['base_path'], "../", "audio_eval", str(self.env["step"]))
         os.makedirs(save_path, exist_ok=True)
@@ -316,20 +354,28 @@ class AudioDiffusionFid(evaluator.Evaluator):
             gen_projections = []
             real_projections = []
             intelligibility_losses = []
-            for i in tqdm(list(range(0, len(self.data), self.skip))):
-                path, text, codes = self.data[(i + self.env['rank']) % len(self.data)]
-                audio = load_audio(path, 22050).to(self.dev)
-                codes = codes.to(self.dev)
-                sample, ref, gen_mel, ref_mel, sample_rate = self.diffusion_fn(audio, codes, text)
-
-                gen_projections.append(self.project(projector, sample, sample_rate).cpu())  # Store on CPU to avoid wasting GPU memory.
-                real_projections.append(self.project(projector, ref, sample_rate).cpu())
-                intelligibility_losses.append(self.intelligibility_loss(w2v, sample, ref, sample_rate, text))
-
-                torchvision.utils.save_image((gen_mel.unsqueeze(1) + 1) / 2, os.path.join(save_path, f'{self.env["rank"]}_{i}_mel.png'))
-                torchvision.utils.save_image((ref_mel.unsqueeze(1) + 1) / 2, os.path.join(save_path, f'{self.env["rank"]}_{i}_mel_target.png'))
-                torchaudio.save(os.path.join(save_path, f"{self.env['rank']}_{i}_gen.wav"), sample.squeeze(0).cpu(), sample_rate)
-                torchaudio.save(os.path.join(save_path, f"{self.env['rank']}_{i}_real.wav"), ref.squeeze(0).cpu(), sample_rate)
+            steps = list(range(0, len(self.data), self.skip))
+            items = prefetch([(i, (i + self.env['rank']) % len(self.data)) for i in steps], self.load_item, workers=self.loader_threads)
+            for b in tqdm(range(0, len(steps), self.batch_size)):
+                batch = [next(items) for _ in range(min(self.batch_size, len(steps) - b))]
+                results = self.generate_batch(batch)
+                uncached = [k for k, (_, index, _, _, _) in enumerate(batch) if index not in self.real_cache.keys()]
+                projections = self.project(projector, [r[0] for r in results] + [results[k][1] for k in uncached], results[0][4])
+                real_projections_by_item = dict(zip(uncached, projections[len(results):]))
+                for k, ((i, index, audio, codes, text), (sample, ref, gen_mel, ref_mel, sample_rate)) in enumerate(zip(batch, results)):
+                    if index not in self.real_cache.keys():
+                        self.real_cache[index] = {'projection': real_projections_by_item[k].cpu(),
+                                                  'ctc_loss': self.ctc_loss(w2v, ref, sample_rate, text),
+                                                  'wav': ref.squeeze(0).cpu(), 'mel': ref_mel.cpu()}
+                    real = self.real_cache[index]
+                    gen_projections.append(projections[k].cpu())  # Store on CPU to avoid wasting GPU memory.
+                    real_projections.append(real['projection'])
+                    intelligibility_losses.append(self.ctc_loss(w2v, sample, sample_rate, text) - real['ctc_loss'])
+
+                    self.writer.save_image(os.path.join(save_path, f'{self.env["rank"]}_{i}_mel.png'), (gen_mel.unsqueeze(1) + 1) / 2)
+                    self.writer.save_image(os.path.join(save_path, f'{self.env["rank"]}_{i}_mel_target.png'), (real['mel'].unsqueeze(1) + 1) / 2)
+                    self.writer.save_audio(os.path.join(save_path, f"{self.env['rank']}_{i}_gen.wav"), sample.squeeze(0), sample_rate)
+                    self.writer.save_audio(os.path.join(save_path, f"{self.env['rank']}_{i}_real.wav"), real['wav'], sample_rate)
             gen_projections = torch.stack(gen_projections, dim=0)
             real_projections = torch.stack(real_projections, dim=0)
             intelligibility_loss = torch.stack(intelligibility_losses, dim=0).mean()
@@ -341,6 +387,7 @@ class AudioDiffusionFid(evaluator.Evaluator):
                 distributed.all_reduce(intelligibility_loss)
                 intelligibility_loss = intelligibility_loss / distributed.get_world_size()
 
+        self.writer.flush()
         self.model.train()
         torch.set_rng_state(rng_state)
 
@@ -0,0 +1,103 @@
+"""
+Building blocks for evaluators that generate samples: background loading of eval items, background writing of
+artifacts and batched diffusion sampling over items of different lengths.
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import torch
+import torch.nn.functional as F
+import torchaudio
+import torchvision
+
+
+def prefetch(items, load_fn, workers=2, lookahead=4):
+    """
+    Yields load_fn(item) for every item of <items>, in order, while up to <lookahead> of the following items are loaded
+    on <workers> background threads.
+    """
+    items = list(items)
+    with ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(load_fn, item) for item in items[:lookahead]]
+        for i in range(len(items)):
+            if i + lookahead < len(items):
+                futures.append(pool.submit(load_fn, items[i + lookahead]))
+            yield futures[i].result()
+            futures[i] = None
+
+
+class ArtifactWriter:
+    """
+    Writes eval artifacts (audio clips and images) from a background thread so that evaluation does not wait on disk.
+    Tensors are moved to the CPU before they are queued. flush() blocks until everything has been written.
+    """
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.worker = threading.Thread(target=self._run, name='artifact_writer', daemon=True)
+        self.worker.start()
+
+    def _run(self):
+        while True:
+            fn, args = self.jobs.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f'Failed to write eval artifact: {e}')
+            finally:
+                self.jobs.task_done()
+
+    def save_audio(self, path, wav, sample_rate):
+        self.jobs.put((torchaudio.save, (path, wav.detach().float().cpu(), sample_rate)))
+
+    def save_image(self, path, img):
+        self.jobs.put((torchvision.utils.save_image, (img.detach().float().cpu(), path)))
+
+    def flush(self):
+        self.jobs.join()
+
+
+@contextmanager
+def isolated_rng(device):
+    """
+    Runs the enclosed block with a copy of the CPU RNG state and that of <device>, restoring both afterwards. Used for
+    work that is only done on some evals, like producing real samples that are not cached yet, so that it does not
+    shift the random numbers the generated samples are drawn from.
+    """
+    device = torch.device(device)
+    with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+        yield
+
+
+def _collate_kwarg(values):
+    if not torch.is_tensor(values[0]):
+        assert all(v == values[0] for v in values), 'Non-tensor model arguments must match across a batch.'
+        return values[0]
+    shapes = [v.shape for v in values]
+    differing = [d for d in range(len(shapes[0])) if len(set(s[d] for s in shapes)) > 1]
+    if len(differing) == 0:
+        return torch.cat(values, dim=0)
+    assert len(differing) == 1 and differing[0] != 0, f'Cannot batch tensors of shapes {shapes}'
+    d = differing[0]
+    longest = max(s[d] for s in shapes)
+    padded = []
+    for v in values:
+        pad = [0, 0] * (len(v.shape) - d - 1) + [0, longest - v.shape[d]]
+        padded.append(F.pad(v, pad))
+    return torch.cat(padded, dim=0)
+
+
+def sample_batched(sampling_fn, model, shapes, model_kwargs, **kwargs):
+    """
+    Draws one sample for each (1,c,t) shape of <shapes> with a single call to <sampling_fn> (e.g.
+    GaussianDiffusion.p_sample_loop), conditioned on the matching dict of <model_kwargs>. Samples and tensor arguments
+    that differ in length are zero-padded along the dimension in which they differ; non-tensor arguments must be the
+    same for every item. Returns the list of samples, each trimmed back to its shape.
+    """
+    if len(shapes) == 1:
+        return [sampling_fn(model, shapes[0], model_kwargs=model_kwargs[0], **kwargs)]
+    longest = max(s[-1] for s in shapes)
+    batch_kwargs = {k: _collate_kwarg([mk[k] for mk in model_kwargs]) for k in model_kwargs[0].keys()}
+    out = sampling_fn(model, (len(shapes),) + tuple(shapes[0][1:-1]) + (longest,), model_kwargs=batch_kwargs, **kwargs)
+    return [out[i:i+1, ..., :s[-1]] for i, s in enumerate(shapes)]
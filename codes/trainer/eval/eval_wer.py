@@ -1,3 +1,4 @@
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 
 #from datasets import load_metric
@@ -7,7 +8,7 @@ from tqdm import tqdm
 from transformers import Wav2Vec2Processor
 
 import trainer.eval.evaluator as evaluator
-from data import create_dataset, create_dataloader
+from data import create_dataset, create_dataloader, create_length_bucketed_sampler
 from models.audio.asr.w2v_wrapper import only_letters, Wav2VecWrapper
 from models.audio.tts.tacotron2 import sequence_to_text, tacotron_symbols
 from pyctcdecode import build_ctcdecoder
@@ -32,16 +33,16 @@ def fb_detokenize(seq):
     return fb_processor.decode(seq)
 
 
-def perform_lm_processing(logits, decoder):
+def lm_decode(logits, decoder):
+    """ Beam-decodes (t,v) numpy <logits> with a pyctcdecode <decoder>. """
     from pyctcdecode.constants import (
         DEFAULT_BEAM_WIDTH,
         DEFAULT_MIN_TOKEN_LOGP,
         DEFAULT_PRUNE_LOGP,
     )
 
-    assert len(logits.shape) == 3 and logits.shape[0] == 1
     decoded_beams = decoder.decode_beams(
-        logits[0].cpu().numpy(),
+        logits,
         beam_width=DEFAULT_BEAM_WIDTH,
         beam_prune_logp=DEFAULT_PRUNE_LOGP,
         token_min_logp=DEFAULT_MIN_TOKEN_LOGP
@@ -49,9 +50,57 @@ def perform_lm_processing(logits, decoder):
     text = decoded_beams[0][0]
     return only_letters(text.upper())
 
+
+# Decoder owned by each worker process of the LM decoding pool; kenlm models cannot be pickled.
+_worker_decoder = None
+
+
+def _init_lm_worker(kenlm_model_path):
+    global _worker_decoder
+    _worker_decoder = build_ctcdecoder(labels=tacotron_symbols(), kenlm_model_path=kenlm_model_path)
+
+
+def _lm_decode_in_worker(logits):
+    return lm_decode(logits, _worker_decoder)
+
+
+def word_edit_distance(ref, hyp):
+    """ Returns the number of word substitutions, deletions and insertions that turn <ref> into <hyp>. """
+    ref, hyp = ref.split(), hyp.split()
+    row = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref):
+        prev, row[0] = row[0], i + 1
+        for j, h in enumerate(hyp):
+            prev, row[j+1] = row[j+1], min(row[j+1] + 1, row[j] + 1, prev + (r != h))
+    return row[-1]
+
+
+class WerAccumulator:
+    """
+    Corpus-level WER (total word errors over total reference words, as computed by jiwer and the HF 'wer' metric),
+    accumulated one utterance at a time so that predictions never need to be collected.
+    """
+    def __init__(self):
+        self.errors = 0
+        self.words = 0
+
+    def add(self, pred, real):
+        self.errors += word_edit_distance(real, pred)
+        self.words += len(real.split())
+
+    def compute(self):
+        return self.errors / max(self.words, 1)
+
+
 class WerEvaluator(evaluator.Evaluator):
     """
     Evaluator that produces the WER for a speech recognition model on a test set.
+
+    Clips are evaluated in padded batches of similar length, up to <batch_size> clips and, optionally,
+    <max_samples_per_batch> padded audio samples per batch (requires a dataset that implements get_length_index(); other
+    datasets are batched in order). When a kenlm model is given, beam search runs on a pool of <decode_workers>
+    processes while the next batch is evaluated. The pool is started on the first evaluation and reused by later ones,
+    so every worker only loads the kenlm model once.
     """
     def __init__(self, model, opt_eval, env, detokenizer_fn=tacotron_detokenize):
         super().__init__(model, opt_eval, env, uses_all_ddp=False)
@@ -59,47 +108,79 @@ class WerEvaluator(evaluator.Evaluator):
         self.clip_lengths_key = opt_eval['clip_lengths_key']
         self.text_seq_key = opt_eval['text_seq_key']
         self.text_seq_lengths_key = opt_eval['text_seq_lengths_key']
-        self.wer_metric = load_metric('wer')
         self.detokenizer_fn = detokenizer_fn
+        self.batch_size = opt_get(opt_eval, ['batch_size'], 16)
+        self.max_samples_per_batch = opt_get(opt_eval, ['max_samples_per_batch'], None)
+        self.decode_workers = opt_get(opt_eval, ['decode_workers'], 2)
 
         self.kenlm_model_path = opt_get(opt_eval, ['kenlm_path'], None)
-        if self.kenlm_model_path is not None:
-            self.kenlm_decoder = build_ctcdecoder(labels=tacotron_symbols(), kenlm_model_path=self.kenlm_model_path)
+        self.decode_pool = None
 
-    def perform_eval(self):
+    def get_decode_pool(self):
+        if self.kenlm_model_path is not None and self.decode_pool is None:
+            self.decode_pool = ProcessPoolExecutor(self.decode_workers, initializer=_init_lm_worker, initargs=(self.kenlm_model_path,))
+        return self.decode_pool
+
+    def create_loader(self):
         val_opt = deepcopy(self.env['opt']['datasets']['val'])
-        val_opt['batch_size'] = 1  # This is important to ensure no padding.
+        val_opt['batch_size'] = self.batch_size
+        val_opt['pad_to_max_length'] = False
+        val_opt['length_bucketing'] = {'max_samples_per_batch': self.max_samples_per_batch, 'max_batch_size': self.batch_size}
         val_dataset, collate_fn = create_dataset(val_opt, return_collate=True)
-        val_loader = create_dataloader(val_dataset, val_opt, self.env['opt'], None, collate_fn=collate_fn)
+        if hasattr(val_dataset, 'get_length_index'):
+            # Sort the entire test set so that clips of similar length end up in the same batch.
+            val_opt['length_bucketing']['sort_window'] = len(val_dataset)
+            return create_dataloader(val_dataset, val_opt, self.env['opt'], None, collate_fn=collate_fn,
+                                     batch_sampler=create_length_bucketed_sampler(val_dataset, val_opt))
+        return create_dataloader(val_dataset, val_opt, self.env['opt'], None, collate_fn=collate_fn)
+
+    def perform_eval(self):
+        val_loader = self.create_loader()
         model = self.model.module if hasattr(self.model, 'module') else self.model  # Unwrap DDP models
         model.eval()
-        with torch.no_grad():
-            preds = []
-            reals = []
-            for batch in tqdm(val_loader):
-                clip = batch[self.clip_key]
-                assert clip.shape[0] == 1
-                real_seq = batch[self.text_seq_key]
-                real_seq_len = batch[self.text_seq_lengths_key][0]
-                real_seq = real_seq[:, :real_seq_len]
-                real_str = only_letters(sequence_to_text(real_seq[0]))
-                if len(real_str) > 0:
-                    reals.append(real_str)
-                else:
-                    continue  # The WER computer doesn't like this scenario.
-                clip_len = batch[self.clip_lengths_key][0]
-                clip = clip[:, :, :clip_len].cuda()
-                logits = model.inference_logits(clip)
-                if self.kenlm_model_path is not None:
-                    pred = perform_lm_processing(logits, self.kenlm_decoder)
+        wer = WerAccumulator()
+        pool = self.get_decode_pool()
+        pending = []
+
+        def drain(block):
+            nonlocal pending
+            remaining = []
+            for future, real_str in pending:
+                if block or future.done():
+                    wer.add(future.result(), real_str)
                 else:
-                    pred_seq = logits.argmax(dim=-1)
-                    pred_seq = [model.decode_ctc(p) for p in pred_seq]
-                    pred = self.detokenizer_fn(pred_seq[0])
-                preds.append(pred)
-        wer = self.wer_metric.compute(predictions=preds, references=reals)
+                    remaining.append((future, real_str))
+            pending = remaining
+
+        try:
+            with torch.no_grad():
+                for batch in tqdm(val_loader):
+                    real_seqs = batch[self.text_seq_key]
+                    real_seq_lens = batch[self.text_seq_lengths_key]
+                    clip_lens = batch[self.clip_lengths_key].cuda()
+                    clips = batch[self.clip_key][:, :, :clip_lens.max()].cuda()
+                    logits = model.inference_logits(clips, clip_lens)
+                    logit_lens = model.inference_output_lengths(clip_lens).tolist()
+                    if pool is not None:
+                        logits = logits.float().cpu().numpy()
+                    else:
+                        pred_seqs = logits.argmax(dim=-1).cpu()
+                    for b in range(real_seqs.shape[0]):
+                        real_str = only_letters(sequence_to_text(real_seqs[b, :real_seq_lens[b]]))
+                        if len(real_str) == 0:
+                            continue  # The WER computer doesn't like this scenario.
+                        if pool is not None:
+                            pending.append((pool.submit(_lm_decode_in_worker, logits[b, :logit_lens[b]]), real_str))
+                        else:
+                            wer.add(self.detokenizer_fn(model.decode_ctc(pred_seqs[b, :logit_lens[b]])), real_str)
+                    drain(block=False)
+            drain(block=True)
+        finally:
+            # Decodes are only left pending when evaluation failed part of the way through.
+            for future, _ in pending:
+                future.cancel()
         model.train()
-        return {'eval_wer': wer}
+        return {'eval_wer': wer.compute()}
 
 
 if __name__ == '__main__':
@@ -128,6 +209,7 @@ if __name__ == '__main__':
         'clip_lengths_key': 'wav_lengths',
         'text_seq_key': 'padded_text',
         'text_seq_lengths_key': 'text_lengths',
+        'batch_size': 16,
         #'kenlm_path': 'Y:\\bookscorpus-5gram\\5gram.bin',
     }
     model = Wav2VecWrapper(vocab_size=148, basis_model='facebook/wav2vec2-large-robust-ft-libri-960h', freeze_transformer=True, checkpointing_enabled=False)
@@ -5,6 +5,8 @@ import pkgutil
 import re
 import sys
 
+from utils.registry import LazyRegistry
+
 
 class Evaluator:
     def __init__(self, model, opt_eval, env, uses_all_ddp=True):
@@ -37,13 +39,20 @@ def find_registered_evaluators(base_path="trainer/eval"):
             mod_name = f'{base_path}/{mod.name}'.replace('/', '.')
             if 'eval_wer' in mod.name: continue # TODO: this causes an import error for PyCtcDecode. get rid of this if there's a need to use that evaluator.
             importlib.import_module(mod_name)
-            classes = inspect.getmembers(sys.modules[mod_name], inspect.isclass)
-            for name, obj in classes:
-                if 'Evaluator' in [mro.__name__ for mro in inspect.getmro(obj)]:
-                    results[format_evaluator_name(name)] = obj
+            for name, _, obj in _evaluators_in(sys.modules[mod_name]):
+                results[name] = obj
     return results
 
 
+def _evaluators_in(module):
+    return [(format_evaluator_name(name), name, obj) for name, obj in inspect.getmembers(module, inspect.isclass)
+            if 'Evaluator' in [mro.__name__ for mro in inspect.getmro(obj)]]
+
+
+# Used by create_evaluator() so that only the module defining the requested evaluator is imported.
+evaluator_registry = LazyRegistry('evaluator', 'trainer/eval', _evaluators_in, exclude_modules=['eval_wer'])
+
+
 class CreateEvaluatorError(Exception):
     def __init__(self, name, available):
         super().__init__(f'Could not find the specified evaluator name: {name}.  Available evaluators:'
@@ -51,8 +60,7 @@ class CreateEvaluatorError(Exception):
 
 
 def create_evaluator(model, opt_eval, env):
-    evaluators = find_registered_evaluators()
     type = opt_eval['type']
-    if type not in evaluators.keys():
-        raise CreateEvaluatorError(type, list(evaluators.keys()))
-    return evaluators[opt_eval['type']](model, opt_eval, env)
+    if type not in evaluator_registry:
+        raise CreateEvaluatorError(type, evaluator_registry.names())
+    return evaluator_registry.get(type)(model, opt_eval, env)
@@ -1,5 +1,4 @@
 import os
-import os
 import os.path as osp
 from glob import glob
 
@@ -16,7 +15,9 @@ import trainer.eval.evaluator as evaluator
 from data.audio.unsupervised_audio_dataset import load_audio
 from models.clip.contrastive_audio import ContrastiveAudio
 from models.diffusion.gaussian_diffusion import get_named_beta_schedule
+from models.diffusion.multistep_solvers import SOLVERS
 from models.diffusion.respace import space_timesteps, SpacedDiffusion
+from trainer.eval.eval_pipeline import ArtifactWriter, isolated_rng, prefetch
 from trainer.injectors.audio_injectors import denormalize_torch_mel, TorchMelSpectrogramInjector, pixel_shuffle_1d, \
     KmeansQuantizerInjector, normalize_torch_mel
 from utils.music_utils import get_music_codegen, get_cheater_decoder, get_cheater_encoder, \
@@ -27,6 +28,11 @@ from utils.util import opt_get, load_model_from_config
 class MusicDiffusionFid(evaluator.Evaluator):
     """
     Evaluator produces generate from a music diffusion model.
+
+    Every diffusion_fn operates on a (b,1,t) batch of clips. Up to <eval_batch_size> consecutive clips of the same
+    length (with clip_audio, that is every clip longer than the clip length) are generated together. Clips are loaded
+    on background threads, artifacts are written from a background thread and the real samples, which do not change
+    between evaluations, are only generated and projected during the first one.
     """
     def __init__(self, model, opt_eval, env):
         super().__init__(model, opt_eval, env, uses_all_ddp=True)
@@ -47,13 +53,23 @@ class MusicDiffusionFid(evaluator.Evaluator):
             diffusion_schedule = opt_get(opt_eval, ['diffusion_schedule'], 'linear')
         conditioning_free_diffusion_enabled = opt_get(opt_eval, ['conditioning_free'], False)
         conditioning_free_k = opt_get(opt_eval, ['conditioning_free_k'], 1)
-        self.diffuser = SpacedDiffusion(use_timesteps=space_timesteps(4000, [diffusion_steps]), model_mean_type='epsilon',
+        # 'p', 'ddim' or one of the multistep ODE solvers. The solvers pick their own timesteps, so for them the
+        # diffuser is not respaced and diffusion_steps is the number of solver steps.
+        self.sampler = opt_get(opt_eval, ['sampler'], 'ddim' if self.ddim else 'p')
+        self.diffuser = SpacedDiffusion(use_timesteps=space_timesteps(4000, [4000 if self.sampler in SOLVERS else diffusion_steps]), model_mean_type='epsilon',
                            model_var_type='learned_range', loss_type='mse', betas=get_named_beta_schedule(diffusion_schedule, 4000),
                            conditioning_free=conditioning_free_diffusion_enabled, conditioning_free_k=conditioning_free_k)
+        self.sampling_fn = self.diffuser.get_sampling_fn(self.sampler, steps=diffusion_steps,
+                                                         order=opt_get(opt_eval, ['solver_order'], 2),
+                                                         schedule=opt_get(opt_eval, ['solver_schedule'], 'karras'))
         self.spectral_diffuser = SpacedDiffusion(use_timesteps=space_timesteps(4000, [16 if self.ddim else 100]), model_mean_type='epsilon',
                            model_var_type='learned_range', loss_type='mse', betas=get_named_beta_schedule('linear', 4000),
                            conditioning_free=False, conditioning_free_k=1)
         self.dev = self.env['device']
+        self.batch_size = opt_get(opt_eval, ['eval_batch_size'], 1)
+        self.loader_threads = opt_get(opt_eval, ['loader_threads'], 2)
+        self.real_cache = {}
+        self.writer = ArtifactWriter()
         mode = opt_get(opt_eval, ['diffusion_type'], 'spec_decode')
 
         self.projector = ContrastiveAudio(model_dim=512, transformer_heads=8, dropout=0, encoder_depth=8, mel_channels=256)
@@ -96,30 +112,28 @@ class MusicDiffusionFid(evaluator.Evaluator):
     def load_data(self, path):
         return list(glob(f'{path}/*.wav'))
 
-    def perform_diffusion_spec_decode(self, audio, sample_rate=22050):
+    def perform_diffusion_spec_decode(self, audio, sample_rate=22050, need_real=True):
         real_resampled = audio
-        audio = audio.unsqueeze(0)
-        output_shape = (1, self.squeeze_ratio, audio.shape[-1] // self.squeeze_ratio)
+        output_shape = (audio.shape[0], self.squeeze_ratio, audio.shape[-1] // self.squeeze_ratio)
         mel = self.spec_fn({'in': audio})['out']
-        gen = self.diffuser.p_sample_loop(self.model, output_shape,
-                                          model_kwargs={'codes': mel})
+        gen = self.sampling_fn(self.model, output_shape,
+                               model_kwargs={'codes': mel})
         gen = pixel_shuffle_1d(gen, self.squeeze_ratio)
 
         return gen, real_resampled, normalize_torch_mel(self.spec_fn({'in': gen})['out']), normalize_torch_mel(mel), sample_rate, 0
 
-    def perform_diffusion_from_codes(self, audio, sample_rate=22050):
+    def perform_diffusion_from_codes(self, audio, sample_rate=22050, need_real=True):
         real_resampled = audio
-        audio = audio.unsqueeze(0)
 
         mel = self.spec_fn({'in': audio})['out']
         codegen = self.local_modules['codegen'].to(mel.device)
         codes = codegen.get_codes(mel, project=True)
         mel_norm = normalize_torch_mel(mel)
-        gen_mel = self.diffuser.p_sample_loop(self.model, mel_norm.shape,
-                                              model_kwargs={'codes': codes, 'conditioning_input': torch.zeros_like(mel_norm[:,:,:390])})
+        gen_mel = self.sampling_fn(self.model, mel_norm.shape,
+                                   model_kwargs={'codes': codes, 'conditioning_input': torch.zeros_like(mel_norm[:,:,:390])})
 
         gen_mel_denorm = denormalize_torch_mel(gen_mel)
-        output_shape = (1,16,audio.shape[-1]//16)
+        output_shape = (audio.shape[0],16,audio.shape[-1]//16)
         self.spec_decoder = self.spec_decoder.to(audio.device)
         gen_wav = self.spectral_diffuser.p_sample_loop(self.spec_decoder, output_shape,
                                               model_kwargs={'aligned_conditioning': gen_mel_denorm})
@@ -127,9 +141,7 @@ class MusicDiffusionFid(evaluator.Evaluator):
 
         return gen_wav, real_resampled, gen_mel, mel_norm, sample_rate, torch.tensor([0])
 
-    def perform_diffusion_from_codes_quant(self, audio, sample_rate=22050):
-        audio = audio.unsqueeze(0)
-
+    def perform_diffusion_from_codes_quant(self, audio, sample_rate=22050, need_real=True):
         mel = self.spec_fn({'in': audio})['out']
         mel_norm = normalize_torch_mel(mel)
         #def denoising_fn(x):
@@ -140,59 +152,49 @@ class MusicDiffusionFid(evaluator.Evaluator):
         #perp = self.diffuser.p_sample_loop_for_log_perplexity(self.model, mel_norm,
         #                                                      model_kwargs = {'truth_mel': mel_norm})
 
-        sampler = self.diffuser.ddim_sample_loop if self.ddim else self.diffuser.p_sample_loop
+        sampler = self.sampling_fn
         gen_mel = sampler(self.model, mel_norm.shape, model_kwargs={'truth_mel': mel_norm})
 
         gen_mel_denorm = denormalize_torch_mel(gen_mel)
-        output_shape = (1,16,audio.shape[-1]//16)
+        output_shape = (audio.shape[0],16,audio.shape[-1]//16)
         self.spec_decoder = self.spec_decoder.to(audio.device)
         sampler = self.spectral_diffuser.ddim_sample_loop if self.ddim else self.spectral_diffuser.p_sample_loop
         gen_wav = sampler(self.spec_decoder, output_shape,
                                               model_kwargs={'codes': gen_mel_denorm})
         gen_wav = pixel_shuffle_1d(gen_wav, 16)
 
-        real_wav = sampler(self.spec_decoder, output_shape,
-                                              model_kwargs={'codes': mel})
-        real_wav = pixel_shuffle_1d(real_wav, 16)
-
-        return gen_wav, real_wav.squeeze(0), gen_mel, mel_norm, sample_rate, torch.tensor([0])
-
-    def perform_reconstruction_from_cheater_gen(self, audio, sample_rate=22050):
-        audio = audio.unsqueeze(0)
+        real_wav = self.decode_real(sampler, mel, output_shape, need_real)
+        return gen_wav, real_wav, gen_mel, mel_norm, sample_rate, torch.tensor([0])
 
+    def perform_reconstruction_from_cheater_gen(self, audio, sample_rate=22050, need_real=True):
         mel = self.spec_fn({'in': audio})['out']
         mel_norm = normalize_torch_mel(mel)
         cheater = self.local_modules['cheater_encoder'].to(audio.device)(mel_norm)
 
         # 1. Generate the cheater latent using the input as a reference.
-        sampler = self.diffuser.ddim_sample_loop if self.ddim else self.diffuser.p_sample_loop
+        sampler = self.sampling_fn
         # center-pad the conditioning input (the center isn't actually used). this is hack for giving tfdpc5 a bigger working context.
-        cheater_padded = torch.cat([cheater[:,:,cheater.shape[-1]//2:], torch.zeros(1,256,160, device=cheater.device),  cheater[:,:,:cheater.shape[-1]//2]], dim=-1)
+        cheater_padded = torch.cat([cheater[:,:,cheater.shape[-1]//2:], torch.zeros(cheater.shape[0],256,160, device=cheater.device),  cheater[:,:,:cheater.shape[-1]//2]], dim=-1)
         gen_cheater = sampler(self.model, cheater.shape, progress=True,
                               causal=self.causal, causal_slope=self.causal_slope,
                               model_kwargs={'conditioning_input': cheater_padded, 'cond_start': 80})
 
         # 2. Decode the cheater into a MEL
-        gen_mel = self.cheater_decoder_diffuser.ddim_sample_loop(self.local_modules['cheater_decoder'].diff.to(audio.device), (1,256,gen_cheater.shape[-1]*16), progress=True,
+        gen_mel = self.cheater_decoder_diffuser.ddim_sample_loop(self.local_modules['cheater_decoder'].diff.to(audio.device), (gen_cheater.shape[0],256,gen_cheater.shape[-1]*16), progress=True,
                                                  model_kwargs={'codes': gen_cheater.permute(0,2,1)})
 
         # 3. And then the MEL back into a spectrogram
-        output_shape = (1,16,audio.shape[-1]//16)
+        output_shape = (audio.shape[0],16,audio.shape[-1]//16)
         self.spec_decoder = self.spec_decoder.to(audio.device)
         gen_mel_denorm = denormalize_torch_mel(gen_mel)
         gen_wav = self.spectral_diffuser.ddim_sample_loop(self.spec_decoder, output_shape,
                                               model_kwargs={'codes': gen_mel_denorm})
         gen_wav = pixel_shuffle_1d(gen_wav, 16)
 
-        real_wav = self.spectral_diffuser.ddim_sample_loop(self.spec_decoder, output_shape,
-                                              model_kwargs={'codes': mel})
-        real_wav = pixel_shuffle_1d(real_wav, 16)
-
-        return gen_wav, real_wav.squeeze(0), gen_mel, mel_norm, sample_rate, torch.tensor([0])
-
-    def perform_diffusion_from_codes_ar_prior(self, audio, sample_rate=22050):
-        audio = audio.unsqueeze(0)
+        real_wav = self.decode_real(self.spectral_diffuser.ddim_sample_loop, mel, output_shape, need_real)
+        return gen_wav, real_wav, gen_mel, mel_norm, sample_rate, torch.tensor([0])
 
+    def perform_diffusion_from_codes_ar_prior(self, audio, sample_rate=22050, need_real=True):
         mel = self.spec_fn({'in': audio})['out']
         mel_norm = normalize_torch_mel(mel)
         cheater = self.local_modules['cheater_encoder'].to(audio.device)(mel_norm)
@@ -200,52 +202,58 @@ class MusicDiffusionFid(evaluator.Evaluator):
         ar_latent = self.local_modules['ar_prior'].to(audio.device)(cheater_codes, cheater, return_latent=True)
 
         # 1. Generate the cheater latent using the input as a reference.
-        sampler = self.diffuser.ddim_sample_loop if self.ddim else self.diffuser.p_sample_loop
+        sampler = self.sampling_fn
         gen_cheater = sampler(self.model, cheater.shape, progress=True,
                               causal=self.causal, causal_slope=self.causal_slope,
                               model_kwargs={'codes': ar_latent})
 
         # 2. Decode the cheater into a MEL
-        gen_mel = self.cheater_decoder_diffuser.ddim_sample_loop(self.local_modules['cheater_decoder'].diff.to(audio.device), (1,256,gen_cheater.shape[-1]*16), progress=True,
+        gen_mel = self.cheater_decoder_diffuser.ddim_sample_loop(self.local_modules['cheater_decoder'].diff.to(audio.device), (gen_cheater.shape[0],256,gen_cheater.shape[-1]*16), progress=True,
                                                  model_kwargs={'codes': gen_cheater.permute(0,2,1)})
         gen_mel_denorm = denormalize_torch_mel(gen_mel)
 
         # 3. Decode into waveform.
-        output_shape = (1,16,audio.shape[-1]//16)
+        output_shape = (audio.shape[0],16,audio.shape[-1]//16)
         self.spec_decoder = self.spec_decoder.to(audio.device)
         gen_wav = self.spectral_diffuser.ddim_sample_loop(self.spec_decoder, output_shape, model_kwargs={'codes': gen_mel_denorm})
         gen_wav = pixel_shuffle_1d(gen_wav, 16)
 
-        real_wav = self.spectral_diffuser.ddim_sample_loop(self.spec_decoder, output_shape, model_kwargs={'codes': mel})
-        real_wav = pixel_shuffle_1d(real_wav, 16)
-
-        return gen_wav, real_wav.squeeze(0), gen_mel, mel_norm, sample_rate, torch.tensor([0])
+        real_wav = self.decode_real(self.spectral_diffuser.ddim_sample_loop, mel, output_shape, need_real)
+        return gen_wav, real_wav, gen_mel, mel_norm, sample_rate, torch.tensor([0])
 
-    def perform_chained_sr(self, audio, sample_rate=22050):
-        audio = audio.unsqueeze(0)
+    def perform_chained_sr(self, audio, sample_rate=22050, need_real=True):
         mel = self.spec_fn({'in': audio})['out']
         mel_norm = normalize_torch_mel(mel)
         conditioning = mel_norm[:,:,:1200]
         downsampled = F.interpolate(mel_norm, scale_factor=1/4, mode='nearest')
-        stage1_shape = (1, 256, downsampled.shape[-1]*4)
-        sampler = self.diffuser.ddim_sample_loop if self.ddim else self.diffuser.p_sample_loop
+        stage1_shape = (audio.shape[0], 256, downsampled.shape[-1]*4)
+        sampler = self.sampling_fn
         # (Eventually) Chain super-sampling using 2 stages.
-        #stage1 = sampler(self.model, stage1_shape, model_kwargs={'resolution': torch.tensor([1], device=audio.device),
+        #stage1 = sampler(self.model, stage1_shape, model_kwargs={'resolution': torch.tensor([1], device=audio.device).repeat(audio.shape[0]),
         #                                                         'x_prior': downsampled,
         #                                                         'conditioning_input': conditioning})
-        stage2 = sampler(self.model, mel.shape,    model_kwargs={'resolution': torch.tensor([0], device=audio.device),
+        stage2 = sampler(self.model, mel.shape,    model_kwargs={'resolution': torch.tensor([0], device=audio.device).repeat(audio.shape[0]),
                                                                  'x_prior': downsampled,
                                                                  'conditioning_input': conditioning})
         # Decode into waveform.
-        output_shape = (1,16,audio.shape[-1]//16)
+        output_shape = (audio.shape[0],16,audio.shape[-1]//16)
         self.spec_decoder = self.spec_decoder.to(audio.device)
         gen_wav = self.spectral_diffuser.ddim_sample_loop(self.spec_decoder, output_shape, model_kwargs={'codes': stage2})
         gen_wav = pixel_shuffle_1d(gen_wav, 16)
 
-        real_wav = self.spectral_diffuser.ddim_sample_loop(self.spec_decoder, output_shape, model_kwargs={'codes': mel})
-        real_wav = pixel_shuffle_1d(real_wav, 16)
+        real_wav = self.decode_real(self.spectral_diffuser.ddim_sample_loop, mel, output_shape, need_real)
+        return gen_wav, real_wav, stage2, mel_norm, sample_rate, torch.tensor([0])
 
-        return gen_wav, real_wav.squeeze(0), stage2, mel_norm, sample_rate, torch.tensor([0])
+    def decode_real(self, sampler, mel, output_shape, need_real):
+        """
+        Decodes the MEL of the real clips into waveforms with the spectrogram decoder, if <need_real>. Evals that find
+        the real clips cached skip this, so it does not draw from the RNG the generated clips use.
+        """
+        if not need_real:
+            return None
+        with isolated_rng(mel.device):
+            real_wav = sampler(self.spec_decoder, output_shape, model_kwargs={'codes': mel})
+        return pixel_shuffle_1d(real_wav, 16)
 
     def project(self, sample, sample_rate):
         sample = torchaudio.functional.resample(sample, sample_rate, 22050)
@@ -266,6 +274,24 @@ class MusicDiffusionFid(evaluator.Evaluator):
         except:
             return 0
 
+    def load_item(self, item):
+        i, index = item
+        audio = load_audio(self.data[index], 22050)
+        if self.clip:
+            audio = audio[:, :100000]
+        return i, index, audio
+
+    def batches(self, items):
+        """ Groups consecutive (i, index, audio) items of the same length into batches of up to <eval_batch_size>. """
+        batch = []
+        for item in tqdm(items, total=len(range(0, len(self.data), self.skip))):
+            if len(batch) > 0 and (len(batch) == self.batch_size or batch[0][2].shape != item[2].shape):
+                yield batch
+                batch = []
+            batch.append(item)
+        if len(batch) > 0:
+            yield batch
+
     def perform_eval(self):
         save_path = osp.join(self.env['base_path'], "../", "audio_eval", str(self.env["step"]))
         os.makedirs(save_path, exist_ok=True)
@@ -282,24 +308,28 @@ class MusicDiffusionFid(evaluator.Evaluator):
             gen_projections = []
             real_projections = []
             perplexities = []
-            for i in tqdm(list(range(0, len(self.data), self.skip))):
-                path = self.data[(i + self.env['rank']) % len(self.data)]
-                audio = load_audio(path, 22050).to(self.dev)
-                #audio = load_audio('C:\\Users\\James\\Music\\another_longer_sample.wav', 22050).to(self.dev)  # <- hack, remove it!
-                #audio = audio[:, :1764000]
-                if self.clip:
-                    audio = audio[:, :100000]
-                sample, ref, sample_mel, ref_mel, sample_rate, perplexity = self.diffusion_fn(audio)
+            steps = list(range(0, len(self.data), self.skip))
+            items = prefetch([(i, (i + self.env['rank']) % len(self.data)) for i in steps], self.load_item, workers=self.loader_threads)
+            for batch in self.batches(items):
+                indices = [index for _, index, _ in batch]
+                audio = torch.stack([a for _, _, a in batch], dim=0).to(self.dev)
+                need_real = any(index not in self.real_cache.keys() for index in indices)
+                sample, ref, sample_mel, ref_mel, sample_rate, perplexity = self.diffusion_fn(audio, need_real=need_real)
                 # Future note: need to normalize perplexity by the size of the input sample, which are always equal for now but not gauranteed for the future.
-                perplexities.append(perplexity)
-
-                gen_projections.append(self.project(sample, sample_rate).cpu())  # Store on CPU to avoid wasting GPU memory.
-                real_projections.append(self.project(ref, sample_rate).cpu())
-
-                torchaudio.save(os.path.join(save_path, f"{self.env['rank']}_{i}_gen.wav"), sample.squeeze(0).cpu(), sample_rate)
-                torchaudio.save(os.path.join(save_path, f"{self.env['rank']}_{i}_real.wav"), ref.cpu(), sample_rate)
-                torchvision.utils.save_image((sample_mel.unsqueeze(1) + 1) / 2, os.path.join(save_path, f"{self.env['rank']}_{i}_gen_mel.png"))
-                torchvision.utils.save_image((ref_mel.unsqueeze(1) + 1) / 2, os.path.join(save_path, f"{self.env['rank']}_{i}_real_mel.png"))
+                perplexities.extend([perplexity] * len(batch))
+
+                for j, (i, index, _) in enumerate(batch):
+                    if index not in self.real_cache.keys():
+                        self.real_cache[index] = {'projection': self.project(ref[j], sample_rate).cpu(),
+                                                  'wav': ref[j].cpu(), 'mel': ref_mel[j:j+1].cpu()}
+                    real = self.real_cache[index]
+                    gen_projections.append(self.project(sample[j:j+1], sample_rate).cpu())  # Store on CPU to avoid wasting GPU memory.
+                    real_projections.append(real['projection'])
+
+                    self.writer.save_audio(os.path.join(save_path, f"{self.env['rank']}_{i}_gen.wav"), sample[j], sample_rate)
+                    self.writer.save_audio(os.path.join(save_path, f"{self.env['rank']}_{i}_real.wav"), real['wav'], sample_rate)
+                    self.writer.save_image(os.path.join(save_path, f"{self.env['rank']}_{i}_gen_mel.png"), (sample_mel[j:j+1].unsqueeze(1) + 1) / 2)
+                    self.writer.save_image(os.path.join(save_path, f"{self.env['rank']}_{i}_real_mel.png"), (real['mel'].unsqueeze(1) + 1) / 2)
             gen_projections = torch.stack(gen_projections, dim=0)
             real_projections = torch.stack(real_projections, dim=0)
             frechet_distance = torch.tensor(self.compute_frechet_distance(gen_projections, real_projections), device=self.env['device'])
@@ -309,6 +339,7 @@ class MusicDiffusionFid(evaluator.Evaluator):
                 distributed.all_reduce(frechet_distance)
                 frechet_distance = frechet_distance / distributed.get_world_size()
 
+        self.writer.flush()
         self.model.train()
         torch.set_rng_state(rng_state)
 
@@ -6,6 +6,8 @@ import sys
 
 import torch.nn
 
+from utils.registry import LazyRegistry
+
 
 # Base class for all other injectors.
 class Injector(torch.nn.Module):
@@ -43,13 +45,20 @@ def find_registered_injectors(base_path="trainer/injectors"):
         else:
             mod_name = f'{base_path}/{mod.name}'.replace('/', '.')
             importlib.import_module(mod_name)
-            classes = inspect.getmembers(sys.modules[mod_name], inspect.isclass)
-            for name, obj in classes:
-                if 'Injector' in [mro.__name__ for mro in inspect.getmro(obj)]:
-                    results[format_injector_name(name)] = obj
+            for name, _, obj in _injectors_in(sys.modules[mod_name]):
+                results[name] = obj
     return results
 
 
+def _injectors_in(module):
+    return [(format_injector_name(name), name, obj) for name, obj in inspect.getmembers(module, inspect.isclass)
+            if 'Injector' in [mro.__name__ for mro in inspect.getmro(obj)]]
+
+
+# Used by create_injector() so that only the module defining the requested injector is imported.
+injector_registry = LazyRegistry('injector', 'trainer/injectors', _injectors_in)
+
+
 class CreateInjectorError(Exception):
     def __init__(self, name, available):
         super().__init__(f'Could not find the specified injector name: {name}.  Available injectors:'
@@ -58,8 +67,7 @@ class CreateInjectorError(Exception):
 
 # Injectors are a way to synthesize data within a step that can then be used (and reused) by loss functions.
 def create_injector(opt_inject, env):
-    injectors = find_registered_injectors()
     type = opt_inject['type']
-    if type not in injectors.keys():
-        raise CreateInjectorError(type, list(injectors.keys()))
-    return injectors[opt_inject['type']](opt_inject, env)
+    if type not in injector_registry:
+        raise CreateInjectorError(type, injector_registry.names())
+    return injector_registry.get(type)(opt_inject, env)
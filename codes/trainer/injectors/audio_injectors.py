@@ -1,4 +1,6 @@
 import random
+import threading
+from functools import lru_cache
 
 import torch
 import torch.nn.functional as F
@@ -37,6 +39,8 @@ class MelSpectrogramInjector(Injector):
         mel_fmin = opt_get(opt, ['mel_fmin'], 0)
         mel_fmax = opt_get(opt, ['mel_fmax'], 8000)
         sampling_rate = opt_get(opt, ['sampling_rate'], 22050)
+        self.filter_length = filter_length
+        self.hop_length = hop_length
         self.stft = TacotronSTFT(filter_length, hop_length, win_length, n_mel_channels, sampling_rate, mel_fmin, mel_fmax)
         self.do_normalization = opt_get(opt, ['do_normalization'], None)  # This is different from the TorchMelSpectrogramInjector. This just normalizes to the range [-1,1]
 
@@ -72,7 +76,7 @@ class TorchMelSpectrogramInjector(Injector):
                                                              norm="slaney")
         self.mel_norm_file = opt_get(opt, ['mel_norm_file'], None)
         if self.mel_norm_file is not None:
-            self.mel_norms = torch.load(self.mel_norm_file)
+            self.mel_norms = load_mel_norms(self.mel_norm_file)
         else:
             self.mel_norms = None
 
@@ -94,6 +98,50 @@ class TorchMelSpectrogramInjector(Injector):
             return {self.output: mel}
 
 
+@lru_cache(maxsize=None)
+def load_mel_norms(path):
+    return torch.load(path)
+
+
+_mel_frontends = {}
+_mel_frontends_lock = threading.Lock()
+
+
+def get_mel_frontend(injector_cls, device=None, **opt):
+    """
+    Returns a process-wide instance of <injector_cls> (MelSpectrogramInjector or TorchMelSpectrogramInjector) built
+    from <opt> and resident on <device>, reading the input 'in' and writing 'out'. Building a front end computes its mel
+    filterbank and STFT window and may load MEL norms from disk, so code that converts clips outside of a training
+    graph should get it from here instead of constructing it for every call.
+    """
+    key = (injector_cls, str(device), tuple(sorted(opt.items())))
+    with _mel_frontends_lock:
+        if key not in _mel_frontends.keys():
+            frontend = injector_cls({'in': 'in', 'out': 'out', **opt}, {}).eval()
+            if device is not None:
+                frontend = frontend.to(device)
+            _mel_frontends[key] = frontend
+        return _mel_frontends[key]
+
+
+def compute_mel_batch(frontend, clips):
+    """
+    Converts a list of mono clips of different lengths into MELs with <frontend> (see get_mel_frontend()) using a single
+    padded STFT. Every clip is reflect-padded past its end exactly as the STFT pads a lone clip, so the results match
+    those of converting the clips one at a time. Returns a list of (1,c,s) MELs.
+    """
+    lengths = [c.shape[-1] for c in clips]
+    padded = []
+    for c, l in zip(clips, lengths):
+        c = c.reshape(1, 1, -1)
+        ext = min(frontend.filter_length // 2, l - 1)
+        if ext > 0:
+            c = F.pad(c, (0, ext), mode='reflect')
+        padded.append(F.pad(c, (0, max(lengths) + frontend.filter_length // 2 - c.shape[-1])).view(-1))
+    mels = frontend({'in': torch.stack(padded, dim=0)})['out']
+    return [mels[i:i+1, :, :l // frontend.hop_length + 1] for i, l in enumerate(lengths)]
+
+
 class RandomAudioCropInjector(Injector):
     def __init__(self, opt, env):
         super().__init__(opt, env)
@@ -6,6 +6,7 @@ from torch.cuda.amp import autocast
 
 from trainer.inject import Injector, create_injector
 from trainer.losses import extract_params_from_state
+from utils.tiled_inference import tiled_inference
 from utils.util import opt_get
 from utils.weight_scheduler import get_scheduler_for_opt
 
@@ -76,6 +77,12 @@ class GeneratorInjector(Injector):
         self.method = opt_get(opt, ['method'], None)  # If specified, this method is called instead of __call__()
         self.args = opt_get(opt, ['args'], {})
         self.fp16_override = opt_get(opt, ['fp16'], True)
+        # If specified, the generator is applied to overlapping tiles of the input image rather than the whole image,
+        # bounding memory use on large inputs. Keys are the arguments of utils.tiled_inference.tiled_inference().
+        # Only supported for generators that take and return a single image and are not trained through this injector.
+        self.tiling = opt_get(opt, ['tiling'], None)
+        if self.tiling is not None:
+            assert not self.grad and not isinstance(self.input, list) and not isinstance(self.output, list)
 
     def forward(self, state):
         gen = self.env['generators'][self.opt['generator']]
@@ -95,7 +102,10 @@ class GeneratorInjector(Injector):
                 was_training = gen.training
                 gen.eval()
                 with torch.no_grad():
-                    results = method(*params, **self.args)
+                    if self.tiling is not None:
+                        results = tiled_inference(lambda x: method(x, **self.args), params[0], **self.tiling)
+                    else:
+                        results = method(*params, **self.args)
                 if was_training:
                     gen.train()
         new_state = {}
@@ -5,6 +5,7 @@ import torch
 from torch.cuda.amp import autocast
 
 from models.diffusion.gaussian_diffusion import get_named_beta_schedule
+from models.diffusion.multistep_solvers import SOLVERS
 from models.diffusion.resample import create_named_schedule_sampler, LossAwareSampler, DeterministicSampler, LossSecondMomentResampler
 from models.diffusion.respace import space_timesteps, SpacedDiffusion
 from trainer.inject import Injector
@@ -133,18 +134,25 @@ class GaussianDiffusionInferenceInjector(Injector):
     def __init__(self, opt, env):
         super().__init__(opt, env)
         use_ddim = opt_get(opt, ['use_ddim'], False)
+        # 'p', 'ddim' or one of the multistep ODE solvers (see models/diffusion/multistep_solvers.py).
+        sampler = opt_get(opt, ['sampler'], 'ddim' if use_ddim else 'p')
         self.generator = opt['generator']
         self.output_batch_size = opt['output_batch_size']
         self.output_scale_factor = opt['output_scale_factor']
         self.undo_n1_to_1 = opt_get(opt, ['undo_n1_to_1'], False)  # Explanation: when specified, will shift the output of this injector from [-1,1] to [0,1]
         opt['diffusion_args']['betas'] = get_named_beta_schedule(**opt['beta_schedule'])
-        if use_ddim:
+        if sampler == 'ddim':
             spacing = "ddim" + str(opt['respaced_timestep_spacing'])
+        elif sampler in SOLVERS:
+            # The solvers pick their own timesteps from the full schedule.
+            spacing = [opt['beta_schedule']['num_diffusion_timesteps']]
         else:
             spacing = [opt_get(opt, ['respaced_timestep_spacing'], opt['beta_schedule']['num_diffusion_timesteps'])]
         opt['diffusion_args']['use_timesteps'] = space_timesteps(opt['beta_schedule']['num_diffusion_timesteps'], spacing)
         self.diffusion = SpacedDiffusion(**opt['diffusion_args'])
-        self.sampling_fn = self.diffusion.ddim_sample_loop if use_ddim else self.diffusion.p_sample_loop
+        self.sampling_fn = self.diffusion.get_sampling_fn(sampler, steps=opt_get(opt, ['solver_steps'], 20),
+                                                          order=opt_get(opt, ['solver_order'], 2),
+                                                          schedule=opt_get(opt, ['solver_schedule'], 'karras'))
         self.model_input_keys = opt_get(opt, ['model_input_keys'], [])
         self.use_ema_model = opt_get(opt, ['use_ema'], False)
         self.noise_style = opt_get(opt, ['noise_type'], 'random')  # 'zero', 'fixed' or 'random'
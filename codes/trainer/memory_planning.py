@@ -0,0 +1,205 @@
+"""
+GPU memory management for the trainer: when to release cached allocator blocks, and picking the gradient accumulation
+factor (mega_batch_factor) that fits a memory target.
+
+Both work through an Allocator, so that the planning logic can be exercised on the CPU with SimulatedAllocator.
+"""
+import math
+
+import torch
+from torch import distributed
+
+
+class Allocator:
+    """ The view of device memory the trainer needs. """
+    def reset_peak(self):
+        raise NotImplementedError
+
+    def peak(self):
+        """ Returns the most bytes allocated at once since reset_peak(). """
+        raise NotImplementedError
+
+    def capacity(self):
+        """ Returns the total bytes the device has. """
+        raise NotImplementedError
+
+    def empty_cache(self):
+        raise NotImplementedError
+
+    def is_oom(self, e):
+        """ Returns whether exception <e> reports that the device ran out of memory. """
+        raise NotImplementedError
+
+
+class CudaAllocator(Allocator):
+    def __init__(self, device=None):
+        self.device = device
+
+    def reset_peak(self):
+        torch.cuda.reset_peak_memory_stats(self.device)
+
+    def peak(self):
+        return torch.cuda.max_memory_allocated(self.device)
+
+    def capacity(self):
+        return torch.cuda.get_device_properties(self.device).total_memory
+
+    def empty_cache(self):
+        torch.cuda.empty_cache()
+
+    def is_oom(self, e):
+        if hasattr(torch.cuda, 'OutOfMemoryError') and isinstance(e, torch.cuda.OutOfMemoryError):
+            return True
+        return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+class SimulatedOutOfMemory(RuntimeError):
+    pass
+
+
+class SimulatedAllocator(Allocator):
+    """
+    Allocator for testing on the CPU: code under test reports its allocations with allocate() and free(), which raise
+    SimulatedOutOfMemory when <capacity_bytes> would be exceeded.
+    """
+    def __init__(self, capacity_bytes):
+        self.capacity_bytes = capacity_bytes
+        self.allocated = 0
+        self.max_allocated = 0
+        self.empty_cache_calls = 0
+
+    def allocate(self, n):
+        if self.allocated + n > self.capacity_bytes:
+            raise SimulatedOutOfMemory(f'out of memory: tried to allocate {n} bytes')
+        self.allocated += n
+        self.max_allocated = max(self.max_allocated, self.allocated)
+
+    def free(self, n):
+        self.allocated -= n
+
+    def reset_peak(self):
+        self.max_allocated = self.allocated
+
+    def peak(self):
+        return self.max_allocated
+
+    def capacity(self):
+        return self.capacity_bytes
+
+    def empty_cache(self):
+        self.empty_cache_calls += 1
+
+    def is_oom(self, e):
+        return isinstance(e, SimulatedOutOfMemory)
+
+
+def create_allocator():
+    return CudaAllocator() if torch.cuda.is_available() else None
+
+
+class EmptyCachePolicy:
+    """
+    Decides when the trainer releases the blocks the CUDA caching allocator holds. Releasing them every step forces
+    fresh cudaMalloc calls for every batch, so by default this never happens. Set by the `empty_cache` train option:
+    - 'never' (default)
+    - an integer N: every N steps
+    - 'on_oom': only after running out of memory, before the step is retried once. Under DDP the other ranks cannot
+      retry along with this one, so the error is raised instead. Only supported with a single training step, since the
+      retry reruns every step.
+    """
+    def __init__(self, policy, allocator):
+        self.policy = 'never' if policy is None else policy
+        assert self.policy in ['never', 'on_oom'] or isinstance(self.policy, int), f'Unknown empty_cache policy {policy}'
+        self.allocator = allocator
+
+    def after_feed(self, step):
+        if self.allocator is not None and isinstance(self.policy, int) and step % self.policy == 0:
+            self.allocator.empty_cache()
+
+    def should_retry(self, e):
+        """
+        Called with an exception raised by a training step; returns whether the step should be retried. If so, call
+        before_retry() once the exception has been handled: until then its traceback keeps the memory of the failed
+        step alive, and emptying the cache would release nothing.
+        """
+        if self.allocator is None or self.policy != 'on_oom' or not self.allocator.is_oom(e):
+            return False
+        return not (distributed.is_available() and distributed.is_initialized())
+
+    def before_retry(self):
+        self.allocator.empty_cache()
+
+
+def estimate_optimizer_state_bytes(optimizers):
+    """
+    Returns an estimate of the memory <optimizers> will allocate for their state on their first step. Optimizers that
+    already hold state are skipped, since that memory is already allocated. SGD keeps one buffer per parameter if it
+    uses momentum; every other optimizer is assumed to keep two, like Adam.
+    """
+    total = 0
+    for optimizer in optimizers:
+        if len(optimizer.state) > 0:
+            continue
+        for group in optimizer.param_groups:
+            if isinstance(optimizer, torch.optim.SGD):
+                buffers = 1 if group.get('momentum', 0) != 0 else 0
+            else:
+                buffers = 2
+            total += buffers * sum(p.numel() * p.element_size() for p in group['params'])
+    return total
+
+
+def plan_batch_factor(run_largest_micro_batch, batch_size, allocator, target_bytes, candidates=None, reduce_fn=None):
+    """
+    Returns the smallest gradient accumulation factor whose micro-batches fit in <target_bytes>, along with the peak
+    memory measured for each factor tried.
+
+    <run_largest_micro_batch>(factor) must perform the forward and backward pass of the largest micro-batch a batch of
+    <batch_size> is split into with the given factor. It is run once per candidate factor, smallest first, and may run
+    out of memory. <reduce_fn>, if given, combines the peak measured on this process with those of the other processes
+    (e.g. the max across DDP ranks) so that every process picks the same factor.
+    """
+    if candidates is None:
+        candidates = [f for f in [1, 2, 4, 8, 16, 32, 64] if f <= batch_size]
+    peaks = {}
+    for factor in sorted(candidates):
+        allocator.empty_cache()
+        allocator.reset_peak()
+        try:
+            run_largest_micro_batch(factor)
+            peak = allocator.peak()
+        except Exception as e:
+            if not allocator.is_oom(e):
+                raise
+            peak = math.inf
+        if reduce_fn is not None:
+            peak = reduce_fn(peak)
+        peaks[factor] = peak
+        if peak <= target_bytes:
+            return factor, peaks
+    return max(candidates), peaks
+
+
+if __name__ == '__main__':
+    # A model with 1GB of weights and gradients which needs 100MB of activations per sample, on a 4GB device.
+    GB = 2 ** 30
+    allocator = SimulatedAllocator(4 * GB)
+    allocator.allocate(GB)
+
+    def run(factor):
+        activations = math.ceil(64 / factor) * GB // 10
+        allocator.allocate(activations)
+        allocator.free(activations)
+
+    factor, peaks = plan_batch_factor(run, 64, allocator, .6 * allocator.capacity())
+    print('Picked mega_batch_factor', factor, {f: p / GB for f, p in peaks.items()})
+    # 1 and 2 run out of memory. 4 fits (2.6GB at peak) but exceeds the 2.4GB target.
+    assert factor == 8 and peaks[2] == math.inf and peaks[4] < allocator.capacity()
+    policy = EmptyCachePolicy('on_oom', allocator)
+    assert policy.should_retry(SimulatedOutOfMemory()) and not policy.should_retry(ValueError())
+    policy.before_retry()
+    assert allocator.empty_cache_calls == len(peaks) + 1
+
+    params = [torch.nn.Parameter(torch.zeros(256))]
+    assert estimate_optimizer_state_bytes([torch.optim.AdamW(params)]) == 2 * 256 * 4
+    assert estimate_optimizer_state_bytes([torch.optim.SGD(params, lr=.1)]) == 0
@@ -0,0 +1,62 @@
+"""
+Splits a mega-batch into gradient accumulation chunks by padded cost rather than by sample count.
+
+When the mega-batch is sorted by length and every chunk is trimmed to its longest sample (see the `auto_collate` train
+option), a chunk costs roughly (number of samples) * (length of its longest sample) tokens. Splitting the batch into
+equally sized chunks wastes memory: the chunk holding the longest samples is the one that determines whether a batch
+fits, while the chunks of short samples use a fraction of it. The partitions computed here instead give every chunk
+about the same padded cost, so more (short) samples go into each chunk of short samples.
+"""
+
+
+def _greedy_chunks(lengths, budget):
+    # <lengths> is sorted in descending order, so the first sample of a chunk is its longest one.
+    sizes = []
+    i = 0
+    while i < len(lengths):
+        n = max(budget // max(lengths[i], 1), 1)
+        n = min(n, len(lengths) - i)
+        sizes.append(n)
+        i += n
+    return sizes
+
+
+def partition_by_padded_cost(lengths, num_chunks=None, budget=None):
+    """
+    Partitions samples with the given <lengths> (sorted in descending order) into contiguous chunks and returns the
+    chunk sizes.
+
+    If <budget> is specified, chunks are made as large as they can be while their padded cost stays within <budget>
+    tokens; samples longer than <budget> get a chunk of their own. Otherwise, the samples are split into at most
+    <num_chunks> chunks such that the padded cost of the most expensive chunk is minimized.
+    """
+    lengths = [int(l) for l in lengths]
+    assert all(a >= b for a, b in zip(lengths, lengths[1:])), 'lengths must be sorted in descending order.'
+    if len(lengths) == 0:
+        return []
+    if budget is not None:
+        return _greedy_chunks(lengths, budget)
+    assert num_chunks is not None and num_chunks > 0
+    # Greedy chunking is optimal for a given budget when costs grow with chunk size, so binary search the smallest
+    # budget that needs no more than num_chunks chunks.
+    low, high = max(lengths[0], 1), max(lengths[0], 1) * len(lengths)
+    while low < high:
+        mid = (low + high) // 2
+        if len(_greedy_chunks(lengths, mid)) <= num_chunks:
+            high = mid
+        else:
+            low = mid + 1
+    return _greedy_chunks(lengths, low)
+
+
+if __name__ == '__main__':
+    import random
+    lengths = sorted([random.randint(20, 600) for _ in range(64)], reverse=True)
+    for sizes in [[16, 16, 16, 16], partition_by_padded_cost(lengths, num_chunks=4),
+                  partition_by_padded_cost(lengths, budget=4000)]:
+        costs, i = [], 0
+        for s in sizes:
+            costs.append(s * lengths[i])
+            i += s
+        assert i == len(lengths)
+        print(f'sizes={sizes} padded={sum(costs)} max_chunk={max(costs)}')
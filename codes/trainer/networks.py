@@ -7,6 +7,8 @@ import sys
 from collections import OrderedDict
 from inspect import isfunction, getmembers, signature
 
+from utils.registry import LazyRegistry
+
 logger = logging.getLogger('base')
 
 
@@ -45,12 +47,20 @@ def find_registered_model_fns(base_path='models'):
         else:
             mod_name = f'{base_path}/{mod.name}'.replace('/', '.')
             importlib.import_module(mod_name)
-            for mod_fn in getmembers(sys.modules[mod_name], isfunction):
-                if hasattr(mod_fn[1], "_dlas_registered_model"):
-                    found_fns[mod_fn[1]._dlas_model_name] = mod_fn[1]
+            for name, _, fn in _registered_model_fns_in(sys.modules[mod_name]):
+                found_fns[name] = fn
     return found_fns
 
 
+def _registered_model_fns_in(module):
+    return [(fn._dlas_model_name, attr, fn) for attr, fn in getmembers(module, isfunction)
+            if hasattr(fn, "_dlas_registered_model")]
+
+
+# Used by create_model() so that only the module defining the requested model is imported.
+model_registry = LazyRegistry('model', 'models', _registered_model_fns_in, exclude_packages=['flownet2'])
+
+
 class CreateModelError(Exception):
     def __init__(self, name, available):
         super().__init__(f'Could not find the specified model name: {name}. Tip: If your model is in a'
@@ -65,11 +75,17 @@ def create_model(opt, opt_net, other_nets=None):
         which_model = opt_net['which_model_G']
     if not which_model:
         which_model = opt_net['which_model_D']
-    registered_fns = find_registered_model_fns()
-    if which_model not in registered_fns.keys():
-        raise CreateModelError(which_model, list(registered_fns.keys()))
-    num_params = len(signature(registered_fns[which_model]).parameters)
+    if which_model not in model_registry:
+        raise CreateModelError(which_model, model_registry.names())
+    model_fn = model_registry.get(which_model)
+    num_params = len(signature(model_fn).parameters)
     if num_params == 2:
-        return registered_fns[which_model](opt_net, opt)
+        net = model_fn(opt_net, opt)
     else:
-        return registered_fns[which_model](opt_net, opt, other_nets)
+        net = model_fn(opt_net, opt, other_nets)
+    # Networks built from models.arch_util attention blocks can switch to a fused or memory-bounded attention kernel.
+    if 'attention_backend' in opt_net.keys():
+        from models.arch_util import set_attention_backend
+        chunk_size = opt_net['attention_chunk_size'] if 'attention_chunk_size' in opt_net.keys() else 1024
+        set_attention_backend(net, opt_net['attention_backend'], chunk_size)
+    return net
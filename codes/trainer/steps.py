@@ -9,6 +9,7 @@ from trainer.losses import create_loss
 import torch
 from collections import OrderedDict
 from trainer.inject import create_injector
+from utils.multi_tensor import grads_are_finite
 from utils.util import recursively_detach, opt_get, clip_grad_norm
 
 logger = logging.getLogger('base')
@@ -274,6 +275,7 @@ class ConfigurableStep(Module):
         if len(self.losses) > 0:
             # Finally, compute the losses.
             total_loss = 0
+            loss_values = {}
             for loss_name, loss in self.losses.items():
                 multiplier = 1
                 # Some losses only activate after a set number of steps. For example, proto-discriminator losses can
@@ -288,29 +290,33 @@ class ConfigurableStep(Module):
                     new_state.update(lstate)
                 else:
                     l = loss(self.get_network_for_name(self.step_opt['training']), local_state)
-                if not l.isfinite():
-                    print(f'!!Detected non-finite loss {loss_name}')
                 total_loss += l * self.weights[loss_name] * multiplier
                 # Record metrics.
                 if isinstance(l, torch.Tensor):
+                    loss_values[loss_name] = l
                     loss_accumulator.add_loss(loss_name, l)
                 for n, v in loss.extra_metrics():
                     loss_accumulator.add_loss("%s_%s" % (loss_name, n), v)
                     loss.clear_metrics()
 
+            total_loss_finite = self.check_losses_finite(loss_values, total_loss)
             # In some cases, the loss could not be set (e.g. all losses have 'after')
-            if train and isinstance(total_loss, torch.Tensor) and total_loss.isfinite():
+            if train and isinstance(total_loss, torch.Tensor) and total_loss_finite:
                 loss_accumulator.add_loss("%s_total" % (self.get_training_network_name(),), total_loss)
 
-                # Scale the loss down by the accumulation factor.
-                total_loss = total_loss / self.env['mega_batch_factor']
+                # Scale the loss down by the accumulation factor, or by the share of the batch this micro-batch holds
+                # when micro-batches are of different sizes.
+                if self.env.get('micro_batch_weights') is not None:
+                    total_loss = total_loss * self.env['micro_batch_weights'][grad_accum_step]
+                else:
+                    total_loss = total_loss / self.env['mega_batch_factor']
 
                 # Get dem grads!
                 self.scaler.scale(total_loss).backward()
                 self.grads_generated = True
                 # Reset nan_loss_counter
                 self.nan_loss_counter = 0
-            elif not total_loss.isfinite():
+            elif not total_loss_finite:
                 print("Non-finite loss encountered. Skipping backwards step.")
                 self.nan_loss_counter += 1
                 if self.nan_loss_counter > 10:
@@ -332,6 +338,21 @@ class ConfigurableStep(Module):
 
         return new_state
 
+    # Reports non-finite <losses> and returns whether <total_loss> is finite. Everything is checked on-device and
+    # fetched at once, so this costs a single host-device sync no matter how many losses there are.
+    def check_losses_finite(self, losses, total_loss):
+        values = list(losses.values())
+        if isinstance(total_loss, torch.Tensor):
+            values.append(total_loss)
+        if len(values) == 0:
+            return True
+        device = values[-1].device
+        finite = torch.stack([torch.isfinite(v.detach()).all().to(device) for v in values]).tolist()
+        for loss_name, f in zip(losses.keys(), finite):
+            if not f:
+                print(f'!!Detected non-finite loss {loss_name}')
+        return finite[-1] if isinstance(total_loss, torch.Tensor) else True
+
     # Performs the optimizer step after all gradient accumulation is completed. Default implementation simply steps()
     # all self.optimizers.
     def do_step(self, step):
@@ -353,13 +374,7 @@ class ConfigurableStep(Module):
 
             nan_found = False
             if self.check_grads_for_nan:
-                for pg in opt.param_groups:
-                    for p in pg['params']:
-                        if not torch.isfinite(p.grad).any():
-                            nan_found = True
-                            break
-                    if nan_found:
-                        break
+                nan_found = not grads_are_finite([p for pg in opt.param_groups for p in pg['params']]).item()
                 if nan_found:
                     print("NaN found in grads. Throwing this step out.")
                     self.nan_counter += 1
@@ -379,6 +394,11 @@ class ConfigurableStep(Module):
                 self.scaler.update()
             else:
                 opt.zero_grad()
+                # The gradients were unscaled (which records whether they overflowed) by ExtensibleTrainer. Let the
+                # scaler lower its scale for an overflow and reset its per-optimizer state, or the next step would skip
+                # unscaling and keep overflowing.
+                if self.scaler.is_enabled():
+                    self.scaler.update()
 
     def get_metrics(self):
         metrics = self.loss_accumulator.as_dict()
@@ -4,6 +4,9 @@ import torch
 from torch import distributed
 
 
+# Buffers live on the device of the first value logged under each name and values are copied into them on-device, so
+# logging a loss never waits for the device. as_dict() computes the means on-device as well; use metrics_to_cpu() to
+# fetch them.
 class LossAccumulator:
     def __init__(self, buffer_sz=50):
         self.buffer_sz = buffer_sz
@@ -11,23 +14,26 @@ class LossAccumulator:
         self.counters = {}
 
     def add_loss(self, name, tensor):
+        # Can take tensors or just plain python numbers.
+        if isinstance(tensor, torch.Tensor):
+            tensor = tensor.detach()
+            if '_histogram' in name:
+                tensor = torch.flatten(tensor)
         if name not in self.buffers.keys():
+            device = tensor.device if isinstance(tensor, torch.Tensor) else 'cpu'
             if "_histogram" in name:
-                tensor = torch.flatten(tensor.detach().cpu())
-                self.buffers[name] = (0, torch.zeros((self.buffer_sz, tensor.shape[0])), False)
+                self.buffers[name] = (0, torch.zeros((self.buffer_sz, tensor.shape[0]), device=device), False)
             else:
-                self.buffers[name] = (0, torch.zeros(self.buffer_sz), False)
+                self.buffers[name] = (0, torch.zeros(self.buffer_sz, device=device), False)
         i, buf, filled = self.buffers[name]
-        # Can take tensors or just plain python numbers.
-        if '_histogram' in name:
-            buf[i] = torch.flatten(tensor.detach().cpu())
-        elif isinstance(tensor, torch.Tensor):
-            buf[i] = tensor.detach().cpu()
-        else:
-            buf[i] = tensor
+        buf[i] = tensor
         filled = i+1 >= self.buffer_sz or filled
         self.buffers[name] = ((i+1) % self.buffer_sz, buf, filled)
 
+    def clear(self):
+        self.buffers = {}
+        self.counters = {}
+
     def increment_metric(self, name):
         if name not in self.counters.keys():
             self.counters[name] = 1
@@ -49,6 +55,26 @@ class LossAccumulator:
         return result
 
 
+def metrics_to_cpu(metrics):
+    """
+    Moves the tensors of a dict of metrics to the CPU with one transfer per device rather than one per tensor. Every
+    transfer waits for the device to catch up, so fetching metrics one at a time stalls training once per metric.
+    """
+    result = dict(metrics)
+    by_device = {}
+    for k, v in metrics.items():
+        if isinstance(v, torch.Tensor) and v.device.type != 'cpu':
+            by_device.setdefault(v.device, []).append(k)
+    for keys in by_device.values():
+        flat = torch.cat([metrics[k].detach().float().flatten() for k in keys]).cpu()
+        offset = 0
+        for k in keys:
+            n = metrics[k].numel()
+            result[k] = flat[offset:offset+n].view(metrics[k].shape)
+            offset += n
+    return result
+
+
 # Stores losses in an infinitely-sized list.
 class InfStorageLossAccumulator:
     def __init__(self):
@@ -0,0 +1,171 @@
+"""
+Multi-tensor versions of the per-parameter passes the trainer makes every step: EMA updates, gradient norms, non-finite
+gradient checks and gradient scaling.
+
+Looping over parameters in Python launches one or more kernels per parameter, and checks like
+`if not torch.isfinite(p.grad).any()` additionally wait for the GPU every time. The functions here hand whole lists of
+tensors to torch._foreach_* ops, which process them in a few fused launches, and return device tensors rather than
+Python values so the caller decides when (and whether) to sync.
+"""
+from collections import defaultdict
+from math import sqrt
+
+import torch
+import torch.nn as nn
+
+import maybe_bnb as mbnb
+
+
+def _group_by_device_and_dtype(*tensor_lists):
+    # _foreach ops need every tensor of a call to share a device and dtype. Groups are keyed by the first list.
+    groups = defaultdict(lambda: tuple([] for _ in tensor_lists))
+    for tensors in zip(*tensor_lists):
+        group = groups[(tensors[0].device, tensors[0].dtype)]
+        for l, t in zip(group, tensors):
+            l.append(t)
+    return groups.values()
+
+
+def _norms(tensors, norm_type):
+    if hasattr(torch, '_foreach_norm'):
+        return list(torch._foreach_norm(tensors, norm_type))
+    return [torch.norm(t, norm_type) for t in tensors]
+
+
+def get_grads(parameters):
+    """ Returns the detached gradients of those of <parameters> that have one. """
+    return [p.grad.detach() for p in parameters if p.grad is not None]
+
+
+def total_norm(tensors, norm_type=2.0):
+    """
+    Returns the norm of <tensors> as if they were concatenated into one vector, as a tensor on the device of the first
+    tensor, or None if <tensors> is empty.
+    """
+    if len(tensors) == 0:
+        return None
+    device = tensors[0].device
+    norm_type = float(norm_type)
+    if norm_type == float('inf'):
+        norms = [t.abs().max().to(device) for t in tensors]
+        return torch.max(torch.stack(norms))
+    norms = []
+    for (group,) in _group_by_device_and_dtype(tensors):
+        norms.extend(n.to(device) for n in _norms(group, norm_type))
+    return torch.norm(torch.stack(norms), norm_type)
+
+
+def grad_norm(parameters, norm_type=2.0):
+    """ Returns the total norm of the gradients of <parameters>, or None if none of them have a gradient. """
+    return total_norm(get_grads(parameters), norm_type)
+
+
+def grads_are_finite(parameters):
+    """
+    Returns a boolean tensor that is False if any gradient of <parameters> has no finite element at all, which is what
+    the trainer's check_grads_for_nan option discards a step for. Individual NaN or inf elements are left to the
+    GradScaler, which skips the step and lowers its scale for them. Every gradient is checked on-device and the results
+    are reduced together, so reading the result costs a single sync.
+    """
+    grads = get_grads(parameters)
+    if len(grads) == 0:
+        return torch.tensor(True)
+    device = grads[0].device
+    return torch.stack([torch.isfinite(g).any().to(device) for g in grads]).all()
+
+
+def scale_tensors_(tensors, scales):
+    """ Multiplies each of <tensors> in-place by the matching Python number of <scales>. """
+    by_scale = defaultdict(list)
+    for t, s in zip(tensors, scales):
+        by_scale[s].append(t)
+    for s, ts in by_scale.items():
+        for (group,) in _group_by_device_and_dtype(ts):
+            torch._foreach_mul_(group, s)
+
+
+def ema_update_(ema_params, params, rate):
+    """
+    Performs ema = ema * rate + param * (1 - rate) for every pair of <ema_params> and <params>. Parameters that are not
+    on the device of their EMA (e.g. when the EMA is kept on the CPU) are copied there first.
+    """
+    ema_params = [p.detach() for p in ema_params]
+    params = [p.detach() if p.device == ep.device else p.detach().to(ep.device) for ep, p in zip(ema_params, params)]
+    for eps, ps in _group_by_device_and_dtype(ema_params, params):
+        torch._foreach_mul_(eps, rate)
+        torch._foreach_add_(eps, ps, alpha=1 - rate)
+
+
+def fan_in_grad_scales(networks, basis):
+    """
+    Returns the weights whose gradients the trainer's automatically_scale_grads_for_fanin option scales, and the factor
+    each is scaled by: sqrt(<basis>) / sqrt(fan_in) for the weights of linear and 1D convolution layers. Module
+    structure does not change during training, so this is computed once and reused with scale_tensors_().
+    """
+    asb = sqrt(basis)
+    weights, scales = [], []
+    for net in networks:
+        for mod in net.modules():
+            fan_in = -1
+            if isinstance(mod, mbnb.nn.Linear):
+                fan_in = mod.weight.data.shape[1]
+            elif isinstance(mod, nn.Conv1d):
+                fan_in = mod.weight.data.shape[0]
+            if fan_in != -1:
+                weights.append(mod.weight)
+                scales.append(asb / sqrt(fan_in))
+    return weights, scales
+
+
+if __name__ == '__main__':
+    # Checks the multi-tensor ops against per-parameter loops and times both, on a model shaped like a ~400M parameter
+    # transformer.
+    from time import time
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    layers, dim = (24, 1024) if device == 'cuda' else (4, 512)
+    params = []
+    for _ in range(layers):
+        for shape in [(dim * 3, dim), (dim * 3,), (dim, dim), (dim,), (dim * 4, dim), (dim * 4,), (dim, dim * 4),
+                      (dim,), (dim,), (dim,), (dim,), (dim,)]:
+            p = nn.Parameter(torch.randn(shape, device=device))
+            p.grad = torch.randn(shape, device=device)
+            params.append(p)
+    ema = [p.detach().clone() for p in params]
+    ema_ref = [p.detach().clone() for p in params]
+    print(f'{len(params)} tensors, {sum(p.numel() for p in params) / 1e6:.1f}M parameters on {device}')
+
+    def bench(name, fn, iters=20):
+        fn()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time()
+        for _ in range(iters):
+            fn()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        print(f'{name}: {(time() - start) / iters * 1000:.2f}ms')
+
+    def loop_ema():
+        for ep, p in zip(ema_ref, params):
+            ep.mul_(.999).add_(p.detach(), alpha=.001)
+    bench('EMA, per-parameter', loop_ema)
+    bench('EMA, multi-tensor', lambda: ema_update_(ema, params, .999))
+    print('EMA max difference:', max((a - b).abs().max().item() for a, b in zip(ema, ema_ref)))
+
+    loop_norm = lambda: torch.norm(torch.stack([torch.norm(p.grad.detach(), 2) for p in params]), 2)
+    bench('Grad norm, per-parameter', loop_norm)
+    bench('Grad norm, multi-tensor', lambda: grad_norm(params))
+    print('Grad norm difference:', (loop_norm() - grad_norm(params)).abs().item())
+
+    def loop_finite():
+        for p in params:
+            if not torch.isfinite(p.grad).any():
+                return False
+        return True
+    bench('Finite check, per-parameter', loop_finite)
+    bench('Finite check, single sync', lambda: bool(grads_are_finite(params)))
+    params[-1].grad[0] = float('nan')
+    assert loop_finite() and grads_are_finite(params)  # A single NaN is the GradScaler's business.
+    params[-1].grad.fill_(float('inf'))
+    assert not loop_finite() and not grads_are_finite(params)
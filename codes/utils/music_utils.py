@@ -1,14 +1,16 @@
 import torch
 
 
+def _music_mel_frontend(device):
+    from trainer.injectors.audio_injectors import TorchMelSpectrogramInjector, get_mel_frontend
+    return get_mel_frontend(TorchMelSpectrogramInjector, device, n_mel_channels=256, mel_fmax=11000, filter_length=16000,
+                            normalize=True, true_normalization=True)
+
+
 def music2mel(clip):
     if len(clip.shape) == 1:
         clip = clip.unsqueeze(0)
-
-    from trainer.injectors.audio_injectors import TorchMelSpectrogramInjector
-    inj = TorchMelSpectrogramInjector({'n_mel_channels': 256, 'mel_fmax': 11000, 'filter_length': 16000,
-                                       'normalize': True, 'true_normalization': True, 'in': 'in', 'out': 'out'}, {})
-    return inj({'in': clip})['out']
+    return _music_mel_frontend(clip.device)({'in': clip})['out']
 
 
 def music2cqt(clip):
@@ -0,0 +1,133 @@
+"""
+Lazy lookup of the models, injectors and evaluators DLAS discovers by scanning its source directories.
+
+Discovering them requires importing every module of the scanned directory, which takes tens of seconds for models/.
+A LazyRegistry scans a directory once and persists what it found to a manifest file in that directory, which maps each
+registered name to the module defining it. The manifest records the modification time of every module it covers, so
+later processes only re-import modules that changed since it was written. Looking up a name imports just the module
+that defines it. Within a process, the registry is built once and shared.
+"""
+import importlib
+import json
+import os
+import sys
+import threading
+
+MANIFEST_VERSION = 1
+
+
+def walk_modules(base_path, exclude_packages=(), exclude_modules=()):
+    """
+    Yields (module name, file path) for every module under <base_path>, descending into packages. Follows the order and
+    rules of pkgutil.walk_packages(), which the find_registered_* functions use, but without importing anything.
+    """
+    for entry in sorted(os.listdir(base_path)):
+        path = os.path.join(base_path, entry)
+        if os.path.isdir(path):
+            if entry.isidentifier() and os.path.exists(os.path.join(path, '__init__.py')) and entry not in exclude_packages:
+                yield from walk_modules(f'{base_path}/{entry}', exclude_packages, exclude_modules)
+        elif entry.endswith('.py') and entry != '__init__.py':
+            name = entry[:-3]
+            if not name.isidentifier() or any(e in name for e in exclude_modules):
+                continue
+            yield f'{base_path}/{name}'.replace('/', '.'), path
+
+
+class LazyRegistry:
+    """
+    Registry of the objects found in the modules under <base_path>. <find_members> is called with each imported module
+    and returns (registered name, attribute name, object) for each object of that module that should be registered.
+    When several modules register the same name, the last one scanned wins, like with the find_registered_* functions.
+    """
+    def __init__(self, kind, base_path, find_members, exclude_packages=(), exclude_modules=()):
+        self.kind = kind
+        self.base_path = base_path
+        self.find_members = find_members
+        self.exclude_packages = exclude_packages
+        self.exclude_modules = exclude_modules
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def manifest_path(self):
+        return os.path.join(self.base_path, f'.{self.kind}_registry.json')
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path(), 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest['modules']
+
+    def _save_manifest(self, modules):
+        path = self.manifest_path()
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'modules': modules}, f)
+            # Atomic, so that concurrent processes (e.g. DDP ranks) never read a partially written manifest.
+            os.replace(tmp, path)
+        except OSError:
+            pass  # The manifest only speeds up startup; not being able to write it (e.g. read-only checkouts) is fine.
+
+    def _scan(self, mod_name):
+        module = importlib.import_module(mod_name)
+        members = {}
+        for name, attr, obj in self.find_members(module):
+            # Point at the module that defines the object rather than the one that imports it, if possible, so that
+            # looking it up imports as little as possible.
+            owner = getattr(obj, '__module__', None)
+            if owner is None or getattr(sys.modules.get(owner), attr, None) is not obj:
+                owner = mod_name
+            members[name] = [owner, attr]
+        return members
+
+    def build(self, use_manifest=True):
+        cached = self._load_manifest() if use_manifest else {}
+        modules = {}
+        for mod_name, path in walk_modules(self.base_path, self.exclude_packages, self.exclude_modules):
+            mtime = os.stat(path).st_mtime_ns
+            entry = cached.get(mod_name)
+            if entry is None or entry['mtime'] != mtime:
+                entry = {'mtime': mtime, 'members': self._scan(mod_name)}
+            modules[mod_name] = entry
+        if modules != cached:
+            self._save_manifest(modules)
+        entries = {}
+        for entry in modules.values():
+            for name, (owner, attr) in entry['members'].items():
+                entries[name] = (owner, attr)
+        self.entries = entries
+
+    def _ensure_built(self):
+        with self.lock:
+            if self.entries is None:
+                self.build()
+
+    def names(self):
+        self._ensure_built()
+        return list(self.entries.keys())
+
+    def __contains__(self, name):
+        self._ensure_built()
+        return name in self.entries
+
+    def get(self, name):
+        """ Returns the object registered under <name>, importing only the module that defines it. """
+        self._ensure_built()
+        owner, attr = self.entries[name]
+        try:
+            return getattr(importlib.import_module(owner), attr)
+        except (ModuleNotFoundError, AttributeError):
+            # The manifest is stale in a way modification times did not reveal, e.g. a module changed what it imports
+            # from another one. Rescan everything.
+            with self.lock:
+                self.build(use_manifest=False)
+            owner, attr = self.entries[name]
+            return getattr(importlib.import_module(owner), attr)
+
+    def all(self):
+        """ Returns a dict of every registered name to its object. Imports every module that registers something. """
+        return {name: self.get(name) for name in self.names()}
@@ -0,0 +1,85 @@
+import torch
+import torch.nn.functional as F
+
+
+def _tile_starts(length, tile, stride):
+    starts = list(range(0, max(length - tile, 0) + 1, stride))
+    if starts[-1] + tile < length:
+        starts.append(length - tile)
+    return starts
+
+
+def _feather(size, ramp, device):
+    # Weights ramp linearly up from the edges of a tile. They never reach zero, so pixels covered by a single tile (e.g.
+    # along the image border) keep their value once the blend is normalized.
+    w = torch.ones(size, device=device)
+    ramp = min(ramp, size // 2)  # Tiles can be narrower than twice the overlap, e.g. along a dimension of a tiny input.
+    if ramp > 0:
+        r = torch.arange(1, ramp + 1, device=device, dtype=torch.float) / (ramp + 1)
+        w[:ramp] = r
+        w[-ramp:] = torch.minimum(w[-ramp:], r.flip(0))
+    return w
+
+
+def tiled_inference(fn, img, tile_size=256, overlap=32, batch_size=8, force_multiple=1, output_device=None):
+    """
+    Applies the image-to-image function <fn> (e.g. a super-resolution generator) to a (b,c,h,w) <img> one tile at a
+    time, so that memory use is bounded by the tile size rather than the image size.
+
+    The image is cut into <tile_size> tiles that overlap their neighbors by at least <overlap> pixels. Tiles of all
+    images of the batch are pushed through <fn> in batches of <batch_size>. Outputs are blended back together with
+    weights that ramp linearly across the overlaps, which hides the seams tiles would otherwise leave. The output scale
+    and channel count are inferred from the output of <fn>.
+
+    Inputs smaller than a tile are reflect-padded (zero-padded if they are too small to reflect). <force_multiple>
+    rounds the tile size (and thus every input <fn> sees) up to a multiple of that value. The result is accumulated on
+    <output_device>, which defaults to the device of <img>; pass 'cpu' to keep large outputs off the GPU.
+    """
+    assert overlap * 2 < tile_size
+    b, _, h, w = img.shape
+    tile_size = force_multiple * ((tile_size + force_multiple - 1) // force_multiple)
+    th, tw = min(tile_size, h), min(tile_size, w)
+    th, tw = [force_multiple * ((t + force_multiple - 1) // force_multiple) for t in (th, tw)]
+    pad_h, pad_w = max(th - h, 0), max(tw - w, 0)
+    if pad_h > 0 or pad_w > 0:
+        mode = 'reflect' if pad_h < h and pad_w < w else 'constant'
+        img = F.pad(img, (0, pad_w, 0, pad_h), mode=mode)
+    ph, pw = img.shape[-2:]
+    output_device = img.device if output_device is None else output_device
+
+    tiles = [(i, y, x) for i in range(b)
+             for y in _tile_starts(ph, th, max(th - overlap, 1))
+             for x in _tile_starts(pw, tw, max(tw - overlap, 1))]
+    out, weights, window, scale = None, None, None, None
+    for t in range(0, len(tiles), batch_size):
+        batch = tiles[t:t+batch_size]
+        results = fn(torch.stack([img[i, :, y:y+th, x:x+tw] for i, y, x in batch], dim=0))
+        if out is None:
+            scale = results.shape[-1] // tw
+            out = torch.zeros((b, results.shape[1], ph * scale, pw * scale), device=output_device)
+            weights = torch.zeros((1, 1, ph * scale, pw * scale), device=output_device)
+            window = (_feather(th * scale, overlap * scale, output_device).unsqueeze(1) *
+                      _feather(tw * scale, overlap * scale, output_device).unsqueeze(0))
+        results = results.to(output_device, dtype=torch.float)
+        for (i, y, x), r in zip(batch, results):
+            ys, xs = y * scale, x * scale
+            out[i, :, ys:ys+th*scale, xs:xs+tw*scale] += r * window
+            if i == 0:
+                weights[0, 0, ys:ys+th*scale, xs:xs+tw*scale] += window
+    out = out / weights
+    return out[:, :, :h * scale, :w * scale]
+
+
+if __name__ == '__main__':
+    # Tiling must be exact for pointwise functions and close for local ones.
+    img = torch.rand(2, 3, 300, 517)
+    upsample = lambda x: F.interpolate(x, scale_factor=2, mode='nearest') * 2
+    tiled = tiled_inference(upsample, img, tile_size=128, overlap=16, batch_size=5)
+    print('pointwise max error:', (tiled - upsample(img)).abs().max().item())
+    blur = lambda x: F.avg_pool2d(x, 3, stride=1, padding=1)
+    tiled = tiled_inference(blur, img, tile_size=128, overlap=16, batch_size=5, force_multiple=16)
+    print('local mean error:', (tiled - blur(img))[:, :, 1:-1, 1:-1].abs().mean().item())
+    small = torch.rand(1, 3, 40, 50)
+    print('small input shape:', tiled_inference(upsample, small, tile_size=64, overlap=8, force_multiple=16).shape)
+    tiny = torch.rand(1, 3, 6, 50)
+    print('tiny input shape:', tiled_inference(upsample, tiny, tile_size=64, overlap=8).shape)
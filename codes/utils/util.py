@@ -27,6 +27,7 @@ from torch import inf
 import yaml
 
 from trainer import networks
+from utils import multi_tensor
 
 try:
     from yaml import CLoader as Loader, CDumper as Dumper
@@ -460,16 +461,11 @@ def clip_grad_norm(parameters: list, parameter_names: list, max_norm: float, nor
     norm_type = float(norm_type)
     if len(parameters) == 0:
         return torch.tensor(0.)
-    device = parameters[0].grad.device
-    if norm_type == inf:
-        norms = [p.grad.detach().abs().max().to(device) for p in parameters]
-        total_norm = norms[0] if len(norms) == 1 else torch.max(torch.stack(norms))
-    else:
-        total_norm = torch.norm(torch.stack([torch.norm(p.grad.detach(), norm_type).to(device) for p in parameters]), norm_type)
+    grads = [p.grad.detach() for p in parameters]
+    total_norm = multi_tensor.total_norm(grads, norm_type)
     clip_coef = max_norm / (total_norm + 1e-6)
     if clip_coef < 1:
-        for p in parameters:
-            p.grad.detach().mul_(clip_coef.to(p.grad.device))
+        multi_tensor.scale_tensors_(grads, [clip_coef.item()] * len(grads))
     return total_norm
 
 